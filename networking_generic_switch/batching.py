@@ -13,26 +13,169 @@
 #    under the License.
 
 import atexit
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import heapq
 import json
+import threading
+import time
+import zlib
 
-import etcd3gw
-from etcd3gw import exceptions as etcd3gw_exc
-from etcd3gw.utils import _decode
-from etcd3gw.utils import _encode
-from etcd3gw.utils import _increment_last_byte
 import eventlet
 from oslo_log import log as logging
 from oslo_utils import netutils
 from oslo_utils import uuidutils
-import tenacity
 
+from networking_generic_switch import _lazy_import
+from networking_generic_switch import connection_pool
 from networking_generic_switch import exceptions as exc
+from networking_generic_switch import save_scheduler
+
+# NOTE: etcd3gw is imported on first use, as it is relatively slow to import
+# and is only needed when batching is enabled.
+etcd3gw = _lazy_import.lazy_import('etcd3gw')
+etcd3gw_exc = _lazy_import.lazy_import('etcd3gw.exceptions')
+etcd3gw_utils = _lazy_import.lazy_import('etcd3gw.utils')
+etcd3gw_watch = _lazy_import.lazy_import('etcd3gw.watch')
+paramiko = _lazy_import.lazy_import('paramiko')
+requests = _lazy_import.lazy_import('requests')
+tenacity = _lazy_import.lazy_import('tenacity')
 
 SHUTDOWN_TIMEOUT = 60
 
+# Interval in seconds at which a caller waiting for a result checks the
+# result key directly, in case the shared watch missed the result.
+RESULT_POLL_INTERVAL = 30
+
+# Maximum number of operations in an etcd transaction. This is the default
+# value of the etcd --max-txn-ops option.
+MAX_TXN_OPS = 128
+
+# Ages in seconds after which the janitor removes queued batches and results
+# that have not been consumed. Callers stop waiting for a result after 300
+# seconds by default, and check for their result at least every
+# RESULT_POLL_INTERVAL seconds.
+ORPHAN_INPUT_AGE = 330
+ORPHAN_RESULT_AGE = 2 * RESULT_POLL_INTERVAL
+
+# First byte of values stored in the compact encoding, followed by zlib
+# compressed JSON. Values in the original encoding are uncompressed JSON, and
+# so start with '{'.
+COMPACT_FORMAT_V1 = b'\x01'
+
+# Interval in seconds at which a worker refreshes the switch lock while it
+# holds it. This must be shorter than the lock TTL.
+LOCK_HEARTBEAT_INTERVAL = 30
+
+# Maximum number of idle connections to etcd kept open by each client.
+# Connections in excess of this, such as those used by watches while many
+# switches are busy, are closed once they are no longer used.
+ETCD_POOL_SIZE = 10
+
 LOG = logging.getLogger(__name__)
 
-THREAD_POOL = eventlet.greenpool.GreenPool()
+THREAD_POOL = None
+
+# Maximum number of switches whose batches are executed concurrently by
+# switch executors in a process.
+EXECUTOR_POOL_SIZE = 64
+
+EXECUTOR_POOL = None
+
+_RESULT_WATCHERS = {}
+_RESULT_WATCHERS_LOCK = threading.Lock()
+
+# etcd clients, by connection parameters.
+_ETCD_CLIENTS = {}
+_ETCD_CLIENTS_LOCK = threading.Lock()
+
+# In-memory queues, by switch name.
+_MEMORY_QUEUES = {}
+_MEMORY_QUEUES_LOCK = threading.Lock()
+
+
+def _get_thread_pool():
+    """Return the pool of batch worker threads, creating it if necessary."""
+    global THREAD_POOL
+    if THREAD_POOL is None:
+        THREAD_POOL = eventlet.greenpool.GreenPool()
+    return THREAD_POOL
+
+
+def _get_executor_pool():
+    """Return the pool of switch executor threads, creating it if necessary."""
+    global EXECUTOR_POOL
+    if EXECUTOR_POOL is None:
+        EXECUTOR_POOL = eventlet.greenpool.GreenPool(EXECUTOR_POOL_SIZE)
+    return EXECUTOR_POOL
+
+
+def get_etcd_client(etcd_url):
+    """Return the etcd client for a URL, creating it if necessary.
+
+    Clients are shared by all switches in the process that use the same etcd
+    endpoint and credentials, so that they share a pool of HTTP connections.
+
+    :param etcd_url: etcd3gw URL, in the format used by the tooz etcd3gw
+        driver.
+    :returns: an etcd3gw client.
+    """
+    parsed_url = netutils.urlsplit(etcd_url)
+    protocol = 'https' if parsed_url.scheme.endswith('https') else 'http'
+    # Use the same parameter format as tooz etcd3gw driver.
+    params = parsed_url.params()
+    key = (parsed_url.hostname, parsed_url.port, protocol,
+           params.get('ca_cert'), params.get('cert_key'),
+           params.get('cert_cert'), params.get('api_version', 'v3alpha'))
+    with _ETCD_CLIENTS_LOCK:
+        client = _ETCD_CLIENTS.get(key)
+        if client is None:
+            client = _create_etcd_client(*key)
+            _ETCD_CLIENTS[key] = client
+        return client
+
+
+def _create_etcd_client(host, port, protocol, ca_cert, cert_key, cert_cert,
+                        api_version):
+    client = etcd3gw.client(
+        host=host, port=port, protocol=protocol,
+        ca_cert=ca_cert, cert_key=cert_key, cert_cert=cert_cert,
+        api_path='/' + api_version + '/',
+        timeout=30)
+    # Keep a bounded number of connections alive for reuse by all switches.
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=ETCD_POOL_SIZE)
+    client.session.mount('http://', adapter)
+    client.session.mount('https://', adapter)
+    return client
+
+
+def encode_value(value, compact=False):
+    """Encode a batch or result for storage in etcd.
+
+    :param value: a dict to encode.
+    :param compact: whether to use the compact encoding.
+    :returns: the encoded value as bytes.
+    """
+    if not compact:
+        return json.dumps(value, sort_keys=True).encode('utf-8')
+    data = json.dumps(value, sort_keys=True, separators=(',', ':'))
+    return COMPACT_FORMAT_V1 + zlib.compress(data.encode('utf-8'))
+
+
+def decode_value(raw_value):
+    """Decode a batch or result stored in etcd, in either encoding.
+
+    :param raw_value: the encoded value, as bytes.
+    :returns: the decoded dict.
+    """
+    if isinstance(raw_value, str):
+        raw_value = raw_value.encode('utf-8')
+    if raw_value[:1] == COMPACT_FORMAT_V1:
+        raw_value = zlib.decompress(raw_value[1:])
+    return json.loads(raw_value.decode('utf-8'))
 
 
 class ShutdownTimeout(Exception):
@@ -40,25 +183,673 @@ class ShutdownTimeout(Exception):
 
 
 @atexit.register
+def _shutdown():
+    """Wait for worker threads, then run pending configuration saves.
+
+    Workers completing while we wait may schedule saves, so pending saves are
+    only run once the workers have finished.
+    """
+    _wait_for_threads()
+    save_scheduler.flush_all_schedulers()
+
+
 def _wait_for_threads():
     """Wait for all threads in the pool to complete.
 
-    This function is registered to execute at exit, to ensure that all worker
-    threads have completed. These threads may be holding switch execution locks
-    and performing switch configuration operations which should not be
+    This function is called at exit, to ensure that all worker threads have
+    completed. These threads may be holding switch execution locks and
+    performing switch configuration operations which should not be
     interrupted.
     """
+    pools = [pool for pool in (THREAD_POOL, EXECUTOR_POOL)
+             if pool is not None]
+    if not pools:
+        return
     LOG.info("Waiting %d seconds for %d threads to complete",
-             SHUTDOWN_TIMEOUT, THREAD_POOL.running())
+             SHUTDOWN_TIMEOUT, sum(pool.running() for pool in pools))
     try:
         with eventlet.Timeout(SHUTDOWN_TIMEOUT, ShutdownTimeout):
-            THREAD_POOL.waitall()
+            for pool in pools:
+                pool.waitall()
     except ShutdownTimeout:
         LOG.error("Timed out waiting for threads to complete")
     else:
         LOG.info("Finished waiting for threads to complete")
 
 
+# Pairs of operations that cancel each other out when applied to the same
+# port and VLAN.
+INVERSE_OPS = {
+    'add network': 'delete network',
+    'delete network': 'add network',
+    'plug port': 'unplug port',
+    'unplug port': 'plug port',
+    'plug bond': 'unplug bond',
+    'unplug bond': 'plug bond',
+}
+
+
+def _op_resources(op):
+    resources = {('vlan', op.get('vlan'))}
+    if 'port' in op:
+        resources.add(('port', op['port']))
+    return resources
+
+
+def coalesce_batches(batches):
+    """Find batches that do not need to be executed.
+
+    A batch followed by a batch with the inverse operation on the same port,
+    VLAN and network is cancelled, along with the inverse batch, provided
+    that no batch in between uses the port or VLAN. A batch that repeats an
+    earlier batch with the same operation and commands, with no batch in
+    between using the port or VLAN, is a duplicate of the earlier batch.
+    Batches without an operation are never coalesced, and are not reordered
+    with other batches.
+
+    :param batches: a list of batch dicts, in execution order.
+    :returns: a dict mapping the index of each batch that should be skipped
+        to None if it was cancelled, or to the index of an earlier batch
+        whose result it should share.
+    """
+    skipped = {}
+    changed = True
+    while changed:
+        changed = False
+        live = [i for i in range(len(batches)) if i not in skipped]
+        for pos, i in enumerate(live):
+            op = batches[i].get('op')
+            if not op:
+                continue
+            resources = _op_resources(op)
+            for j in live[pos + 1:]:
+                if j in skipped:
+                    continue
+                other = batches[j].get('op')
+                # Batches without an operation may touch anything.
+                if not other:
+                    break
+                if not resources & _op_resources(other):
+                    continue
+                if (other.get('port') != op.get('port')
+                        or other.get('vlan') != op.get('vlan')
+                        or other.get('network_id') != op.get('network_id')):
+                    break
+                if other['name'] == INVERSE_OPS.get(op['name']):
+                    skipped[i] = skipped[j] = None
+                    changed = True
+                    break
+                if (other['name'] != op['name']
+                        or batches[j]['cmds'] != batches[i]['cmds']):
+                    break
+                skipped[j] = i
+            if changed:
+                break
+    return skipped
+
+
+# Priority classes of batched operations. Batches in lower classes are
+# executed first.
+OP_PRIORITIES = {
+    'plug port': 0,
+    'unplug port': 0,
+    'plug bond': 0,
+    'unplug bond': 0,
+    'add network': 1,
+    'delete network': 1,
+}
+
+# Priority class of batches without a known operation.
+DEFAULT_PRIORITY = 2
+
+
+def _batch_priority(batch):
+    op = batch.get('op')
+    if not op:
+        return DEFAULT_PRIORITY
+    return OP_PRIORITIES.get(op['name'], DEFAULT_PRIORITY)
+
+
+def _batches_conflict(batch, other):
+    op = batch.get('op')
+    other_op = other.get('op')
+    # Batches without an operation may touch anything.
+    if not op or not other_op:
+        return True
+    return bool(_op_resources(op) & _op_resources(other_op))
+
+
+def prioritise_batches(batches, aging=0):
+    """Order batches by priority class.
+
+    Batches in higher priority classes are moved ahead of batches in lower
+    classes, except that a batch is never moved ahead of an earlier batch
+    that uses the same port or VLAN, or of a batch without an operation.
+    Batches in the same class keep their queue order. To prevent
+    starvation, a batch is promoted by one class for every ``aging``
+    batches queued after it.
+
+    :param batches: a list of batch dicts, in queue order.
+    :param aging: number of later batches for which a batch is promoted by
+        one class. 0 disables promotion.
+    :returns: a tuple of the list of batches in execution order, and a list
+        of their effective priority classes.
+    """
+    count = len(batches)
+    priorities = []
+    for i, batch in enumerate(batches):
+        priority = _batch_priority(batch)
+        if aging:
+            priority -= (count - 1 - i) // aging
+        priorities.append(max(priority, 0))
+
+    # Number of earlier batches that each batch must follow, and the later
+    # batches that must follow each batch.
+    blockers = [0] * count
+    followers = [[] for _ in range(count)]
+    for j in range(count):
+        for i in range(j):
+            if _batches_conflict(batches[i], batches[j]):
+                blockers[j] += 1
+                followers[i].append(j)
+
+    ready = [(priorities[i], i) for i in range(count) if not blockers[i]]
+    heapq.heapify(ready)
+    order = []
+    while ready:
+        _, i = heapq.heappop(ready)
+        order.append(i)
+        for j in followers[i]:
+            blockers[j] -= 1
+            if not blockers[j]:
+                heapq.heappush(ready, (priorities[j], j))
+    return [batches[i] for i in order], [priorities[i] for i in order]
+
+
+class DeleteWatch(object):
+    """Watch for the deletion of any of a set of etcd keys.
+
+    Used by workers waiting for the switch lock, to wake up as soon as the
+    lock is released or their batch has been executed by another worker.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.deleted = set()
+        self.started = False
+        self._event = threading.Event()
+        self._watchers = []
+
+    def start(self, keys, start_revision):
+        """Start watching keys.
+
+        :param keys: an iterable of keys to watch.
+        :param start_revision: revision from which to watch the keys.
+            Deletions at or after this revision wake up the waiter, even if
+            they happened before the watch was started.
+        """
+        self.started = True
+        for key in keys:
+            try:
+                watcher = etcd3gw_watch.Watcher(
+                    self.client, key, functools.partial(self._deleted, key),
+                    start_revision=start_revision, filters=['NOPUT'])
+            except Exception:
+                # Waiting falls back to polling.
+                LOG.warning("Failed to watch etcd key %s", key, exc_info=True)
+                continue
+            self._watchers.append(watcher)
+
+    def _deleted(self, key, event):
+        self.deleted.add(key)
+        self._event.set()
+
+    @property
+    def woken(self):
+        """Whether a key was deleted since the last call to reset()."""
+        return self._event.is_set()
+
+    def reset(self):
+        self._event.clear()
+
+    def sleep(self, seconds):
+        """Sleep until a watched key is deleted, or for at most seconds."""
+        self._event.wait(seconds)
+
+    def stop(self):
+        for watcher in self._watchers:
+            try:
+                watcher.stop()
+            except Exception:
+                LOG.debug("Failed to stop etcd watch", exc_info=True)
+        self._watchers = []
+
+
+def get_result_watcher(switch_name, client):
+    """Return the result watcher for a switch, creating it if necessary.
+
+    Result watchers are shared by all queues of a switch in the process.
+
+    :param switch_name: name of the switch.
+    :param client: etcd client used if the watcher is created.
+    :returns: a ResultWatcher object.
+    """
+    with _RESULT_WATCHERS_LOCK:
+        watcher = _RESULT_WATCHERS.get(switch_name)
+        if watcher is None:
+            watcher = ResultWatcher(switch_name, client)
+            _RESULT_WATCHERS[switch_name] = watcher
+        return watcher
+
+
+class ResultWatcher(object):
+    """Watcher for the results of the batches of a switch.
+
+    A single etcd watch on the output prefix of the switch is shared by all
+    callers in the process that are waiting for a result. Results are
+    dispatched to the callers through futures, and consumed result keys are
+    deleted in bulk. The watch is cancelled when no caller is waiting.
+    """
+
+    def __init__(self, switch_name, client):
+        self.switch_name = switch_name
+        self.client = client
+        self.prefix = SwitchQueue.RESULT_PREFIX % switch_name
+        # Futures of waiting callers, by result key.
+        self._waiters = {}
+        self._consumed = []
+        self._lock = threading.Lock()
+        self._cancel = None
+        self._start_revision = None
+        self._deleter = None
+
+    def wait(self, result_key, start_revision, timeout):
+        """Wait for a result to be written.
+
+        :param result_key: the result key to wait for.
+        :param start_revision: revision from which the result may be written.
+        :param timeout: wait timeout in seconds.
+        :returns: the result dict.
+        :raises: GenericSwitchBatchError if waiting times out, or if the
+            result key was deleted.
+        """
+        future = concurrent.futures.Future()
+        with self._lock:
+            self._waiters[result_key] = future
+            if self._cancel is None:
+                self._start(start_revision)
+            # A watch started after our batch was added may have missed the
+            # result.
+            check_now = (self._cancel is None
+                         or self._start_revision > start_revision)
+        try:
+            deadline = time.monotonic() + timeout
+            polled = False
+            while True:
+                if check_now:
+                    result = self._get_result(result_key)
+                    if result is not None:
+                        if polled:
+                            # The watch missed the result, so it may have
+                            # failed. Start a new one for the next caller.
+                            self._stop_watch()
+                        return result
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise exc.GenericSwitchBatchError(
+                        device=self.switch_name,
+                        error="Timed out waiting for result key: %s"
+                        % result_key)
+                try:
+                    return future.result(
+                        timeout=min(remaining, RESULT_POLL_INTERVAL))
+                except concurrent.futures.TimeoutError:
+                    check_now = polled = True
+        finally:
+            with self._lock:
+                self._waiters.pop(result_key, None)
+
+    def _start(self, start_revision):
+        # Called with the lock held.
+        try:
+            events, cancel = self.client.watch_prefix(
+                self.prefix, start_revision=start_revision)
+        except Exception:
+            # Waiting callers fall back to polling.
+            LOG.warning("Failed to watch results of %s", self.switch_name,
+                        exc_info=True)
+            return
+        self._cancel = cancel
+        self._start_revision = start_revision
+        eventlet.spawn(self._dispatch, events, cancel)
+
+    def _stop_watch(self):
+        with self._lock:
+            cancel = self._cancel
+            self._cancel = None
+        if cancel is not None:
+            cancel()
+
+    def _dispatch(self, events, cancel):
+        for event in events:
+            key = event["kv"]["key"]
+            if isinstance(key, bytes):
+                key = key.decode("utf-8")
+            with self._lock:
+                future = self._waiters.pop(key, None)
+            # Results of callers in other processes are ignored.
+            if future is not None:
+                if event.get("type") == "DELETE":
+                    future.set_exception(exc.GenericSwitchBatchError(
+                        device=self.switch_name,
+                        error="Output key was deleted, perhaps lease "
+                              "expired"))
+                else:
+                    LOG.debug("got result event for: %s", key)
+                    future.set_result(decode_value(event["kv"]["value"]))
+                    self._delete(key)
+            with self._lock:
+                if not self._waiters and self._cancel is cancel:
+                    self._cancel = None
+                    cancel()
+
+    def _get_result(self, result_key):
+        values = self.client.get(result_key)
+        if not values:
+            return None
+        self._delete(result_key)
+        return decode_value(values[0])
+
+    def _delete(self, result_key):
+        with self._lock:
+            self._consumed.append(result_key)
+            if self._deleter is None:
+                self._deleter = eventlet.spawn(self._delete_consumed)
+
+    def _delete_consumed(self):
+        # Let other results be consumed, to delete them together.
+        eventlet.sleep(0)
+        while True:
+            with self._lock:
+                keys = self._consumed[:MAX_TXN_OPS]
+                del self._consumed[:MAX_TXN_OPS]
+                if not keys:
+                    self._deleter = None
+                    return
+            txn = {
+                'compare': [],
+                'success': [
+                    {
+                        'request_delete_range': {
+                            'key': etcd3gw_utils._encode(key),
+                        }
+                    }
+                    for key in keys
+                ],
+                'failure': []
+            }
+            try:
+                self.client.transaction(txn)
+            except Exception:
+                # The result keys will expire with their lease.
+                LOG.warning("Failed to delete %d result keys of %s",
+                            len(keys), self.switch_name, exc_info=True)
+            else:
+                LOG.debug("deleted %d result keys", len(keys))
+
+
+class LeaseManager(object):
+    """Shares etcd leases between writes.
+
+    Rather than granting a lease for every write, a lease is used for all
+    writes made within ``rotation_interval`` seconds of it being granted,
+    after which a new lease is granted. Leases are granted with a TTL padded
+    by the rotation interval, so that every key attached to a lease lives for
+    at least ``ttl`` seconds, and at most ``ttl + rotation_interval`` seconds.
+    Leases are never refreshed: a lease that is no longer used expires along
+    with its keys, so the number of live leases is bounded.
+    """
+
+    def __init__(self, client, ttl, rotation_interval=60):
+        self.client = client
+        self.ttl = ttl
+        self.rotation_interval = rotation_interval
+        self._lease_id = None
+        self._granted_at = None
+        self._lock = threading.Lock()
+
+    def get_lease_id(self):
+        """Return the ID of a lease to attach new keys to."""
+        with self._lock:
+            # Measure the age of the lease from before it was granted, to
+            # err on the side of rotating early.
+            now = time.monotonic()
+            if (self._lease_id is None
+                    or now - self._granted_at >= self.rotation_interval):
+                lease = self.client.lease(
+                    ttl=self.ttl + self.rotation_interval)
+                self._lease_id = lease.id
+                self._granted_at = now
+                LOG.debug("granted lease %s", lease.id)
+            return self._lease_id
+
+    def invalidate(self, lease_id):
+        """Stop using a lease, for example because it no longer exists."""
+        with self._lock:
+            if self._lease_id == lease_id:
+                self._lease_id = None
+
+
+def _is_lease_not_found(error):
+    return 'lease not found' in (error.detail_text or '')
+
+
+class LockHeartbeat(object):
+    """Context manager keeping a lock alive in the background."""
+
+    def __init__(self, lock, interval=LOCK_HEARTBEAT_INTERVAL):
+        self.lock = lock
+        self.interval = interval
+        self.lost = False
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = eventlet.spawn(self._run)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._thread.kill()
+
+    def _run(self):
+        while not self.lost:
+            eventlet.sleep(self.interval)
+            self.beat()
+
+    def beat(self):
+        """Refresh the lock, recording whether it has been lost."""
+        try:
+            ttl = self.lock.refresh()
+        except Exception:
+            # Try again at the next interval. Results are only recorded
+            # while the lock is held, so a lost lock is detected anyway.
+            LOG.warning("Failed to refresh lock %s", self.lock.key,
+                        exc_info=True)
+            return
+        if ttl <= 0:
+            LOG.error("Lock %s has expired", self.lock.key)
+            self.lost = True
+
+
+class BatchLinger(object):
+    """Policy for waiting for further batches before taking a switch lock.
+
+    A worker waits for up to the current window for batches to be queued by
+    this process, or until ``max_batches`` batches are queued. The window
+    adapts to the arrival rate of batches: it is doubled, up to
+    ``max_linger``, when further batches arrive while waiting, and is halved,
+    down to an eighth of ``max_linger``, when none do.
+    """
+
+    def __init__(self, max_linger, max_batches=0):
+        self.max_linger = max_linger
+        self.min_linger = max_linger / 8.0
+        self.max_batches = max_batches
+        self.window = max_linger
+        # Number of batches queued since a worker last took the queue.
+        self._queued = 0
+        self._arrivals = 0
+        self._cond = threading.Condition()
+
+    def _full(self):
+        return bool(self.max_batches) and self._queued >= self.max_batches
+
+    def arrived(self):
+        """Record that a batch has been queued."""
+        with self._cond:
+            self._queued += 1
+            self._arrivals += 1
+            if self._full():
+                self._cond.notify_all()
+
+    def taken(self):
+        """Record that a worker has taken the queued batches."""
+        with self._cond:
+            self._queued = 0
+
+    def wait(self):
+        """Wait for further batches to be queued."""
+        with self._cond:
+            arrivals = self._arrivals
+            deadline = time.monotonic() + self.window
+            while not self._full():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            if self._full() or self._arrivals > arrivals:
+                self.window = min(self.max_linger, self.window * 2)
+            else:
+                self.window = max(self.min_linger, self.window / 2)
+
+
+class QueueJanitor(object):
+    """Periodic removal of orphaned keys from the queue of a switch.
+
+    Batches and results are normally removed once consumed, and otherwise
+    expire with their lease. The janitor removes batches that have been
+    queued for longer than callers wait for a result, and results that have
+    not been consumed by their caller, so that they do not have to be read
+    past until they expire. Keys are aged from when the janitor first sees
+    them, so no clock is shared between processes.
+
+    The number of queued batches and results, and the number of keys
+    removed, are available in ``stats``.
+    """
+
+    def __init__(self, queue, interval, input_age=ORPHAN_INPUT_AGE,
+                 result_age=ORPHAN_RESULT_AGE):
+        self.queue = queue
+        self.interval = interval
+        self.input_age = input_age
+        self.result_age = result_age
+        self.stats = {
+            'queue_depth': 0,
+            'results': 0,
+            'orphaned_inputs': 0,
+            'orphaned_results': 0,
+        }
+        # Mod revision and time first seen, by key.
+        self._seen = {}
+        self._thread = None
+
+    def start(self):
+        """Start removing orphaned keys periodically in the background."""
+        if self._thread is None:
+            self._thread = eventlet.spawn(self._run)
+
+    def stop(self):
+        """Stop removing orphaned keys."""
+        if self._thread is not None:
+            self._thread.kill()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            eventlet.sleep(self.interval)
+            try:
+                self.run_once()
+            except Exception:
+                LOG.warning("Failed to clean up batch queue of %s",
+                            self.queue.switch_name, exc_info=True)
+
+    def run_once(self):
+        """Remove orphaned keys, and update the statistics of the queue."""
+        switch_name = self.queue.switch_name
+        now = time.monotonic()
+        inputs = self._list(self.queue.INPUT_PREFIX % switch_name)
+        results = self._list(self.queue.RESULT_PREFIX % switch_name)
+        seen = {}
+        orphaned_inputs = self._find_orphans(inputs, self.input_age, now,
+                                             seen)
+        orphaned_results = self._find_orphans(results, self.result_age, now,
+                                              seen)
+        self._seen = seen
+        self._delete(orphaned_inputs + orphaned_results)
+
+        self.stats['queue_depth'] = len(inputs) - len(orphaned_inputs)
+        self.stats['results'] = len(results) - len(orphaned_results)
+        self.stats['orphaned_inputs'] += len(orphaned_inputs)
+        self.stats['orphaned_results'] += len(orphaned_results)
+        if orphaned_inputs or orphaned_results:
+            LOG.info("Removed %(inputs)d orphaned batches and %(results)d "
+                     "orphaned results of %(switch)s",
+                     {'inputs': len(orphaned_inputs),
+                      'results': len(orphaned_results),
+                      'switch': switch_name})
+        LOG.debug("Batch queue statistics of %s: %s", switch_name,
+                  self.stats)
+
+    def _list(self, prefix):
+        range_end = etcd3gw_utils._encode(
+            etcd3gw_utils._increment_last_byte(prefix))
+        return [(metadata['key'], int(metadata['mod_revision']))
+                for _, metadata in self.queue.client.get(
+                    prefix, metadata=True, range_end=range_end,
+                    keys_only=True)]
+
+    def _find_orphans(self, keys, age, now, seen):
+        orphans = []
+        for key, mod_revision in keys:
+            first_seen = now
+            previous = self._seen.get(key)
+            if previous is not None and previous[0] == mod_revision:
+                first_seen = previous[1]
+            if now - first_seen >= age:
+                orphans.append(key)
+            else:
+                seen[key] = (mod_revision, first_seen)
+        return orphans
+
+    def _delete(self, keys):
+        for start in range(0, len(keys), MAX_TXN_OPS):
+            chunk = keys[start:start + MAX_TXN_OPS]
+            txn = {
+                'compare': [],
+                'success': [
+                    {
+                        'request_delete_range': {
+                            'key': etcd3gw_utils._encode(key),
+                        }
+                    }
+                    for key in chunk
+                ],
+                'failure': []
+            }
+            self.queue.client.transaction(txn)
+        for key in keys:
+            self.queue._batch_cache.pop(key, None)
+
+
 class SwitchQueueItem(object):
     """An item in the queue."""
 
@@ -70,15 +861,24 @@ class SwitchQueueItem(object):
 class SwitchQueue(object):
     INPUT_PREFIX = "/ngs/batch/%s/input/"
     INPUT_ITEM_KEY = "/ngs/batch/%s/input/%s"
+    RESULT_PREFIX = "/ngs/batch/%s/output/"
     RESULT_ITEM_KEY = "/ngs/batch/%s/output/%s"
     EXEC_LOCK = "/ngs/batch/%s/execute_lock"
 
-    def __init__(self, switch_name, etcd_client):
+    def __init__(self, switch_name, etcd_client, compact=False,
+                 output_limit=1024):
         self.switch_name = switch_name
         self.client = etcd_client
+        # Whether to write batches and results in the compact encoding, and
+        # the maximum length of device output retained in compact results.
+        self.compact = compact
+        self.output_limit = output_limit
         self.lease_ttl = 600
+        self.leases = LeaseManager(etcd_client, self.lease_ttl)
+        # Mod revisions and decoded batches, by input key.
+        self._batch_cache = {}
 
-    def add_batch(self, cmds):
+    def add_batch(self, cmds, op=None):
         """Clients add batch, given key events.
 
         Each batch is given an uuid that is used to generate both
@@ -91,6 +891,8 @@ class SwitchQueue(object):
         to the workers, and start waiting for results.
 
         :param cmds: an iterable of commands
+        :param op: Optional dict describing the operation performed by the
+            commands, used to coalesce batches.
         :return: a SwitchQueueItem object
         """
 
@@ -98,18 +900,23 @@ class SwitchQueue(object):
         result_key = self.RESULT_ITEM_KEY % (self.switch_name, uuid)
         input_key = self.INPUT_ITEM_KEY % (self.switch_name, uuid)
 
-        batch = {
-            "uuid": uuid,
-            "input_key": input_key,
-            "result_key": result_key,
-            "cmds": cmds,
-        }
-        value = json.dumps(batch, sort_keys=True).encode("utf-8")
-        lease = self.client.lease(ttl=self.lease_ttl)
+        if self.compact:
+            # The keys are derived from the input key when decoding.
+            batch = {"cmds": cmds}
+        else:
+            batch = {
+                "uuid": uuid,
+                "input_key": input_key,
+                "result_key": result_key,
+                "cmds": cmds,
+            }
+        if op is not None:
+            batch["op"] = op
+        value = encode_value(batch, self.compact)
         # Use a transaction rather than create() in order to extract the
         # create revision.
-        base64_key = _encode(input_key)
-        base64_value = _encode(value)
+        base64_key = etcd3gw_utils._encode(input_key)
+        base64_value = etcd3gw_utils._encode(value)
         txn = {
             'compare': [{
                 'key': base64_key,
@@ -125,8 +932,7 @@ class SwitchQueue(object):
             }],
             'failure': []
         }
-        txn['success'][0]['request_put']['lease'] = lease.id
-        result = self.client.transaction(txn)
+        result = self._transaction_with_lease(txn)
 
         success = result.get('succeeded', False)
         # Be sure to free watcher resources on error
@@ -152,21 +958,8 @@ class SwitchQueue(object):
             unsuccessful
         """
         result_key = self.RESULT_ITEM_KEY % (self.switch_name, item.uuid)
-        try:
-            event = self.client.watch_once(result_key, timeout=timeout,
-                                           start_revision=item.create_revision)
-        except etcd3gw_exc.WatchTimedOut:
-            raise exc.GenericSwitchBatchError(
-                device=self.switch_name,
-                error="Timed out waiting for result key: %s" % result_key)
-
-        LOG.debug("got event: %s", event)
-        if event["kv"]["version"] == 0:
-            raise exc.GenericSwitchBatchError(
-                device=self.switch_name,
-                error="Output key was deleted, perhaps lease expired")
-        # TODO(johngarbutt) check we have the create event and result?
-        result_dict = self._get_and_delete_result(result_key)
+        watcher = get_result_watcher(self.switch_name, self.client)
+        result_dict = watcher.wait(result_key, item.create_revision, timeout)
         LOG.debug("got result: %s", result_dict)
         if "result" in result_dict:
             return result_dict["result"]
@@ -175,112 +968,228 @@ class SwitchQueue(object):
                 device=self.switch_name,
                 error=result_dict["error"])
 
-    def _get_and_delete_result(self, result_key):
-        # called when watch event says the result key should exist
-        txn = {
-            'compare': [],
-            'success': [{
-                'request_delete_range': {
-                    'key': _encode(result_key),
-                    'prev_kv': True,
-                }
-            }],
-            'failure': []
-        }
-        result = self.client.transaction(txn)
-        success = result.get('succeeded', False)
-        if not success:
-            raise exc.GenericSwitchBatchError(
-                device=self.switch_name,
-                error="Unable to find result: %s" % result_key)
-        delete_response = result['responses'][0]['response_delete_range']
-        raw_value = delete_response['prev_kvs'][0]['value']
-        result_dict = json.loads(_decode(raw_value))
-        LOG.debug("fetched and deleted result for: %s", result_key)
-        return result_dict
-
-    def _get_raw_batches(self, max_create_revision=None):
+    def _input_range(self):
         input_prefix = self.INPUT_PREFIX % self.switch_name
+        range_end = etcd3gw_utils._encode(
+            etcd3gw_utils._increment_last_byte(input_prefix))
+        return input_prefix, range_end
+
+    def _get_raw_batches(self, max_create_revision=None, **kwargs):
+        input_prefix, range_end = self._input_range()
         # Sort order ensures FIFO style queue
         # Use get rather than get_prefix since get accepts max_create_revision.
-        range_end = _encode(_increment_last_byte(input_prefix))
         raw_batches = self.client.get(input_prefix,
                                       metadata=True,
                                       range_end=range_end,
                                       sort_order="ascend",
                                       sort_target="create",
-                                      max_create_revision=max_create_revision)
+                                      max_create_revision=max_create_revision,
+                                      **kwargs)
         return raw_batches
 
+    def _count_batches(self, max_create_revision=None):
+        """Return the number of batches in the queue, without reading them.
+
+        :param max_create_revision: Optional revision. If provided, only
+            batches added up to and including this revision are counted.
+        """
+        input_prefix, range_end = self._input_range()
+        payload = {
+            'key': etcd3gw_utils._encode(input_prefix),
+            'range_end': range_end,
+            'count_only': True,
+        }
+        if max_create_revision is not None:
+            payload['max_create_revision'] = max_create_revision
+        # The client's get() discards the count of a count only request.
+        result = self.client.post(self.client.get_url('/kv/range'),
+                                  json=payload)
+        return int(result.get('count', 0))
+
+    def has_batches(self, item=None):
+        """Return whether the queue contains any batches.
+
+        :param item: Optional SwitchQueueItem object. If provided, only batches
+            added up to and including this item are considered.
+        """
+        max_create_revision = item.create_revision if item else None
+        return self._count_batches(max_create_revision) > 0
+
     def get_batches(self, item=None):
         """Return a list of the event dicts written in wait for result.
 
-        This is called both with or without getting a lock to get the
-        latest list of work that has send to the per switch queue in
-        etcd.
+        This is called with the lock held, to get the latest list of work
+        that has been sent to the per switch queue in etcd.
+
+        The keys of the queue are read first. Values are then only read for
+        keys that are not in the cache of decoded batches, starting at the
+        lowest mod revision of those keys.
 
         :param item: Optional SwitchQueueItem object. If provided, only batches
             added up to and including this item are returned.
         """
         max_create_revision = item.create_revision if item else None
-        raw_batches = self._get_raw_batches(max_create_revision)
-        LOG.debug("found %s batches", len(raw_batches))
+        keys = [(metadata['key'], int(metadata['mod_revision']))
+                for _, metadata in self._get_raw_batches(max_create_revision,
+                                                         keys_only=True)]
+        LOG.debug("found %s batches", len(keys))
+
+        cache = self._batch_cache
+        if max_create_revision is None:
+            # Forget batches that have left the queue.
+            current = {key for key, _ in keys}
+            for key in list(cache):
+                if key not in current:
+                    cache.pop(key, None)
+
+        missing = [mod_revision for key, mod_revision in keys
+                   if cache.get(key, (None,))[0] != mod_revision]
+        fetched = {}
+        if missing:
+            raw_batches = self._get_raw_batches(
+                max_create_revision, min_mod_revision=min(missing))
+            LOG.debug("read %s batches", len(raw_batches))
+            for raw_value, metadata in raw_batches:
+                entry = (int(metadata['mod_revision']),
+                         self._decode_batch(metadata['key'], raw_value))
+                fetched[metadata['key']] = cache[metadata['key']] = entry
 
         batches = []
-        for raw_value, metadata in raw_batches:
-            batch = json.loads(raw_value.decode('utf-8'))
-            batches.append(batch)
+        for key, mod_revision in keys:
+            entry = fetched.get(key) or cache.get(key)
+            if entry is None or entry[0] != mod_revision:
+                # The batch was removed or replaced since the keys were read.
+                continue
+            # Callers add results to the batches, so return copies.
+            batches.append(dict(entry[1]))
         return batches
 
-    def record_result(self, batch):
-        """Record the result from executing given command set.
+    def _decode_batch(self, input_key, raw_value):
+        batch = decode_value(raw_value)
+        if raw_value[:1] == COMPACT_FORMAT_V1:
+            # Compact batches do not include their keys.
+            input_key = input_key.decode('utf-8')
+            uuid = input_key.rsplit('/', 1)[-1]
+            batch["uuid"] = uuid
+            batch["input_key"] = input_key
+            batch["result_key"] = self.RESULT_ITEM_KEY % (self.switch_name,
+                                                          uuid)
+        return batch
+
+    def _encode_result(self, batch):
+        if not self.compact:
+            return encode_value(batch)
+        # Store only the outcome, and a prefix of the device output.
+        if "error" in batch:
+            result = {"error": batch["error"]}
+        else:
+            result = {"result": (batch["result"] or "")[:self.output_limit]}
+        return encode_value(result, compact=True)
+
+    def record_results(self, batches, lock):
+        """Record the results from executing given command sets.
 
         We assume that a lock is held before getting a fresh list
         of batches, executing them, and then calling this record
         results function, before finally dropping the lock.
+
+        Results are written and input keys deleted in as few transactions as
+        possible, each of which only succeeds if the lock is still held.
+
+        :param batches: a list of batch dicts with a result or an error.
+        :param lock: the switch lock held by the worker.
+        :raises: GenericSwitchBatchError if the lock is no longer held.
         """
-        # Write results and delete input keys so the next worker to hold the
-        # lock knows not to execute these batches
-        lease = self.client.lease(ttl=self.lease_ttl)
-        result_value = json.dumps(batch, sort_keys=True).encode('utf-8')
-        txn = {
-            'compare': [],
-            'success': [
-                {
+        lock_compare = {
+            'key': etcd3gw_utils._encode(lock.key),
+            'result': 'EQUAL',
+            'target': 'VALUE',
+            'value': etcd3gw_utils._encode(lock.uuid),
+        }
+        # Each batch requires two operations.
+        per_txn = MAX_TXN_OPS // 2
+        for start in range(0, len(batches), per_txn):
+            chunk = batches[start:start + per_txn]
+            # Write results and delete input keys so the next worker to hold
+            # the lock knows not to execute these batches
+            success = []
+            for batch in chunk:
+                result_value = self._encode_result(batch)
+                success.append({
                     'request_put': {
-                        'key': _encode(batch['result_key']),
-                        'value': _encode(result_value),
-                        'lease': lease.id,
+                        'key': etcd3gw_utils._encode(batch['result_key']),
+                        'value': etcd3gw_utils._encode(result_value),
                     }
-                },
-                {
+                })
+                success.append({
                     'request_delete_range': {
-                        'key': _encode(batch['input_key']),
+                        'key': etcd3gw_utils._encode(batch['input_key']),
                     }
-                }
-            ],
-            'failure': []
-        }
-        result = self.client.transaction(txn)
-        success = result.get('succeeded', False)
-        if not success:
-            LOG.error("failed to report batch result for: %s",
-                      batch)
-        else:
-            LOG.debug("written result key: %s", batch['result_key'])
+                })
+            txn = {
+                'compare': [lock_compare],
+                'success': success,
+                'failure': []
+            }
+            result = self._transaction_with_lease(txn)
+            if not result.get('succeeded', False):
+                raise exc.GenericSwitchBatchError(
+                    device=self.switch_name,
+                    error="Worker aborting - lock timed out")
+            LOG.debug("written %d result keys", len(chunk))
+            for batch in chunk:
+                self._batch_cache.pop(batch['input_key'].encode('utf-8'),
+                                      None)
+
+    def _transaction_with_lease(self, txn):
+        """Run a transaction, attaching a shared lease to each put.
+
+        If the lease no longer exists, for example because it was revoked,
+        the transaction is retried once with a new lease.
+        """
+        lease_id = self.leases.get_lease_id()
+        try:
+            return self.client.transaction(self._with_lease(txn, lease_id))
+        except etcd3gw_exc.Etcd3Exception as e:
+            if not _is_lease_not_found(e):
+                raise
+        LOG.info("Lease %s not found, granting a new lease", lease_id)
+        self.leases.invalidate(lease_id)
+        lease_id = self.leases.get_lease_id()
+        return self.client.transaction(self._with_lease(txn, lease_id))
+
+    @staticmethod
+    def _with_lease(txn, lease_id):
+        for request in txn['success']:
+            if 'request_put' in request:
+                request['request_put']['lease'] = lease_id
+        return txn
 
     def acquire_worker_lock(self, item, acquire_timeout=300, lock_ttl=120,
                             wait=None):
-        """Wait for lock needed to call record_result.
+        """Wait for lock needed to call record_results.
 
         This blocks until the work queue is empty of the switch lock is
         acquired. If we timeout waiting for the lock we raise an exception.
+
+        Rather than polling, a waiting worker watches the lock key and the
+        input key of its batch, and tries again as soon as either is deleted.
+
+        :param item: a SwitchQueueItem object.
+        :param acquire_timeout: time in seconds to wait for the lock.
+        :param lock_ttl: TTL of the lock in seconds.
+        :param wait: Optional tenacity wait strategy, giving the maximum time
+            to wait for a watched key to be deleted before polling again.
+        :returns: the acquired lock, or None if there is no work left.
         """
         lock_name = self.EXEC_LOCK % self.switch_name
         lock = self.client.lock(lock_name, lock_ttl)
+        input_key = self.INPUT_ITEM_KEY % (self.switch_name, item.uuid)
 
         if wait is None:
-            wait = tenacity.wait_random(min=1, max=3)
+            wait = tenacity.wait_random(min=5, max=10)
+
+        watch = DeleteWatch(self.client)
 
         @tenacity.retry(
             # Log a message after each failed attempt.
@@ -289,50 +1198,374 @@ class SwitchQueue(object):
             retry=tenacity.retry_if_result(lambda x: x is False),
             # Stop after timeout.
             stop=tenacity.stop_after_delay(acquire_timeout),
-            # Wait between lock retries
+            # Wait between lock retries, waking up early on a watch event.
             wait=wait,
+            sleep=watch.sleep,
         )
         def _acquire_lock_with_retry():
+            # Our batch was executed by another worker.
+            if input_key in watch.deleted:
+                return None
+
+            woken = watch.woken
+            watch.reset()
             lock_acquired = lock.acquire()
             if lock_acquired:
                 return lock
 
-            # Stop waiting for the lock if there is nothing to do
-            work = self._get_raw_batches(item.create_revision)
-            if not work:
-                return None
+            if not watch.started:
+                # Watch from the creation of our batch, so that no release of
+                # the lock after our failed attempt is missed.
+                watch.start([lock.key, input_key], item.create_revision)
+
+            # Stop waiting for the lock if there is nothing to do. There is
+            # no need to check after a watch event on the lock key.
+            if not woken:
+                if not self._count_batches(item.create_revision):
+                    return None
 
             # Trigger a retry
             return False
 
-        return _acquire_lock_with_retry()
+        try:
+            return _acquire_lock_with_retry()
+        finally:
+            watch.stop()
+
+    def acquire_lock(self, acquire_timeout=300, lock_ttl=120, wait=None):
+        """Wait for the switch lock, whether or not batches are queued.
+
+        Used to serialise other work on the switch, such as a deferred save
+        of its configuration, with the execution of batches.
+
+        :param acquire_timeout: time in seconds to wait for the lock.
+        :param lock_ttl: TTL of the lock in seconds.
+        :param wait: Optional tenacity wait strategy between attempts.
+        :returns: the acquired lock.
+        :raises: GenericSwitchBatchError if waiting times out.
+        """
+        lock = self.client.lock(self.EXEC_LOCK % self.switch_name, lock_ttl)
+
+        if wait is None:
+            wait = tenacity.wait_random(min=1, max=5)
+
+        @tenacity.retry(
+            # Log a message after each failed attempt.
+            after=tenacity.after_log(LOG, logging.DEBUG),
+            # Retry if we haven't got the lock yet
+            retry=tenacity.retry_if_result(lambda x: x is False),
+            # Stop after timeout.
+            stop=tenacity.stop_after_delay(acquire_timeout),
+            wait=wait,
+        )
+        def _acquire_lock_with_retry():
+            return lock.acquire()
+
+        try:
+            _acquire_lock_with_retry()
+        except tenacity.RetryError:
+            raise exc.GenericSwitchBatchError(
+                device=self.switch_name,
+                error="Timed out waiting for lock")
+        return lock
+
+
+def get_memory_queue(switch_name):
+    """Return the in-memory queue for a switch, creating it if necessary.
+
+    :param switch_name: name of the switch.
+    :returns: a MemorySwitchQueue object.
+    """
+    with _MEMORY_QUEUES_LOCK:
+        queue = _MEMORY_QUEUES.get(switch_name)
+        if queue is None:
+            queue = MemorySwitchQueue(switch_name)
+            _MEMORY_QUEUES[switch_name] = queue
+        return queue
+
+
+class MemoryLock(object):
+    """Worker lock of a MemorySwitchQueue.
+
+    Provides the subset of the etcd3gw Lock interface used by SwitchBatch.
+    The lock does not expire while it is held.
+    """
+
+    def __init__(self, queue, ttl):
+        self._queue = queue
+        self.key = queue.EXEC_LOCK % queue.switch_name
+        self.uuid = uuidutils.generate_uuid()
+        self.ttl = ttl
+
+    def acquire(self):
+        with self._queue._cond:
+            if self._queue._lock_owner is None:
+                self._queue._lock_owner = self.uuid
+            return self.is_acquired()
+
+    def is_acquired(self):
+        return self._queue._lock_owner == self.uuid
+
+    def release(self):
+        with self._queue._cond:
+            if not self.is_acquired():
+                return False
+            self._queue._lock_owner = None
+            self._queue._cond.notify_all()
+            return True
+
+    def refresh(self):
+        return self.ttl if self.is_acquired() else -1
+
+
+class MemorySwitchQueue(object):
+    """Queue of the batches of a switch, held in the memory of the process.
+
+    This has the same interface as SwitchQueue, but does not require etcd.
+    Batches are only serialised within a single process, so this queue must
+    only be used when a single process configures each switch.
+    """
+
+    EXEC_LOCK = SwitchQueue.EXEC_LOCK
+
+    def __init__(self, switch_name):
+        self.switch_name = switch_name
+        # Pending batches and their revisions, by uuid, in the order added.
+        self._batches = collections.OrderedDict()
+        # Futures of the results of pending batches, by uuid.
+        self._futures = {}
+        self._revision = 0
+        self._lock_owner = None
+        self._cond = threading.Condition()
+
+    def add_batch(self, cmds, op=None):
+        """Add a batch to the queue.
+
+        :param cmds: an iterable of commands
+        :param op: Optional dict describing the operation performed by the
+            commands, used to coalesce batches.
+        :return: a SwitchQueueItem object
+        """
+        uuid = uuidutils.generate_uuid()
+        batch = {"uuid": uuid, "cmds": cmds}
+        if op is not None:
+            batch["op"] = op
+        with self._cond:
+            self._revision += 1
+            self._batches[uuid] = (self._revision, batch)
+            self._futures[uuid] = concurrent.futures.Future()
+            return SwitchQueueItem(uuid, self._revision)
+
+    def wait_for_result(self, item, timeout):
+        """Wait for the result of a command batch.
+
+        :param item: SwitchQueueItem object returned by add_batch
+        :param timeout: wait timeout in seconds
+        :return: output string generated by this command set
+        :raises: GenericSwitchBatchError if waiting times out or the command
+            batch was unsuccessful
+        """
+        future = self._futures[item.uuid]
+        try:
+            result_dict = future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            raise exc.GenericSwitchBatchError(
+                device=self.switch_name,
+                error="Timed out waiting for result of batch: %s"
+                % item.uuid)
+        finally:
+            with self._cond:
+                self._futures.pop(item.uuid, None)
+        LOG.debug("got result: %s", result_dict)
+        if "result" in result_dict:
+            return result_dict["result"]
+        else:
+            raise exc.GenericSwitchBatchError(
+                device=self.switch_name,
+                error=result_dict["error"])
+
+    def get_batches(self, item=None):
+        """Return a list of the pending batch dicts, in the order added.
+
+        :param item: Optional SwitchQueueItem object. If provided, only batches
+            added up to and including this item are returned.
+        """
+        with self._cond:
+            return [dict(batch)
+                    for revision, batch in self._batches.values()
+                    if item is None or revision <= item.create_revision]
+
+    def has_batches(self, item=None):
+        """Return whether the queue contains any batches.
+
+        :param item: Optional SwitchQueueItem object. If provided, only batches
+            added up to and including this item are considered.
+        """
+        with self._cond:
+            return any(item is None or revision <= item.create_revision
+                       for revision, _ in self._batches.values())
+
+    def record_results(self, batches, lock):
+        """Record the results from executing given command sets.
+
+        :param batches: a list of batch dicts with a result or an error.
+        :param lock: the switch lock held by the worker.
+        :raises: GenericSwitchBatchError if the lock is no longer held.
+        """
+        with self._cond:
+            if not lock.is_acquired():
+                raise exc.GenericSwitchBatchError(
+                    device=self.switch_name,
+                    error="Worker aborting - lock timed out")
+            for batch in batches:
+                self._batches.pop(batch["uuid"], None)
+                future = self._futures.get(batch["uuid"])
+                if future is not None and not future.done():
+                    future.set_result(batch)
+            # Wake up workers whose batches have been executed.
+            self._cond.notify_all()
+
+    def acquire_worker_lock(self, item, acquire_timeout=300, lock_ttl=120,
+                            wait=None):
+        """Wait for lock needed to call record_results.
+
+        This blocks until the batch of the item has been executed or the
+        switch lock is acquired.
+
+        :param item: a SwitchQueueItem object.
+        :param acquire_timeout: time in seconds to wait for the lock.
+        :param lock_ttl: TTL reported by the lock while it is held.
+        :param wait: ignored, for compatibility with SwitchQueue.
+        :returns: the acquired lock, or None if there is no work left.
+        :raises: GenericSwitchBatchError if waiting times out.
+        """
+        lock = MemoryLock(self, lock_ttl)
+        deadline = time.monotonic() + acquire_timeout
+        with self._cond:
+            while True:
+                # Our batch was executed by another worker.
+                if item.uuid not in self._batches:
+                    return None
+                if lock.acquire():
+                    return lock
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise exc.GenericSwitchBatchError(
+                        device=self.switch_name,
+                        error="Timed out waiting for lock")
+                self._cond.wait(remaining)
+
+    def acquire_lock(self, acquire_timeout=300, lock_ttl=120, wait=None):
+        """Wait for the switch lock, whether or not batches are queued.
+
+        :param acquire_timeout: time in seconds to wait for the lock.
+        :param lock_ttl: TTL reported by the lock while it is held.
+        :param wait: ignored, for compatibility with SwitchQueue.
+        :returns: the acquired lock.
+        :raises: GenericSwitchBatchError if waiting times out.
+        """
+        lock = MemoryLock(self, lock_ttl)
+        deadline = time.monotonic() + acquire_timeout
+        with self._cond:
+            while not lock.acquire():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise exc.GenericSwitchBatchError(
+                        device=self.switch_name,
+                        error="Timed out waiting for lock")
+                self._cond.wait(remaining)
+        return lock
+
+
+class SwitchExecutor(object):
+    """Drain loop executing the batches of a switch.
+
+    Rather than each request spawning a worker, requests wake a single loop
+    per switch in the process. The loop runs while requests are submitted,
+    executing every batch up to the latest request each time, and exits once
+    there is nothing left to execute. Loops run in a bounded pool.
+    """
+
+    def __init__(self, batch):
+        self._batch = batch
+        self._lock = threading.Lock()
+        # Device and queue item of the latest request not yet executed.
+        self._work = None
+        self._running = False
+
+    def submit(self, device, item):
+        """Request execution of the batches up to and including an item.
+
+        :param device: a NetmikoSwitch device object
+        :param item: a SwitchQueueItem object
+        """
+        with self._lock:
+            if (self._work is None or int(item.create_revision)
+                    > int(self._work[1].create_revision)):
+                self._work = (device, item)
+            if self._running:
+                return
+            self._running = True
+        _get_executor_pool().spawn_n(self._run)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._work is None:
+                    self._running = False
+                    return
+            if self._batch.linger is not None:
+                # Give other requests a chance to join this batch.
+                self._batch.linger.wait()
+            with self._lock:
+                device, item = self._work
+                self._work = None
+            try:
+                self._batch._execute_pending_batches(device, item)
+            except Exception:
+                LOG.exception("Failed to execute batches for %s",
+                              self._batch.switch_name)
 
 
 class SwitchBatch(object):
-    def __init__(self, switch_name, etcd_url=None, switch_queue=None):
+    def __init__(self, switch_name, etcd_url=None, switch_queue=None,
+                 coalesce=False, single_session=False, publish_each=False,
+                 backend='etcd', linger=0, linger_batches=0,
+                 executor=False, max_backlog=0, compact=False,
+                 output_limit=1024, priority=False, priority_aging=0,
+                 janitor_interval=0):
         if switch_queue is None:
-            parsed_url = netutils.urlsplit(etcd_url)
-            host = parsed_url.hostname
-            port = parsed_url.port
-            protocol = 'https' if parsed_url.scheme.endswith(
-                'https') else 'http'
-            # Use the same parameter format as tooz etcd3gw driver.
-            params = parsed_url.params()
-            ca_cert = params.get('ca_cert')
-            cert_key = params.get('cert_key')
-            cert_cert = params.get('cert_cert')
-            api_version = params.get('api_version', 'v3alpha')
-            etcd_client = etcd3gw.client(
-                host=host, port=port, protocol=protocol,
-                ca_cert=ca_cert, cert_key=cert_key, cert_cert=cert_cert,
-                api_path='/' + api_version + '/',
-                timeout=30)
-            self.queue = SwitchQueue(switch_name, etcd_client)
-        else:
-            self.queue = switch_queue
+            if backend == 'memory':
+                switch_queue = get_memory_queue(switch_name)
+            else:
+                switch_queue = SwitchQueue(switch_name,
+                                           get_etcd_client(etcd_url),
+                                           compact=compact,
+                                           output_limit=output_limit)
+        self.queue = switch_queue
         self.switch_name = switch_name
-
-    def do_batch(self, device, cmd_set, timeout=300):
+        self.coalesce = coalesce
+        self.single_session = single_session
+        self.publish_each = publish_each
+        self.linger = None
+        if linger > 0:
+            self.linger = BatchLinger(linger, linger_batches)
+        self.executor = SwitchExecutor(self) if executor else None
+        self.max_backlog = max_backlog
+        # Results may only include part of the device output, so check the
+        # output for errors before recording the results.
+        self.check_output = compact
+        self.priority = priority
+        self.priority_aging = priority_aging
+        self.janitor = None
+        if janitor_interval and isinstance(self.queue, SwitchQueue):
+            self.janitor = QueueJanitor(self.queue, janitor_interval)
+            self.janitor.start()
+        # Number of requests in this process waiting for a result.
+        self._backlog = 0
+        self._backlog_lock = threading.Lock()
+
+    def do_batch(self, device, cmd_set, timeout=300, op=None):
         """Batch up switch configuration commands to reduce overheads.
 
         We collect together the iterables in the cmd_set, and
@@ -340,15 +1573,41 @@ class SwitchBatch(object):
 
         :param device: a NetmikoSwitch device object
         :param cmd_set: an iterable of commands
+        :param op: Optional dict describing the operation performed by the
+            commands, used to coalesce batches.
         :return: output string generated by this command set
+        :raises: GenericSwitchBatchError if the backlog of the switch is full
         """
+        with self._backlog_lock:
+            if self.max_backlog and self._backlog >= self.max_backlog:
+                raise exc.GenericSwitchBatchError(
+                    device=self.switch_name,
+                    error="Too many pending requests: %d" % self._backlog)
+            self._backlog += 1
+        try:
+            return self._do_batch(device, cmd_set, timeout, op)
+        finally:
+            with self._backlog_lock:
+                self._backlog -= 1
 
+    def _do_batch(self, device, cmd_set, timeout, op):
         # request that the cmd_set by executed
         cmd_list = list(cmd_set)
-        item = self.queue.add_batch(cmd_list)
+        item = self.queue.add_batch(cmd_list, op=op)
+        if self.linger is not None:
+            self.linger.arrived()
+
+        if self.executor is not None:
+            self.executor.submit(device, item)
+            output = self.queue.wait_for_result(item, timeout)
+            LOG.debug("Got batch result: %s", output)
+            return output
 
         def do_work():
             try:
+                if self.linger is not None:
+                    # Give other requests a chance to join this batch.
+                    self.linger.wait()
                 self._execute_pending_batches(device, item)
             except Exception as e:
                 LOG.error("failed to run execute batch: %s", e,
@@ -371,7 +1630,23 @@ class SwitchBatch(object):
         eventlet.sleep(0)
         # Run all pending tasks, which might be a no op
         # if pending tasks already ran
-        THREAD_POOL.spawn_n(work_fn)
+        _get_thread_pool().spawn_n(work_fn)
+
+    def save_configuration(self, device):
+        """Save the configuration of a switch under the switch lock.
+
+        This serialises a deferred save with the execution of batches by
+        workers in this and other processes.
+
+        :param device: a NetmikoSwitch device object
+        """
+        lock = self.queue.acquire_lock()
+        try:
+            with LockHeartbeat(lock):
+                with device._get_connection() as net_connect:
+                    device.save_configuration(net_connect)
+        finally:
+            lock.release()
 
     def _execute_pending_batches(self, device, item):
         """Execute all batches currently registered.
@@ -382,12 +1657,11 @@ class SwitchBatch(object):
         :param device: a NetmikoSwitch device object
         :param item: a SwitchQueueItem object
         """
-        batches = self.queue.get_batches(item)
-        if not batches:
+        if not self.queue.has_batches(item):
             LOG.debug("Skipped execution for %s", self.switch_name)
             return
-        LOG.debug("Found %d batches - trying to acquire lock for %s",
-                  len(batches), self.switch_name)
+        LOG.debug("Found batches - trying to acquire lock for %s",
+                  self.switch_name)
 
         # Many workers can end up piling up here trying to acquire the
         # lock. Only consider batches at least as old as the one that triggered
@@ -411,6 +1685,8 @@ class SwitchBatch(object):
             # Fetch fresh list now we have the lock
             # and order the list so we execute in order added
             batches = self.queue.get_batches()
+            if self.linger is not None:
+                self.linger.taken()
             if not batches:
                 LOG.debug("No batches to execute %s", self.switch_name)
                 return
@@ -423,30 +1699,147 @@ class SwitchBatch(object):
         LOG.debug("end of lock for %s", self.switch_name)
 
     def _send_commands(self, device, batches, lock):
-        with device._get_connection() as net_connect:
+        lanes = None
+        if self.priority:
+            batches, lanes = prioritise_batches(batches, self.priority_aging)
+        skipped = coalesce_batches(batches) if self.coalesce else {}
+        if skipped:
+            LOG.debug("Skipping %d of %d batches for %s", len(skipped),
+                      len(batches), self.switch_name)
+        if len(skipped) == len(batches):
+            # Nothing to send, so avoid connecting to the switch.
             for batch in batches:
-                try:
-                    output = device.send_config_set(net_connect, batch['cmds'])
-                    batch["result"] = output
-                except Exception as e:
-                    batch["error"] = str(e)
+                batch["result"] = ""
+            self.queue.record_results(batches, lock)
+            return
 
-                # The switch configuration can take a long time, and may exceed
-                # the lock TTL. Periodically refresh our lease, and verify that
-                # we still own the lock before recording the results.
-                lock.refresh()
-                if not lock.is_acquired():
-                    raise exc.GenericSwitchBatchError(
-                        device=self.switch_name,
-                        error="Worker aborting - lock timed out")
+        # The switch configuration can take a long time, and may exceed the
+        # lock TTL, so refresh the lock in the background.
+        with LockHeartbeat(lock) as heartbeat:
+            # NOTE: A pooled connection may have been closed by the switch
+            # since it was last used, so if a reused connection is lost,
+            # retry the batches not yet executed once with a new connection.
+            reconnects = 1
+            start = 0
+            while True:
+                try:
+                    self._send_on_connection(device, batches, skipped, lock,
+                                             heartbeat, lanes, start)
+                    return
+                except connection_pool.StaleConnection as e:
+                    error = e
+                except (paramiko.SSHException, EOFError) as e:
+                    error = e
+                    reconnects = 0
+                start = self._first_unexecuted(batches)
+                if start is None:
+                    # The connection was lost while saving.
+                    return
+                if not reconnects:
+                    break
+                reconnects -= 1
+                LOG.warning("Lost persistent connection to %s, reconnecting",
+                            self.switch_name)
+
+            LOG.error("Lost connection to %s: %s", self.switch_name, error)
+
+            def connection_lost(cmds):
+                raise exc.GenericSwitchBatchError(
+                    device=self.switch_name,
+                    error="Lost connection: %s" % error)
+
+            self._send_batches(device, batches, skipped, connection_lost,
+                               lock, heartbeat, lanes, start)
 
-                # Tell request watchers the result and
-                # tell workers which batches have now been executed
-                self.queue.record_result(batch)
+    @staticmethod
+    def _first_unexecuted(batches):
+        """Return the index of the first batch without a result or None."""
+        for i, batch in enumerate(batches):
+            if "result" not in batch and "error" not in batch:
+                return i
+        return None
+
+    def _send_on_connection(self, device, batches, skipped, lock, heartbeat,
+                            lanes, start):
+        """Send batches from index start on a single connection.
+
+        :raises: StaleConnection, paramiko.SSHException or EOFError if the
+            connection is lost. Batches executed until then have their
+            results recorded.
+        """
+        with device._get_connection() as net_connect:
+            if self.single_session:
+                # Enter configuration mode once for all batches.
+                session = device.config_session(net_connect)
+            else:
+                session = contextlib.nullcontext(
+                    functools.partial(device.send_config_set, net_connect))
+            with session as send_config_set:
+                self._send_batches(device, batches, skipped, send_config_set,
+                                   lock, heartbeat, lanes, start)
 
             if device._get_save_configuration():
+                if device.save_scheduler is not None:
+                    device.save_scheduler.schedule()
+                    return
                 try:
                     device.save_configuration(net_connect)
+                except (paramiko.SSHException, EOFError):
+                    # Do not return a lost connection to the pool.
+                    LOG.exception("Failed to save configuration")
+                    raise
                 except Exception:
                     LOG.exception("Failed to save configuration")
                     # Probably not worth failing all batches for this.
+
+    def _send_batches(self, device, batches, skipped, send_config_set,
+                      lock, heartbeat, lanes=None, start=0):
+        executed = []
+        for i in range(start, len(batches)):
+            batch = batches[i]
+            if i in skipped:
+                # Sources of duplicates precede them, so already have a
+                # result.
+                source = skipped[i]
+                if source is None:
+                    # Cancelled out, so nothing was done.
+                    batch["result"] = ""
+                elif "error" in batches[source]:
+                    batch["error"] = batches[source]["error"]
+                else:
+                    batch["result"] = batches[source]["result"]
+            else:
+                try:
+                    output = send_config_set(batch['cmds'])
+                    if self.check_output and batch.get("op"):
+                        device.check_output(output, batch["op"]["name"])
+                    batch["result"] = output
+                except (paramiko.SSHException, EOFError):
+                    # The connection was lost. Publish the results so far,
+                    # and leave the remaining batches to the caller.
+                    if executed:
+                        self.queue.record_results(executed, lock)
+                    raise
+                except Exception as e:
+                    batch["error"] = str(e)
+
+            # Stop configuring the switch if another worker may hold the
+            # lock.
+            if heartbeat.lost:
+                raise exc.GenericSwitchBatchError(
+                    device=self.switch_name,
+                    error="Worker aborting - lock timed out")
+
+            executed.append(batch)
+            # Publish the results of each priority class as soon as it has
+            # been executed.
+            lane_done = (lanes is not None and i + 1 < len(batches)
+                         and lanes[i + 1] != lanes[i])
+            if self.publish_each or lane_done:
+                # Tell request watchers the result and
+                # tell workers which batches have now been executed
+                self.queue.record_results(executed, lock)
+                executed = []
+
+        if executed:
+            self.queue.record_results(executed, lock)
@@ -0,0 +1,150 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import contextlib
+import threading
+import time
+
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+_BREAKERS = {}
+_BREAKERS_LOCK = threading.Lock()
+
+
+class CircuitOpen(Exception):
+    """Exception raised when a call is rejected by an open circuit."""
+
+
+def get_circuit_breaker(name, threshold, reset_timeout):
+    """Return the circuit breaker for a switch, creating it if necessary.
+
+    Circuit breakers are shared by all callers in the process.
+
+    :param name: name of the switch.
+    :param threshold: number of consecutive failures after which the circuit
+        is opened.
+    :param reset_timeout: time in seconds after which an open circuit allows
+        a trial call.
+    :returns: a CircuitBreaker object.
+    """
+    with _BREAKERS_LOCK:
+        breaker = _BREAKERS.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(name, threshold, reset_timeout)
+            _BREAKERS[name] = breaker
+        return breaker
+
+
+class CircuitBreaker(object):
+    """Circuit breaker for connections to a single switch.
+
+    The circuit starts closed, allowing all calls. After ``threshold``
+    consecutive failed calls it opens, and calls are rejected immediately.
+    Once ``reset_timeout`` seconds have passed the circuit becomes half-open,
+    and a single trial call is allowed. If the trial succeeds the circuit is
+    closed, otherwise it is opened again.
+
+    """
+
+    def __init__(self, name, threshold, reset_timeout):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self._opened_at = None
+        self._trial_in_progress = False
+        self._lock = threading.Lock()
+
+    def check(self):
+        """Check whether a call may proceed, without starting a trial.
+
+        :raises: CircuitOpen if the circuit is open and the reset timeout has
+            not yet passed.
+        """
+        with self._lock:
+            if self.state == OPEN and not self._reset_timeout_passed():
+                raise self._open_error()
+
+    @contextlib.contextmanager
+    def attempt(self):
+        """Context manager wrapping a call protected by the circuit breaker.
+
+        The outcome of the call is recorded: an exception raised from the
+        block counts as a failure.
+
+        :raises: CircuitOpen if the call is not allowed.
+        """
+        with self._lock:
+            if self.state == OPEN:
+                if not self._reset_timeout_passed():
+                    raise self._open_error()
+                LOG.info("Circuit breaker for %s is half-open, allowing a "
+                         "trial connection", self.name)
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN:
+                if self._trial_in_progress:
+                    raise self._open_error()
+                self._trial_in_progress = True
+                trial = True
+            else:
+                trial = False
+
+        try:
+            yield
+        except Exception:
+            self._record_failure(trial)
+            raise
+        except BaseException:
+            # Not an outcome of the call - e.g. a greenthread being killed.
+            if trial:
+                with self._lock:
+                    self._trial_in_progress = False
+            raise
+        self._record_success(trial)
+
+    def _record_success(self, trial):
+        with self._lock:
+            if self.state != CLOSED:
+                LOG.info("Circuit breaker for %s is closed", self.name)
+            self.state = CLOSED
+            self.failures = 0
+            self._opened_at = None
+            if trial:
+                self._trial_in_progress = False
+
+    def _record_failure(self, trial):
+        with self._lock:
+            self.failures += 1
+            if trial:
+                self._trial_in_progress = False
+            if self.state == HALF_OPEN or self.failures >= self.threshold:
+                if self.state != OPEN:
+                    LOG.warning("Circuit breaker for %s is open after %d "
+                                "consecutive failures", self.name,
+                                self.failures)
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+
+    def _reset_timeout_passed(self):
+        return time.monotonic() - self._opened_at >= self.reset_timeout
+
+    def _open_error(self):
+        return CircuitOpen("Circuit breaker for %s is %s after %d consecutive "
+                           "failures" % (self.name, self.state,
+                                         self.failures))
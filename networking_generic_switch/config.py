@@ -26,12 +26,49 @@ coordination_opts = [
                default=60,
                help='Timeout in seconds after which an attempt to grab a lock '
                     'is failed. Value of 0 is forever.'),
+    cfg.StrOpt('batch_backend',
+               default='etcd',
+               choices=[('etcd', 'Queue batched requests in etcd, using the '
+                                 'backend_url option.'),
+                        ('memory', 'Queue batched requests in the memory of '
+                                   'each process. Only suitable when a '
+                                   'single process configures the switches.')],
+               help='Backend used to queue requests for switches with '
+                    'ngs_batch_requests enabled.'),
+    cfg.IntOpt('batch_janitor_interval',
+               min=0,
+               default=0,
+               help='Interval in seconds at which each process removes '
+                    'orphaned batches and results from the etcd queues of '
+                    'switches with ngs_batch_requests enabled. '
+                    'Value of 0 disables removal, in which case orphaned '
+                    'keys expire after about 10 minutes.'),
 ]
 
 ngs_opts = [
     cfg.StrOpt('session_log_file',
                default=None,
-               help='Netmiko session log file.')
+               help='Netmiko session log file.'),
+    cfg.IntOpt('switch_concurrency',
+               min=1,
+               default=1,
+               help='Maximum number of switches to configure concurrently '
+                    'when creating or deleting a network, or when binding or '
+                    'unbinding a port with links to several switches. The '
+                    'default of 1 configures switches one at a time.'),
+    cfg.StrOpt('device_loading',
+               default='eager',
+               choices=[('eager', 'Load all switch devices when the '
+                                  'mechanism driver is initialised.'),
+                        ('lazy', 'Load each switch device when it is '
+                                 'first used.'),
+                        ('background', 'Load switch devices in the '
+                                       'background after the mechanism '
+                                       'driver is initialised, or on first '
+                                       'use if that is sooner.')],
+               help='When to load switch devices. Switch options are '
+                    'validated when the mechanism driver is initialised '
+                    'regardless of this option.'),
 ]
 
 CONF.register_opts(coordination_opts, group='ngs_coordination')
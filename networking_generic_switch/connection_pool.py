@@ -0,0 +1,168 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import atexit
+import collections
+import contextlib
+import threading
+import time
+import weakref
+
+import eventlet
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+_POOLS = weakref.WeakSet()
+
+
+@atexit.register
+def _close_all_pools():
+    """Close idle connections of all pools at exit."""
+    for pool in list(_POOLS):
+        pool.close()
+
+
+class StaleConnection(Exception):
+    """A connection reused from the pool was lost while in use."""
+
+
+class ConnectionPool(object):
+    """Pool of long-lived connections to a single switch.
+
+    Connections are created on demand using the provided factory, and
+    returned to the pool after use rather than being closed. At most
+    ``max_size`` idle connections are kept. Idle connections are closed once
+    they have not been used for ``idle_timeout`` seconds, and are checked for
+    liveness before being handed out again.
+
+    The switch may close an idle connection without the liveness check
+    noticing. Exceptions in ``lost_errors`` raised while using a reused
+    connection are therefore reraised as StaleConnection, allowing the caller
+    to retry with a new connection.
+
+    """
+
+    def __init__(self, create_connection, max_size=1, idle_timeout=60,
+                 name=None, lost_errors=()):
+        self._create_connection = create_connection
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.name = name
+        self.lost_errors = lost_errors
+        # Idle connections as (connection, last used time) tuples, with the
+        # most recently used on the right.
+        self._idle = collections.deque()
+        self._lock = threading.Lock()
+        self._reaper = None
+        _POOLS.add(self)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Context manager providing a pooled connection.
+
+        The connection is returned to the pool on success. If the caller
+        raises an exception the connection may be in an unknown state, so it
+        is closed rather than reused.
+        """
+        net_connect, reused = self._acquire()
+        try:
+            yield net_connect
+        except BaseException as e:
+            self.discard(net_connect)
+            if reused and isinstance(e, self.lost_errors):
+                raise StaleConnection(str(e)) from e
+            raise
+        self.release(net_connect)
+
+    def acquire(self):
+        """Return a live connection, creating one if none are idle."""
+        return self._acquire()[0]
+
+    def _acquire(self):
+        """Return a live connection, and whether it was reused."""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                net_connect, last_used = self._idle.pop()
+            if time.monotonic() - last_used > self.idle_timeout:
+                self._close(net_connect)
+                continue
+            if self._is_alive(net_connect):
+                LOG.debug("Reusing pooled connection to %s", self.name)
+                return net_connect, True
+            LOG.debug("Pooled connection to %s is no longer alive",
+                      self.name)
+            self._close(net_connect)
+
+        LOG.debug("Creating new pooled connection to %s", self.name)
+        return self._create_connection(), False
+
+    def release(self, net_connect):
+        """Return a connection to the pool."""
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append((net_connect, time.monotonic()))
+                net_connect = None
+                if self._reaper is None:
+                    self._reaper = eventlet.spawn(self._reap_idle)
+        if net_connect is not None:
+            # The pool is full.
+            self._close(net_connect)
+
+    def discard(self, net_connect):
+        """Close a connection without returning it to the pool."""
+        self._close(net_connect)
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle = [net_connect for net_connect, _ in self._idle]
+            self._idle.clear()
+        for net_connect in idle:
+            self._close(net_connect)
+
+    def evict_idle(self):
+        """Close connections that have been idle for too long."""
+        expired = []
+        now = time.monotonic()
+        with self._lock:
+            # The oldest connections are on the left.
+            while (self._idle
+                   and now - self._idle[0][1] > self.idle_timeout):
+                expired.append(self._idle.popleft()[0])
+        for net_connect in expired:
+            self._close(net_connect)
+
+    def _reap_idle(self):
+        while True:
+            eventlet.sleep(self.idle_timeout)
+            self.evict_idle()
+            with self._lock:
+                if not self._idle:
+                    self._reaper = None
+                    return
+
+    @staticmethod
+    def _is_alive(net_connect):
+        try:
+            return net_connect.is_alive()
+        except Exception:
+            return False
+
+    def _close(self, net_connect):
+        try:
+            net_connect.disconnect()
+        except Exception:
+            LOG.debug("Failed to close connection to %s", self.name,
+                      exc_info=True)
@@ -13,46 +13,162 @@
 #    under the License.
 
 import abc
+import types
 
 from neutron_lib.utils.helpers import parse_mappings
 from oslo_log import log as logging
 from oslo_utils import strutils
 import stevedore
 
+from networking_generic_switch._i18n import _
 from networking_generic_switch import exceptions as gsw_exc
 
 GENERIC_SWITCH_NAMESPACE = 'generic_switch.devices'
 LOG = logging.getLogger(__name__)
 
 # Internal ngs options will not be passed to driver.
+# The optional 'type' of an option determines how its value is parsed into
+# the device's settings: 'bool', 'int', 'list' (comma-separated) or
+# 'mappings' (comma-separated "<key>:<value>" entries). Other options are
+# kept as strings.
 NGS_INTERNAL_OPTS = [
     {'name': 'ngs_mac_address'},
     # Comma-separated list of names of interfaces to be added to each network.
-    {'name': 'ngs_trunk_ports'},
+    {'name': 'ngs_trunk_ports', 'type': 'list'},
     {'name': 'ngs_port_default_vlan'},
     # Comma-separated list of physical networks to which this switch is mapped.
-    {'name': 'ngs_physical_networks'},
+    {'name': 'ngs_physical_networks', 'type': 'list'},
     # Comma-separated list of entries formatted as "<type>:<algorithm>",
     # specifying SSH algorithms to disable.
-    {'name': 'ngs_ssh_disabled_algorithms'},
-    {'name': 'ngs_ssh_connect_timeout', 'default': 60},
-    {'name': 'ngs_ssh_connect_interval', 'default': 10},
-    {'name': 'ngs_max_connections', 'default': 1},
+    {'name': 'ngs_ssh_disabled_algorithms', 'type': 'mappings'},
+    {'name': 'ngs_ssh_connect_timeout', 'default': 60, 'type': 'int'},
+    {'name': 'ngs_ssh_connect_interval', 'default': 10, 'type': 'int'},
+    {'name': 'ngs_max_connections', 'default': 1, 'type': 'int'},
     {'name': 'ngs_switchport_mode', 'default': 'access'},
     # If True, disable switch ports that are not in use.
-    {'name': 'ngs_disable_inactive_ports', 'default': False},
+    {'name': 'ngs_disable_inactive_ports', 'default': False, 'type': 'bool'},
     # String format for network name to configure on switches.
     # Accepts {network_id} and {segmentation_id} formatting options.
     {'name': 'ngs_network_name_format', 'default': '{network_id}'},
     # If false, ngs will not add and delete VLANs from switches
-    {'name': 'ngs_manage_vlans', 'default': True},
+    {'name': 'ngs_manage_vlans', 'default': True, 'type': 'bool'},
     # If False, ngs will skip saving configuration on devices
-    {'name': 'ngs_save_configuration', 'default': True},
+    {'name': 'ngs_save_configuration', 'default': True, 'type': 'bool'},
+    # Time (seconds) to wait for further configuration changes before saving
+    # the configuration. 0 saves the configuration after every change.
+    {'name': 'ngs_save_delay', 'default': 0, 'type': 'int'},
+    # Maximum time (seconds) for which saving the configuration may be
+    # delayed by further configuration changes.
+    {'name': 'ngs_save_max_wait', 'default': 60, 'type': 'int'},
     # When true try to batch up in flight switch requests
-    {'name': 'ngs_batch_requests', 'default': False},
+    {'name': 'ngs_batch_requests', 'default': False, 'type': 'bool'},
+    # When true, skip batched operations that are cancelled out or repeated
+    # by other batches waiting in the same queue.
+    {'name': 'ngs_batch_coalesce', 'default': False, 'type': 'bool'},
+    # When true, send all pending batches in a single configuration session.
+    {'name': 'ngs_batch_single_session', 'default': False, 'type': 'bool'},
+    # When true, publish the result of each batch as soon as it has been
+    # executed, rather than publishing the results of all batches together.
+    {'name': 'ngs_batch_publish_each', 'default': False, 'type': 'bool'},
+    # Maximum time (milliseconds) for which a batch worker waits for further
+    # batches to be queued before taking the switch lock. 0 disables waiting.
+    {'name': 'ngs_batch_linger_ms', 'default': 0, 'type': 'int'},
+    # Number of queued batches at which a batch worker stops waiting for
+    # further batches. 0 means no limit.
+    {'name': 'ngs_batch_linger_batches', 'default': 0, 'type': 'int'},
+    # When true, execute batches using a single drain loop per switch in each
+    # process, rather than a worker per request.
+    {'name': 'ngs_batch_executor', 'default': False, 'type': 'bool'},
+    # Maximum number of batched requests to the switch that may be pending
+    # in each process. Further requests are rejected. 0 means no limit.
+    {'name': 'ngs_batch_max_backlog', 'default': 0, 'type': 'int'},
+    # When true, store batches and results in etcd in a compressed encoding,
+    # and only keep part of the device output in results.
+    {'name': 'ngs_batch_compact', 'default': False, 'type': 'bool'},
+    # Maximum number of characters of device output kept in compact results.
+    {'name': 'ngs_batch_output_limit', 'default': 1024, 'type': 'int'},
+    # When true, execute batches binding and unbinding ports before batches
+    # creating and deleting VLANs, and those before other batches.
+    {'name': 'ngs_batch_priority', 'default': False, 'type': 'bool'},
+    # Number of later batches for which a batch is promoted by one priority
+    # class, to prevent starvation. 0 disables promotion.
+    {'name': 'ngs_batch_priority_aging', 'default': 16, 'type': 'int'},
+    # If True, keep SSH connections open and reuse them between requests.
+    {'name': 'ngs_persistent_connections', 'default': False, 'type': 'bool'},
+    # Time (seconds) after which unused persistent connections are closed.
+    {'name': 'ngs_connection_idle_timeout', 'default': 60, 'type': 'int'},
+    # Number of consecutive connection failures after which requests to the
+    # switch fail immediately. 0 disables the circuit breaker.
+    {'name': 'ngs_circuit_breaker_threshold', 'default': 0, 'type': 'int'},
+    # Time (seconds) after which a trial connection is allowed to a switch
+    # whose circuit breaker is open.
+    {'name': 'ngs_circuit_breaker_reset_timeout', 'default': 60,
+     'type': 'int'},
 ]
 
 
+def _parse_list(value):
+    return tuple(item.strip() for item in value.split(','))
+
+
+def _parse_mappings(value):
+    mappings = parse_mappings(value.split(','), unique_keys=False,
+                              unique_values=False)
+    return types.MappingProxyType(
+        {key: tuple(values) for key, values in mappings.items()})
+
+
+_OPT_PARSERS = {
+    'bool': lambda value: strutils.bool_from_string(value, strict=True),
+    'int': int,
+    'list': _parse_list,
+    'mappings': _parse_mappings,
+}
+
+_EMPTY_VALUES = {
+    'list': (),
+    'mappings': types.MappingProxyType({}),
+}
+
+
+class DeviceSettings(object):
+    """Parsed, read-only values of the NGS internal options of a device.
+
+    Attributes are named after the options, without the ``ngs_`` prefix.
+    Options which are not set have a value of None, or an empty tuple or
+    mapping for list and mapping options.
+    """
+
+    __slots__ = tuple(opt['name'][len('ngs_'):] for opt in NGS_INTERNAL_OPTS)
+
+    def __init__(self, ngs_config):
+        """Parse and validate the NGS internal options of a device.
+
+        :param ngs_config: a dict of NGS internal options of a device.
+        :raises: GenericSwitchConfigValueInvalid if an option has an invalid
+            value.
+        """
+        for opt in NGS_INTERNAL_OPTS:
+            opt_name = opt['name']
+            opt_type = opt.get('type')
+            value = ngs_config.get(opt_name)
+            if value is None or value == '':
+                value = _EMPTY_VALUES.get(opt_type)
+            elif opt_type in _OPT_PARSERS:
+                try:
+                    value = _OPT_PARSERS[opt_type](value)
+                except (TypeError, ValueError) as e:
+                    raise gsw_exc.GenericSwitchConfigValueInvalid(
+                        option=opt_name, value=value, error=e)
+            object.__setattr__(self, opt_name[len('ngs_'):], value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(_("Device settings are read-only"))
+
+    def __delattr__(self, name):
+        raise AttributeError(_("Device settings are read-only"))
+
+
 def device_manager(device_cfg):
     device_type = device_cfg.get('device_type', '')
     try:
@@ -92,6 +208,7 @@ class GenericSwitchDevice(object, metaclass=abc.ABCMeta):
             elif 'default' in opt:
                 self.ngs_config[opt_name] = opt['default']
         self.config = device_cfg
+        self.settings = DeviceSettings(self.ngs_config)
 
         self._validate_network_name_format()
 
@@ -107,32 +224,24 @@ class GenericSwitchDevice(object, metaclass=abc.ABCMeta):
                 name_format=network_name_format)
 
     def _get_trunk_ports(self):
-        """Return a list of trunk ports on this switch."""
-        trunk_ports = self.ngs_config.get('ngs_trunk_ports')
-        if not trunk_ports:
-            return []
-        return [port.strip() for port in trunk_ports.split(',')]
+        """Return a tuple of trunk ports on this switch."""
+        return self.settings.trunk_ports
 
     def _get_port_default_vlan(self):
         """Return a default vlan of switch's interface if you specify."""
-        return self.ngs_config.get('ngs_port_default_vlan', None)
+        return self.settings.port_default_vlan
 
     def _get_physical_networks(self):
-        """Return a list of physical networks mapped to this switch."""
-        physnets = self.ngs_config.get('ngs_physical_networks')
-        if not physnets:
-            return []
-        return [net.strip() for net in physnets.split(',')]
+        """Return a tuple of physical networks mapped to this switch."""
+        return self.settings.physical_networks
 
     def _disable_inactive_ports(self):
         """Return whether inactive ports should be disabled."""
-        return strutils.bool_from_string(
-            self.ngs_config['ngs_disable_inactive_ports'])
+        return self.settings.disable_inactive_ports
 
     def _get_save_configuration(self):
         """Return whether configuration should be saved on device."""
-        return strutils.bool_from_string(
-            self.ngs_config['ngs_save_configuration'])
+        return self.settings.save_configuration
 
     def _get_network_name(self, network_id, segmentation_id):
         """Return a network name to configure on switches.
@@ -141,7 +250,7 @@ class GenericSwitchDevice(object, metaclass=abc.ABCMeta):
         :param segmentation_id: segmentation ID of the network.
         :returns: a formatted network name.
         """
-        network_name_format = self.ngs_config['ngs_network_name_format']
+        network_name_format = self.settings.network_name_format
         return network_name_format.format(network_id=network_id,
                                           segmentation_id=segmentation_id)
 
@@ -150,21 +259,21 @@ class GenericSwitchDevice(object, metaclass=abc.ABCMeta):
 
         The dict is in a suitable format for feeding to Netmiko/Paramiko.
         """
-        algorithms = self.ngs_config.get('ngs_ssh_disabled_algorithms')
-        if not algorithms:
-            return {}
         # Builds a dict: keys are types, values are list of algorithms
-        return parse_mappings(algorithms.split(','), unique_keys=False,
-                              unique_values=False)
+        return {algo_type: list(algos) for algo_type, algos
+                in self.settings.ssh_disabled_algorithms.items()}
 
     def _do_vlan_management(self):
         """Check if drivers should add and remove VLANs from switches."""
-        return strutils.bool_from_string(self.ngs_config['ngs_manage_vlans'])
+        return self.settings.manage_vlans
 
     def _batch_requests(self):
         """Return whether to batch up requests to the switch."""
-        return strutils.bool_from_string(
-            self.ngs_config['ngs_batch_requests'])
+        return self.settings.batch_requests
+
+    def _persistent_connections(self):
+        """Return whether to keep connections to the switch open."""
+        return self.settings.persistent_connections
 
     @abc.abstractmethod
     def add_network(self, segmentation_id, network_id):
@@ -0,0 +1,110 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import re
+import string
+import threading
+
+from networking_generic_switch._i18n import _
+from networking_generic_switch import exceptions as exc
+
+_FIELD_NAME_RE = re.compile(r'[.\[]')
+
+_TEMPLATES = {}
+_TEMPLATES_LOCK = threading.Lock()
+
+
+class CommandTemplate(object):
+    """A sequence of command format strings, parsed once.
+
+    Commands are in str.format() syntax. Commands without placeholders are
+    rendered at compile time.
+    """
+
+    __slots__ = ('commands', 'fields', '_parts')
+
+    def __init__(self, commands):
+        """Parse a sequence of command format strings.
+
+        :param commands: a sequence of command format strings.
+        :raises: ValueError if a command is not a valid format string.
+        """
+        self.commands = tuple(commands)
+        fields = set()
+        parts = []
+        for cmd in self.commands:
+            cmd_fields = {_FIELD_NAME_RE.split(field_name, 1)[0]
+                          for _, field_name, _, _
+                          in string.Formatter().parse(cmd)
+                          if field_name is not None}
+            if '' in cmd_fields or any(f.isdigit() for f in cmd_fields):
+                raise ValueError(_("Positional placeholders are not "
+                                   "supported in command %r") % cmd)
+            fields |= cmd_fields
+            # A command without placeholders renders to a constant string,
+            # with any escaped braces unescaped.
+            parts.append((cmd, True) if cmd_fields else (cmd.format(), False))
+        self.fields = frozenset(fields)
+        self._parts = tuple(parts)
+
+    def render(self, kwargs):
+        """Render the commands.
+
+        :param kwargs: a dict of values for the placeholders.
+        :returns: a list of rendered commands.
+        :raises: GenericSwitchNetmikoMethodError if a placeholder value is
+            missing or empty, or cannot be formatted.
+        """
+        if not all(kwargs.values()) or not self.fields <= kwargs.keys():
+            raise exc.GenericSwitchNetmikoMethodError(cmds=self.commands,
+                                                      args=kwargs)
+        try:
+            return [cmd.format_map(kwargs) if has_fields else cmd
+                    for cmd, has_fields in self._parts]
+        except (AttributeError, IndexError, KeyError, TypeError):
+            raise exc.GenericSwitchNetmikoMethodError(cmds=self.commands,
+                                                      args=kwargs)
+
+    def validate(self, allowed_fields, name):
+        """Check that the commands only use allowed placeholders.
+
+        :param allowed_fields: a collection of allowed placeholder names.
+        :param name: name of the command sequence, for error reporting.
+        :raises: GenericSwitchCommandTemplateInvalid if an unknown placeholder
+            is used.
+        """
+        unknown = self.fields.difference(allowed_fields)
+        if unknown:
+            raise exc.GenericSwitchCommandTemplateInvalid(
+                name=name,
+                error="unknown placeholders %s, allowed placeholders are %s"
+                % (sorted(unknown), sorted(allowed_fields)))
+
+
+def get_template(commands):
+    """Return the compiled template for a sequence of commands.
+
+    Templates are cached, so that each distinct sequence of commands is
+    parsed only once per process.
+
+    :param commands: a tuple or list of command format strings.
+    :returns: a CommandTemplate object.
+    """
+    key = commands if isinstance(commands, tuple) else tuple(commands)
+    template = _TEMPLATES.get(key)
+    if template is None:
+        with _TEMPLATES_LOCK:
+            template = _TEMPLATES.get(key)
+            if template is None:
+                template = CommandTemplate(key)
+                _TEMPLATES[key] = template
+    return template
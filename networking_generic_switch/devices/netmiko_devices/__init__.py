@@ -12,36 +12,70 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import atexit
 import contextlib
 import functools
+import inspect
+import threading
 import uuid
 
-import netmiko
 from oslo_config import cfg
 from oslo_log import log as logging
-import paramiko
-import tenacity
-from tooz import coordination
 
+from networking_generic_switch import _lazy_import
 from networking_generic_switch import batching
+from networking_generic_switch import circuit_breaker
+from networking_generic_switch import connection_pool
 from networking_generic_switch import devices
+from networking_generic_switch.devices import command_templates
 from networking_generic_switch.devices import utils as device_utils
 from networking_generic_switch import exceptions as exc
 from networking_generic_switch import locking as ngs_lock
+from networking_generic_switch import save_scheduler
+
+# NOTE: these are imported on first use, as they are relatively slow to
+# import.
+netmiko = _lazy_import.lazy_import('netmiko')
+paramiko = _lazy_import.lazy_import('paramiko')
+tenacity = _lazy_import.lazy_import('tenacity')
 
 LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
 
+# The operation being performed by the current (green) thread, used to
+# describe batched requests.
+_current_op = threading.local()
+
+
+def _describe_op(operation, arguments):
+    """Describe an operation for batching.
+
+    :param operation: name of the operation.
+    :param arguments: a dict of the arguments of the operation's method.
+    :returns: a dict with the name of the operation, the VLAN it applies to
+        and, for port and bond operations, the port, and for network
+        operations, the network.
+    """
+    op = {'name': operation, 'vlan': arguments.get('segmentation_id')}
+    port = arguments.get('port', arguments.get('bond'))
+    if port is not None:
+        op['port'] = port
+    network_id = arguments.get('network_id')
+    if network_id is not None:
+        # Networks may be identified with or without dashes.
+        op['network_id'] = str(network_id).replace('-', '').lower()
+    return op
+
 
 def check_output(operation):
     """Returns a decorator that checks the output of an operation.
 
     :param operation: Operation being attempted. One of 'add network',
-        'delete network', 'plug port', 'unplug port'.
+        'delete network', 'plug port', 'unplug port', 'plug bond',
+        'unplug bond'.
     """
     def decorator(func):
         """The real decorator."""
+        signature = inspect.signature(func)
 
         @functools.wraps(func)
         def wrapper(self, *args, **kwargs):
@@ -51,7 +85,13 @@ def check_output(operation):
             :raises: GenericSwitchNetmikoConfigError if the driver detects that
                 an error has occurred.
             """
-            output = func(self, *args, **kwargs)
+            arguments = signature.bind(self, *args, **kwargs).arguments
+            outer_op = getattr(_current_op, 'op', None)
+            _current_op.op = _describe_op(operation, arguments)
+            try:
+                output = func(self, *args, **kwargs)
+            finally:
+                _current_op.op = outer_op
             self.check_output(output, operation)
             return output
 
@@ -90,6 +130,13 @@ class NetmikoSwitch(devices.GenericSwitchDevice):
 
     SAVE_CONFIGURATION = None
 
+    SAVE_COMMITS_CONFIG = False
+    """Whether saving the configuration is what applies it.
+
+    Drivers that stage changes and only commit them when saving cannot defer
+    the save, so ``ngs_save_delay`` is rejected for them.
+    """
+
     ERROR_MSG_PATTERNS = ()
     """Sequence of error message patterns.
 
@@ -97,6 +144,40 @@ class NetmikoSwitch(devices.GenericSwitchDevice):
     device output that indicate a failure to apply configuration.
     """
 
+    COMMAND_FIELDS = {
+        'ADD_NETWORK': ('segmentation_id', 'network_id', 'network_name'),
+        'DELETE_NETWORK': ('segmentation_id', 'network_id', 'network_name'),
+        'PLUG_PORT_TO_NETWORK': ('port', 'segmentation_id'),
+        'DELETE_PORT': ('port', 'segmentation_id'),
+        'PLUG_BOND_TO_NETWORK': ('bond', 'segmentation_id'),
+        'UNPLUG_BOND_FROM_NETWORK': ('bond', 'segmentation_id'),
+        'ADD_NETWORK_TO_TRUNK': ('port', 'segmentation_id'),
+        'REMOVE_NETWORK_FROM_TRUNK': ('port', 'segmentation_id'),
+        'ENABLE_PORT': ('port',),
+        'DISABLE_PORT': ('port',),
+        'ENABLE_BOND': ('bond',),
+        'DISABLE_BOND': ('bond',),
+    }
+    """Mapping of command sequence attributes to their allowed placeholders.
+
+    The command sequences of each driver class are compiled and checked
+    against this mapping when the class is defined.
+    """
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name, allowed_fields in cls.COMMAND_FIELDS.items():
+            commands = getattr(cls, name, None)
+            if not commands:
+                continue
+            try:
+                template = command_templates.get_template(commands)
+            except ValueError as e:
+                raise exc.GenericSwitchCommandTemplateInvalid(
+                    name='%s.%s' % (cls.__name__, name), error=e)
+            template.validate(allowed_fields,
+                              '%s.%s' % (cls.__name__, name))
+
     def __init__(self, device_cfg):
         super(NetmikoSwitch, self).__init__(device_cfg)
         if self.NETMIKO_DEVICE_TYPE:
@@ -120,7 +201,7 @@ class NetmikoSwitch(devices.GenericSwitchDevice):
             self.config['session_log_file_mode'] = 'append'
 
         self.lock_kwargs = {
-            'locks_pool_size': int(self.ngs_config['ngs_max_connections']),
+            'locks_pool_size': self.settings.max_connections,
             'locks_prefix': self.config.get(
                 'host', '') or self.config.get('ip', ''),
             'timeout': CONF.ngs_coordination.acquire_timeout}
@@ -128,7 +209,9 @@ class NetmikoSwitch(devices.GenericSwitchDevice):
         self.locker = None
         self.batch_cmds = None
         if self._batch_requests():
-            if not CONF.ngs_coordination.backend_url:
+            batch_backend = CONF.ngs_coordination.batch_backend
+            if (batch_backend == 'etcd'
+                    and not CONF.ngs_coordination.backend_url):
                 raise exc.GenericSwitchNetmikoConfigError(
                     config=device_utils.sanitise_config(self.config),
                     error="ngs_batch_requests is true but [ngs_coordination] "
@@ -137,30 +220,73 @@ class NetmikoSwitch(devices.GenericSwitchDevice):
             self.locker = None
             switch_name = self.lock_kwargs['locks_prefix']
             self.batch_cmds = batching.SwitchBatch(
-                switch_name, CONF.ngs_coordination.backend_url)
+                switch_name, CONF.ngs_coordination.backend_url,
+                coalesce=self.settings.batch_coalesce,
+                single_session=self.settings.batch_single_session,
+                publish_each=self.settings.batch_publish_each,
+                linger=self.settings.batch_linger_ms / 1000.0,
+                linger_batches=self.settings.batch_linger_batches,
+                executor=self.settings.batch_executor,
+                max_backlog=self.settings.batch_max_backlog,
+                compact=self.settings.batch_compact,
+                output_limit=self.settings.batch_output_limit,
+                priority=self.settings.batch_priority,
+                priority_aging=self.settings.batch_priority_aging,
+                janitor_interval=CONF.ngs_coordination.batch_janitor_interval,
+                backend=batch_backend)
         elif CONF.ngs_coordination.backend_url:
-            self.locker = coordination.get_coordinator(
+            self.locker = ngs_lock.get_coordinator(
                 CONF.ngs_coordination.backend_url,
                 ('ngs-' + device_utils.get_hostname()).encode('ascii'))
-            self.locker.start()
-            atexit.register(self.locker.stop)
+
+        self.connection_pool = None
+        if self._persistent_connections():
+            self.connection_pool = connection_pool.ConnectionPool(
+                self._create_connection,
+                max_size=self.settings.max_connections,
+                idle_timeout=self.settings.connection_idle_timeout,
+                name=self.lock_kwargs['locks_prefix'],
+                lost_errors=(paramiko.SSHException, EOFError))
+
+        self.circuit_breaker = None
+        threshold = self.settings.circuit_breaker_threshold
+        if threshold > 0:
+            self.circuit_breaker = circuit_breaker.get_circuit_breaker(
+                self.lock_kwargs['locks_prefix'], threshold,
+                self.settings.circuit_breaker_reset_timeout)
+
+        self.save_scheduler = None
+        if (self._get_save_configuration()
+                and self.settings.save_delay > 0):
+            if self._save_commits_config():
+                raise exc.GenericSwitchConfigValueInvalid(
+                    option='ngs_save_delay',
+                    value=self.settings.save_delay,
+                    error='Saving the configuration of this device type '
+                          'commits it, so it cannot be delayed.')
+            self.save_scheduler = save_scheduler.SaveScheduler(
+                self._save_configuration_now,
+                delay=self.settings.save_delay,
+                max_wait=self.settings.save_max_wait,
+                name=self.lock_kwargs['locks_prefix'])
+
+    def _save_commits_config(self):
+        """Whether save_configuration() is needed to apply changes.
+
+        Drivers overriding save_configuration() are assumed to do more than
+        persist the running configuration.
+        """
+        return (self.SAVE_COMMITS_CONFIG
+                or type(self).save_configuration
+                is not NetmikoSwitch.save_configuration)
 
     def _format_commands(self, commands, **kwargs):
         if not commands:
             return []
-        if not all(kwargs.values()):
-            raise exc.GenericSwitchNetmikoMethodError(cmds=commands,
-                                                      args=kwargs)
-        try:
-            cmd_set = [cmd.format(**kwargs) for cmd in commands]
-        except (KeyError, TypeError):
-            raise exc.GenericSwitchNetmikoMethodError(cmds=commands,
-                                                      args=kwargs)
-        return cmd_set
+        return command_templates.get_template(commands).render(kwargs)
 
-    @contextlib.contextmanager
-    def _get_connection(self):
-        """Context manager providing a netmiko SSH connection object.
+    def _create_connection(self):
+        """Create a netmiko SSH connection object.
 
         This function hides the complexities of gracefully handling retrying
         failed connection attempts.
@@ -177,17 +303,27 @@ class NetmikoSwitch(devices.GenericSwitchDevice):
             retry=tenacity.retry_if_exception_type(retry_exc_types),
             # Stop after the configured timeout.
             stop=tenacity.stop_after_delay(
-                int(self.ngs_config['ngs_ssh_connect_timeout'])),
+                self.settings.ssh_connect_timeout),
             # Wait for the configured interval between attempts.
             wait=tenacity.wait_fixed(
-                int(self.ngs_config['ngs_ssh_connect_interval'])),
+                self.settings.ssh_connect_interval),
         )
         def _create_connection():
             return netmiko.ConnectHandler(**self.config)
 
-        # First, create a connection.
+        if self.circuit_breaker is not None:
+            attempt = self.circuit_breaker.attempt()
+        else:
+            attempt = contextlib.nullcontext()
+
         try:
-            net_connect = _create_connection()
+            with attempt:
+                return _create_connection()
+        except circuit_breaker.CircuitOpen as e:
+            LOG.warning("Not connecting to %s: %s",
+                        self.lock_kwargs['locks_prefix'], e)
+            raise exc.GenericSwitchNetmikoConnectError(
+                config=device_utils.sanitise_config(self.config), error=e)
         except tenacity.RetryError as e:
             LOG.error("Reached maximum SSH connection attempts, not retrying")
             raise exc.GenericSwitchNetmikoConnectError(
@@ -197,6 +333,22 @@ class NetmikoSwitch(devices.GenericSwitchDevice):
             raise exc.GenericSwitchNetmikoConnectError(
                 config=device_utils.sanitise_config(self.config), error=e)
 
+    @contextlib.contextmanager
+    def _get_connection(self):
+        """Context manager providing a netmiko SSH connection object.
+
+        If persistent connections are enabled, the connection is taken from
+        and returned to the connection pool of this switch. Otherwise a new
+        connection is created and closed after use.
+        """
+        if self.connection_pool is not None:
+            with self.connection_pool.connection() as net_connect:
+                yield net_connect
+            return
+
+        # First, create a connection.
+        net_connect = self._create_connection()
+
         # Now yield the connection to the caller.
         with net_connect:
             yield net_connect
@@ -206,20 +358,48 @@ class NetmikoSwitch(devices.GenericSwitchDevice):
             LOG.debug("Nothing to execute")
             return
 
+        # Fail fast rather than waiting for a lock or a batch worker if the
+        # switch is known to be unreachable.
+        self._check_circuit_breaker()
+
         # If configured, batch up requests to the switch
         if self.batch_cmds is not None:
-            return self.batch_cmds.do_batch(self, cmd_set)
+            return self.batch_cmds.do_batch(
+                self, cmd_set, op=getattr(_current_op, 'op', None))
         return self._send_commands_to_device(cmd_set)
 
+    def _check_circuit_breaker(self):
+        """Check whether requests to the switch may proceed.
+
+        :raises: GenericSwitchNetmikoConnectError if the circuit breaker for
+            the switch is open.
+        """
+        if self.circuit_breaker is None:
+            return
+        try:
+            self.circuit_breaker.check()
+        except circuit_breaker.CircuitOpen as e:
+            raise exc.GenericSwitchNetmikoConnectError(
+                config=device_utils.sanitise_config(self.config), error=e)
+
     def _send_commands_to_device(self, cmd_set):
+        # NOTE: A pooled connection may have been closed by the switch since
+        # it was last used, so retry once with a new connection if a reused
+        # connection is lost. A new connection that fails is not retried.
+        reconnects = 1
         try:
             with ngs_lock.PoolLock(self.locker, **self.lock_kwargs):
-                with self._get_connection() as net_connect:
-                    output = self.send_config_set(net_connect, cmd_set)
-                    if self._get_save_configuration():
-                        # Save configuration only if enabled in settings
-                        # and when configuration is applied successfully.
-                        self.save_configuration(net_connect)
+                while True:
+                    try:
+                        output = self._configure_device(cmd_set)
+                        break
+                    except connection_pool.StaleConnection:
+                        if not reconnects:
+                            raise
+                        reconnects -= 1
+                        LOG.warning("Lost persistent connection to %s, "
+                                    "reconnecting",
+                                    self.lock_kwargs['locks_prefix'])
         except exc.GenericSwitchException:
             # Reraise without modification exceptions originating from this
             # module.
@@ -231,6 +411,29 @@ class NetmikoSwitch(devices.GenericSwitchDevice):
         LOG.debug(output)
         return output
 
+    def _configure_device(self, cmd_set):
+        with self._get_connection() as net_connect:
+            output = self.send_config_set(net_connect, cmd_set)
+            if self._get_save_configuration():
+                # Save configuration only if enabled in settings
+                # and when configuration is applied successfully.
+                if self.save_scheduler is not None:
+                    self.save_scheduler.schedule()
+                else:
+                    self.save_configuration(net_connect)
+        return output
+
+    def _save_configuration_now(self):
+        """Save the configuration using a new or pooled connection."""
+        if self.batch_cmds is not None:
+            # The device lock is not used when batching, so take the batch
+            # lock of the switch instead.
+            self.batch_cmds.save_configuration(self)
+            return
+        with ngs_lock.PoolLock(self.locker, **self.lock_kwargs):
+            with self._get_connection() as net_connect:
+                self.save_configuration(net_connect)
+
     @check_output('add network')
     def add_network(self, segmentation_id, network_id):
         if not self._do_vlan_management():
@@ -377,6 +580,50 @@ class NetmikoSwitch(devices.GenericSwitchDevice):
         return net_connect.send_config_set(config_commands=cmd_set,
                                            cmd_verify=False)
 
+    @contextlib.contextmanager
+    def config_session(self, net_connect):
+        """Open a session for sending several sets of configuration lines.
+
+        Configuration mode is entered once for the whole session, rather than
+        once per set of lines. Drivers that override send_config_set fall back
+        to calling it for each set of lines.
+
+        :param net_connect: a netmiko connection object.
+        :returns: a context manager yielding a function that takes a list of
+            configuration lines, sends them to the device, and returns their
+            output.
+        """
+        if type(self).send_config_set is not NetmikoSwitch.send_config_set:
+            yield functools.partial(self.send_config_set, net_connect)
+            return
+
+        net_connect.enable()
+        net_connect.config_mode()
+        failed = False
+
+        def send(cmd_set):
+            nonlocal failed
+            if failed:
+                # The state of the session is unknown after a failure, so use
+                # a separate configuration session for each remaining set.
+                return self.send_config_set(net_connect, cmd_set)
+            try:
+                return net_connect.send_config_set(
+                    config_commands=cmd_set, cmd_verify=False,
+                    enter_config_mode=False, exit_config_mode=False)
+            except Exception:
+                failed = True
+                raise
+
+        try:
+            yield send
+        finally:
+            try:
+                net_connect.exit_config_mode()
+            except Exception:
+                LOG.warning("Failed to exit configuration mode on %s",
+                            self.lock_kwargs['locks_prefix'], exc_info=True)
+
     def save_configuration(self, net_connect):
         """Try to save the device's configuration.
 
@@ -47,6 +47,9 @@ class BrocadeFastIron(netmiko_devices.NetmikoSwitch):
         'show interfaces ether {port} | include VLAN',
     )
 
+    COMMAND_FIELDS = dict(netmiko_devices.NetmikoSwitch.COMMAND_FIELDS,
+                          QUERY_PORT=('port',))
+
     @staticmethod
     def _process_raw_output(raw_output):
         PATTERN = "Member of L2 VLAN ID (\\d+), port is untagged"
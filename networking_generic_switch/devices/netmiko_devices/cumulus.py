@@ -79,6 +79,8 @@ class Cumulus(netmiko_devices.NetmikoSwitch):
         'net commit',
     ]
 
+    SAVE_COMMITS_CONFIG = True
+
     ERROR_MSG_PATTERNS = [
         # Its tempting to add this error message, but as only one
         # bridge-access is allowed, we ignore that error for now:
@@ -129,7 +129,7 @@ class DellPowerConnect(netmiko_devices.NetmikoSwitch):
 
     def __init__(self, device_cfg):
         super(DellPowerConnect, self).__init__(device_cfg)
-        port_mode = self.ngs_config['ngs_switchport_mode']
+        port_mode = self.settings.switchport_mode
         switchport_mode = {
             'general': self._switch_to_general_mode,
             'access': lambda: ()
@@ -181,6 +181,11 @@ class DellPowerConnect(netmiko_devices.NetmikoSwitch):
         'exit',
     )
 
+    COMMAND_FIELDS = dict(
+        netmiko_devices.NetmikoSwitch.COMMAND_FIELDS,
+        PLUG_PORT_TO_NETWORK_GENERAL=('port', 'segmentation_id'),
+        DELETE_PORT_GENERAL=('port', 'segmentation_id'))
+
     ADD_NETWORK_TO_TRUNK = (
         'interface {port}',
         'switchport general allowed vlan add {segmentation_id} tagged',
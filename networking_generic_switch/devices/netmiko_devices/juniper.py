@@ -72,6 +72,8 @@ class Juniper(netmiko_devices.NetmikoSwitch):
         'vlan members {segmentation_id}',
     )
 
+    SAVE_COMMITS_CONFIG = True
+
     def __init__(self, device_cfg):
         super(Juniper, self).__init__(device_cfg)
 
@@ -15,9 +15,6 @@
 from oslo_log import log as logging
 
 from networking_generic_switch.devices import netmiko_devices
-from networking_generic_switch.devices import utils as device_utils
-from networking_generic_switch import exceptions as exc
-from networking_generic_switch import locking as ngs_lock
 
 LOG = logging.getLogger(__name__)
 
@@ -69,23 +66,16 @@ class NokiaSRL(netmiko_devices.NetmikoSwitch):
             LOG.debug('Nothing to execute')
             return
 
-        try:
-            with ngs_lock.PoolLock(self.locker, **self.lock_kwargs):
-                with self._get_connection() as net_connect:
-                    output = self.send_config_set(net_connect, cmd_set)
-                    # A commit is required with Nokia SRL before saving
-                    output += self.commit(net_connect)
-                    self.save_configuration(net_connect)
-        except exc.GenericSwitchException:
-            # Reraise without modification exceptions originating from this
-            # module.
-            raise
-        except Exception as e:
-            raise exc.GenericSwitchNetmikoConnectError(
-                config=device_utils.sanitise_config(self.config), error=e
-            )
+        # Configuration is always committed and saved, so neither batching
+        # nor delayed saving is used.
+        return self._send_commands_to_device(cmd_set)
 
-        LOG.debug(output)
+    def _configure_device(self, cmd_set):
+        with self._get_connection() as net_connect:
+            output = self.send_config_set(net_connect, cmd_set)
+            # A commit is required with Nokia SRL before saving
+            output += self.commit(net_connect)
+            self.save_configuration(net_connect)
         return output
 
     def commit(self, net_connect) -> str:
@@ -0,0 +1,89 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections.abc
+import threading
+
+from oslo_log import log as logging
+
+from networking_generic_switch import devices
+
+LOG = logging.getLogger(__name__)
+
+
+class DeviceRegistry(collections.abc.Mapping):
+    """Mapping of switch names to switch device objects.
+
+    Device objects are created from their configuration on first access.
+    The NGS internal options of every switch are parsed and validated when
+    the registry is created, so that lookups by MAC address or physical
+    network do not require the devices to be created.
+    """
+
+    def __init__(self, device_configs):
+        """Create a device registry.
+
+        :param device_configs: a dict mapping switch names to device
+            configuration dicts.
+        :raises: GenericSwitchConfigValueInvalid if a switch option has an
+            invalid value.
+        """
+        self._configs = dict(device_configs)
+        self._settings = {name: devices.DeviceSettings(device_cfg)
+                          for name, device_cfg in self._configs.items()}
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        device = self._devices.get(name)
+        if device is None:
+            device_cfg = self._configs[name]
+            with self._lock:
+                device = self._devices.get(name)
+                if device is None:
+                    # device_manager removes NGS internal options from the
+                    # configuration it is passed, so pass a copy.
+                    device = devices.device_manager(dict(device_cfg))
+                    self._devices[name] = device
+        return device
+
+    def __iter__(self):
+        return iter(self._configs)
+
+    def __len__(self):
+        return len(self._configs)
+
+    def get_settings(self, name):
+        """Return the parsed NGS internal options of a switch.
+
+        :param name: name of the switch.
+        :returns: a DeviceSettings object.
+        """
+        return self._settings[name]
+
+    def is_loaded(self, name):
+        """Return whether the device object of a switch has been created."""
+        return name in self._devices
+
+    def load_all(self, ignore_errors=False):
+        """Create the device objects of all switches.
+
+        :param ignore_errors: whether to log and skip switches whose device
+            object cannot be created, rather than raising an exception.
+        """
+        for name in self:
+            try:
+                self[name]
+            except Exception:
+                if not ignore_errors:
+                    raise
+                LOG.exception("Failed to load device %s", name)
@@ -12,6 +12,8 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import types
+
 from oslo_config import cfg
 
 
@@ -19,7 +21,7 @@ CONF = cfg.CONF
 
 
 def get_switch_device(switches, switch_info=None,
-                      ngs_mac_address=None):
+                      ngs_mac_address=None, mac_index=None):
     """Return switch device by specified identifier.
 
     Returns switch device from switches array that matched with any of
@@ -28,18 +30,41 @@ def get_switch_device(switches, switch_info=None,
 
     :param switch_info: hostname of the switch or any other switch identifier.
     :param ngs_mac_address: Normalized mac address of the switch.
+    :param mac_index: Optional index of switch names by MAC address, as
+        returned by build_mac_index. If not specified, switches are scanned
+        linearly.
     :returns: switch device matches by specified identifier or None.
     """
 
     if ngs_mac_address:
-        for sw_info, switch in switches.items():
-            mac_address = switch.ngs_config.get('ngs_mac_address')
-            if mac_address and mac_address.lower() == ngs_mac_address.lower():
-                return switch
+        if mac_index is None:
+            mac_index = build_mac_index(
+                (name, switch.ngs_config.get('ngs_mac_address'))
+                for name, switch in switches.items())
+        name = mac_index.get(ngs_mac_address.lower())
+        if name is not None:
+            return switches[name]
     if switch_info:
         return switches.get(switch_info)
 
 
+def build_mac_index(mac_addresses):
+    """Return an index of switch names by MAC address.
+
+    Where several switches have the same MAC address, the first one wins.
+
+    :param mac_addresses: an iterable of 2-tuples containing the name of a
+        switch and its ngs_mac_address, or None.
+    :returns: a read-only mapping of lower case ngs_mac_address to switch
+        name.
+    """
+    index = {}
+    for name, mac_address in mac_addresses:
+        if mac_address:
+            index.setdefault(mac_address.lower(), name)
+    return types.MappingProxyType(index)
+
+
 def sanitise_config(config):
     """Return a sanitised configuration of a switch device.
 
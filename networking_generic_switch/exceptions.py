@@ -25,6 +25,10 @@ class GenericSwitchConfigException(exceptions.NeutronException):
     message = _("%(option)s must be one of: %(allowed_options)s")
 
 
+class GenericSwitchConfigValueInvalid(GenericSwitchException):
+    message = _("Invalid value for '%(option)s': %(value)s. %(error)s")
+
+
 class GenericSwitchEntrypointLoadError(GenericSwitchException):
     message = _("Failed to load entrypoint %(ep)s: %(err)s")
 
@@ -39,6 +43,10 @@ class GenericSwitchNetmikoMethodError(GenericSwitchException):
     message = _("Can not parse arguments: commands %(cmds)s, args %(args)s")
 
 
+class GenericSwitchCommandTemplateInvalid(GenericSwitchException):
+    message = _("Invalid command template %(name)s: %(error)s")
+
+
 class GenericSwitchNetmikoNotSupported(GenericSwitchException):
     message = _("Netmiko does not support device type %(device_type)s")
 
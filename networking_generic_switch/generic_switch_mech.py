@@ -12,19 +12,22 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import sys
+import types
 
+import eventlet
 from neutron.db import provisioning_blocks
 from neutron_lib.api.definitions import portbindings
 from neutron_lib.callbacks import resources
 from neutron_lib.plugins.ml2 import api
+from oslo_config import cfg
 from oslo_log import log as logging
 
 from networking_generic_switch import config as gsw_conf
-from networking_generic_switch import devices
+from networking_generic_switch.devices import registry as device_registry
 from networking_generic_switch.devices import utils as device_utils
 
 LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
 
 GENERIC_SWITCH_ENTITY = 'GENERICSWITCH'
 
@@ -43,15 +46,62 @@ class GenericSwitchDriver(api.MechanismDriver):
                             portbindings.CONNECTIVITY_L2}
 
         gsw_devices = gsw_conf.get_devices()
-        self.switches = {}
-        for switch_info, device_cfg in gsw_devices.items():
-            switch = devices.device_manager(device_cfg)
-            self.switches[switch_info] = switch
-
-        LOG.info('Devices %s have been loaded', self.switches.keys())
+        self.switches = device_registry.DeviceRegistry(gsw_devices)
+        self._build_indexes()
+
+        loading = CONF.ngs.device_loading
+        if loading == 'eager':
+            self.switches.load_all()
+            LOG.info('Devices %s have been loaded', self.switches.keys())
+        elif loading == 'background':
+            LOG.info('Devices %s have been configured, loading them in the '
+                     'background', self.switches.keys())
+            eventlet.spawn_n(self.switches.load_all, ignore_errors=True)
+        else:
+            LOG.info('Devices %s have been configured, and will be loaded '
+                     'on first use', self.switches.keys())
         if not self.switches:
             LOG.error('No devices have been loaded')
 
+    def _build_indexes(self):
+        """Build the switch lookup indexes.
+
+        The indexes are immutable, and are used to avoid scanning every
+        switch for each port and network operation. They are built from the
+        switch configuration, without creating the device objects.
+        """
+        settings = {name: self.switches.get_settings(name)
+                    for name in self.switches}
+        self._switches_by_mac = device_utils.build_mac_index(
+            (name, switch_settings.mac_address)
+            for name, switch_settings in settings.items())
+
+        # NOTE(mgoddard): If the switch has no physical networks then
+        # follow the old behaviour of mapping all networks to it.
+        by_physnet = {}
+        unassigned = []
+        for switch_name, switch_settings in settings.items():
+            physnets = switch_settings.physical_networks
+            if not physnets:
+                unassigned.append(switch_name)
+                for switch_names in by_physnet.values():
+                    switch_names.append(switch_name)
+                continue
+            for physnet in set(physnets):
+                switch_names = by_physnet.setdefault(physnet,
+                                                     list(unassigned))
+                switch_names.append(switch_name)
+        self._switches_by_physnet = types.MappingProxyType(
+            {physnet: tuple(switch_names)
+             for physnet, switch_names in by_physnet.items()})
+        self._switches_without_physnet = tuple(unassigned)
+
+    def _get_switch_device(self, switch_info=None, switch_id=None):
+        """Return the switch device for a link, or None if not known."""
+        return device_utils.get_switch_device(
+            self.switches, switch_info=switch_info,
+            ngs_mac_address=switch_id, mac_index=self._switches_by_mac)
+
     def create_network_precommit(self, context):
         """Allocate resources for a new network.
 
@@ -85,8 +135,11 @@ class GenericSwitchDriver(api.MechanismDriver):
 
         if provider_type == 'vlan' and segmentation_id:
             # Create vlan on all switches from this driver
-            for switch_name, switch in self._get_devices_by_physnet(physnet):
+            def add_network(switch_name):
                 try:
+                    # Load the switch here, so that a switch that fails to
+                    # load is reported like any other failure.
+                    switch = self.switches[switch_name]
                     switch.add_network(segmentation_id, network_id)
                 except Exception as e:
                     LOG.error("Failed to create network %(net_id)s "
@@ -100,6 +153,14 @@ class GenericSwitchDriver(api.MechanismDriver):
                              '%(device)s', {'net_id': network['id'],
                                             'device': switch_name})
 
+            errors = self._run_concurrently(
+                add_network,
+                [(name,) for name in self._get_switch_names_by_physnet(
+                    physnet)],
+                fail_fast=True)
+            if errors:
+                raise errors[0]
+
     def update_network_precommit(self, context):
         """Update resources of a network.
 
@@ -170,9 +231,9 @@ class GenericSwitchDriver(api.MechanismDriver):
 
         if provider_type == 'vlan' and segmentation_id:
             # Delete vlan on all switches from this driver
-            exc_info = None
-            for switch_name, switch in self._get_devices_by_physnet(physnet):
+            def del_network(switch_name):
                 try:
+                    switch = self.switches[switch_name]
                     switch.del_network(segmentation_id, network['id'])
                 except Exception as e:
                     LOG.error("Failed to delete network %(net_id)s "
@@ -180,14 +241,20 @@ class GenericSwitchDriver(api.MechanismDriver):
                               {'net_id': network['id'],
                                'switch': switch_name,
                                'exc': e})
-                    # Save any exceptions for later reraise.
-                    exc_info = sys.exc_info()
+                    raise
                 else:
                     LOG.info('Network %(net_id)s has been deleted on device '
                              '%(device)s', {'net_id': network['id'],
                                             'device': switch_name})
-            if exc_info:
-                raise exc_info[1]
+
+            # Attempt to delete the network on all switches, then reraise the
+            # last failure.
+            errors = self._run_concurrently(
+                del_network,
+                [(name,) for name in self._get_switch_names_by_physnet(
+                    physnet)])
+            if errors:
+                raise errors[-1]
 
     def create_subnet_precommit(self, context):
         """Allocate resources for a new subnet.
@@ -349,9 +416,7 @@ class GenericSwitchDriver(api.MechanismDriver):
             for link in local_link_information:
                 switch_info = link.get('switch_info')
                 switch_id = link.get('switch_id')
-                switch = device_utils.get_switch_device(
-                    self.switches, switch_info=switch_info,
-                    ngs_mac_address=switch_id)
+                switch = self._get_switch_device(switch_info, switch_id)
                 if not switch:
                     return
             provisioning_blocks.provisioning_complete(
@@ -447,30 +512,36 @@ class GenericSwitchDriver(api.MechanismDriver):
                 return
 
             is_802_3ad = self._is_802_3ad(port)
-            for link in local_link_information:
-                port_id = link.get('port_id')
-                switch_info = link.get('switch_info')
-                switch_id = link.get('switch_id')
-                switch = device_utils.get_switch_device(
-                    self.switches, switch_info=switch_info,
-                    ngs_mac_address=switch_id)
-
-                segments = context.segments_to_bind
-                # If segmentation ID is None, set vlan 1
-                segmentation_id = segments[0].get('segmentation_id') or 1
-                LOG.debug("Putting port %(port_id)s on %(switch_info)s "
-                          "to vlan: %(segmentation_id)s",
-                          {'port_id': port_id, 'switch_info': switch_info,
-                           'segmentation_id': segmentation_id})
-                # Move port to network
-                if is_802_3ad and hasattr(switch, 'plug_bond_to_network'):
-                    switch.plug_bond_to_network(port_id, segmentation_id)
-                else:
-                    switch.plug_port_to_network(port_id, segmentation_id)
-                LOG.info("Successfully bound port %(port_id)s in segment "
-                         "%(segment_id)s on device %(device)s",
-                         {'port_id': port['id'], 'device': switch_info,
-                          'segment_id': segmentation_id})
+            segments = context.segments_to_bind
+            # If segmentation ID is None, set vlan 1
+            segmentation_id = segments[0].get('segmentation_id') or 1
+
+            def plug_links(switch, links):
+                for link in links:
+                    port_id = link.get('port_id')
+                    switch_info = link.get('switch_info')
+                    LOG.debug("Putting port %(port_id)s on %(switch_info)s "
+                              "to vlan: %(segmentation_id)s",
+                              {'port_id': port_id, 'switch_info': switch_info,
+                               'segmentation_id': segmentation_id})
+                    # Move port to network
+                    if is_802_3ad and hasattr(switch, 'plug_bond_to_network'):
+                        switch.plug_bond_to_network(port_id, segmentation_id)
+                    else:
+                        switch.plug_port_to_network(port_id, segmentation_id)
+                    LOG.info("Successfully bound port %(port_id)s in segment "
+                             "%(segment_id)s on device %(device)s",
+                             {'port_id': port['id'], 'device': switch_info,
+                              'segment_id': segmentation_id})
+
+            # Links on different switches are configured concurrently, while
+            # links on the same switch are configured in order.
+            errors = self._run_concurrently(
+                plug_links,
+                self._get_links_by_switch(local_link_information),
+                fail_fast=True)
+            if errors:
+                raise errors[0]
 
             context.set_binding(segments[0][api.ID],
                                 portbindings.VIF_TYPE_OTHER, {})
@@ -498,9 +569,7 @@ class GenericSwitchDriver(api.MechanismDriver):
         for link in local_link_information:
             switch_info = link.get('switch_info')
             switch_id = link.get('switch_id')
-            switch = device_utils.get_switch_device(
-                self.switches, switch_info=switch_info,
-                ngs_mac_address=switch_id)
+            switch = self._get_switch_device(switch_info, switch_id)
             if not switch:
                 LOG.error("Cannot bind port %(port)s as device %(device)s "
                           "is not configured. Check baremetal port link "
@@ -579,48 +648,122 @@ class GenericSwitchDriver(api.MechanismDriver):
             return
 
         is_802_3ad = self._is_802_3ad(port)
+        # If segmentation ID is None, set vlan 1
+        segmentation_id = network.get('provider:segmentation_id') or 1
+
+        def unplug_links(switch, links):
+            for link in links:
+                switch_info = link.get('switch_info')
+                port_id = link.get('port_id')
+                LOG.debug("Unplugging port %(port)s on %(switch_info)s from "
+                          "vlan: %(segmentation_id)s",
+                          {'port': port_id, 'switch_info': switch_info,
+                           'segmentation_id': segmentation_id})
+                try:
+                    if is_802_3ad and hasattr(switch,
+                                              'unplug_bond_from_network'):
+                        switch.unplug_bond_from_network(port_id,
+                                                        segmentation_id)
+                    else:
+                        switch.delete_port(port_id, segmentation_id)
+                except Exception as e:
+                    LOG.error("Failed to unplug port %(port_id)s "
+                              "on device: %(switch)s from network %(net_id)s "
+                              "reason: %(exc)s",
+                              {'port_id': port['id'], 'net_id': network['id'],
+                               'switch': switch_info, 'exc': e})
+                    raise
+                LOG.info('Port %(port_id)s has been unplugged from network '
+                         '%(net_id)s on device %(device)s',
+                         {'port_id': port['id'], 'net_id': network['id'],
+                          'device': switch_info})
+
+        # Links on different switches are unplugged concurrently, while links
+        # on the same switch are unplugged in order.
+        errors = self._run_concurrently(
+            unplug_links, self._get_links_by_switch(local_link_information),
+            fail_fast=True)
+        if errors:
+            raise errors[0]
+
+    def _get_links_by_switch(self, local_link_information):
+        """Group the links of a port by the switch they are connected to.
+
+        Links that refer to a switch that is not known to NGS are skipped.
+
+        :param local_link_information: The local link information of a port.
+        :returns: A list of 2-tuples containing a switch device object and a
+            list of the links connected to it, in the order in which the
+            switches first appear.
+        """
+        links_by_switch = []
         for link in local_link_information:
-            switch_info = link.get('switch_info')
-            switch_id = link.get('switch_id')
-            switch = device_utils.get_switch_device(
-                self.switches, switch_info=switch_info,
-                ngs_mac_address=switch_id)
+            switch = self._get_switch_device(link.get('switch_info'),
+                                             link.get('switch_id'))
             if not switch:
                 continue
-            port_id = link.get('port_id')
-            # If segmentation ID is None, set vlan 1
-            segmentation_id = network.get('provider:segmentation_id') or 1
-            LOG.debug("Unplugging port %(port)s on %(switch_info)s from vlan: "
-                      "%(segmentation_id)s",
-                      {'port': port_id, 'switch_info': switch_info,
-                       'segmentation_id': segmentation_id})
+            for known_switch, links in links_by_switch:
+                if known_switch is switch:
+                    links.append(link)
+                    break
+            else:
+                links_by_switch.append((switch, [link]))
+        return links_by_switch
+
+    @staticmethod
+    def _run_concurrently(func, args_list, fail_fast=False):
+        """Call a function for each set of arguments, concurrently.
+
+        Up to ``[ngs] switch_concurrency`` calls are run at once using green
+        threads.
+
+        :param func: The function to call.
+        :param args_list: An iterable of argument tuples to call the function
+            with.
+        :param fail_fast: Whether to stop making new calls after one has
+            failed. Calls that have already started are allowed to complete.
+        :returns: A list of exceptions raised by the calls, in the order they
+            were raised.
+        """
+        errors = []
+
+        def run(args):
+            if fail_fast and errors:
+                return
             try:
-                if is_802_3ad and hasattr(switch, 'unplug_bond_from_network'):
-                    switch.unplug_bond_from_network(port_id, segmentation_id)
-                else:
-                    switch.delete_port(port_id, segmentation_id)
+                func(*args)
             except Exception as e:
-                LOG.error("Failed to unplug port %(port_id)s "
-                          "on device: %(switch)s from network %(net_id)s "
-                          "reason: %(exc)s",
-                          {'port_id': port['id'], 'net_id': network['id'],
-                           'switch': switch_info, 'exc': e})
-                raise e
-            LOG.info('Port %(port_id)s has been unplugged from network '
-                     '%(net_id)s on device %(device)s',
-                     {'port_id': port['id'], 'net_id': network['id'],
-                      'device': switch_info})
+                errors.append(e)
+
+        width = CONF.ngs.switch_concurrency
+        if width <= 1:
+            for args in args_list:
+                run(args)
+            return errors
+
+        pool = eventlet.GreenPool(width)
+        for args in args_list:
+            if fail_fast and errors:
+                break
+            pool.spawn_n(run, args)
+        pool.waitall()
+        return errors
+
+    def _get_switch_names_by_physnet(self, physnet):
+        """Return the names of the switches on a physical network.
+
+        :param physnet: Physical network to filter by.
+        :returns: A tuple of switch names.
+        """
+        return self._switches_by_physnet.get(
+            physnet, self._switches_without_physnet)
 
     def _get_devices_by_physnet(self, physnet):
-        """Generator yielding switches on a particular physical network.
+        """Return the switches on a particular physical network.
 
         :param physnet: Physical network to filter by.
-        :returns: Yields 2-tuples containing the name of the switch and the
-            switch device object.
+        :returns: An iterator over 2-tuples containing the name of the switch
+            and the switch device object.
         """
-        for switch_name, switch in self.switches.items():
-            physnets = switch._get_physical_networks()
-            # NOTE(mgoddard): If the switch has no physical networks then
-            # follow the old behaviour of mapping all networks to it.
-            if not physnets or physnet in physnets:
-                yield switch_name, switch
+        return ((switch_name, self.switches[switch_name])
+                for switch_name in self._get_switch_names_by_physnet(physnet))
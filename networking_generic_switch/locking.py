@@ -12,14 +12,92 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import atexit
 import itertools
+import threading
 
 from oslo_log import log as logging
-import tenacity
-from tooz import coordination
+
+from networking_generic_switch import _lazy_import
+
+# NOTE: tooz is imported on first use, as it is relatively slow to import and
+# is only needed when a coordination backend is configured.
+coordination = _lazy_import.lazy_import('tooz.coordination')
+tenacity = _lazy_import.lazy_import('tenacity')
 
 LOG = logging.getLogger(__name__)
 
+_COORDINATORS = {}
+_COORDINATORS_LOCK = threading.Lock()
+
+
+def get_coordinator(backend_url, member_id):
+    """Return the shared coordinator for a backend URL.
+
+    Coordinators are shared by all switches in the process, and are started
+    on first use.
+
+    :param backend_url: URL of the tooz backend.
+    :param member_id: member ID to use if the coordinator is created.
+    :returns: a SharedCoordinator object.
+    """
+    with _COORDINATORS_LOCK:
+        coordinator = _COORDINATORS.get(backend_url)
+        if coordinator is None:
+            if not _COORDINATORS:
+                atexit.register(_stop_coordinators)
+            coordinator = SharedCoordinator(backend_url, member_id)
+            _COORDINATORS[backend_url] = coordinator
+        return coordinator
+
+
+def _stop_coordinators():
+    for coordinator in list(_COORDINATORS.values()):
+        coordinator.stop()
+
+
+class SharedCoordinator(object):
+    """A tooz coordinator shared by all switches using a backend.
+
+    The underlying coordinator is created and started, with a heartbeat, the
+    first time a lock is requested.
+    """
+
+    def __init__(self, backend_url, member_id):
+        self.backend_url = backend_url
+        self.member_id = member_id
+        self._coordinator = None
+        self._lock = threading.Lock()
+
+    def _get_coordinator(self):
+        if self._coordinator is None:
+            with self._lock:
+                if self._coordinator is None:
+                    coordinator = coordination.get_coordinator(
+                        self.backend_url, self.member_id)
+                    coordinator.start(start_heart=True)
+                    self._coordinator = coordinator
+        return self._coordinator
+
+    def get_lock(self, name):
+        """Return a tooz lock, starting the coordinator if necessary.
+
+        :param name: name of the lock.
+        :returns: a tooz lock object.
+        """
+        return self._get_coordinator().get_lock(name)
+
+    def stop(self):
+        """Stop the coordinator if it has been started."""
+        with self._lock:
+            coordinator, self._coordinator = self._coordinator, None
+        if coordinator is not None:
+            try:
+                coordinator.stop()
+            except Exception:
+                LOG.warning("Failed to stop coordinator for %s",
+                            self.backend_url, exc_info=True)
+
 
 class PoolLock(object):
     """Tooz lock wrapper for pools of locks
@@ -0,0 +1,130 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+import time
+import weakref
+
+import eventlet
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+_SCHEDULERS = weakref.WeakSet()
+
+# Maximum time in seconds between attempts to save after failures.
+MAX_RETRY_INTERVAL = 300
+
+
+def flush_all_schedulers():
+    """Run pending saves of all schedulers.
+
+    This is called at exit, once batch workers have completed, as they may
+    schedule saves.
+    """
+    for scheduler in list(_SCHEDULERS):
+        scheduler.flush()
+
+
+class SaveScheduler(object):
+    """Debounced saving of the configuration of a single switch.
+
+    Each call to schedule() requests that the configuration be saved. The
+    save runs in a background thread once no further save has been requested
+    for ``delay`` seconds, or ``max_wait`` seconds after the first request
+    that is still pending, whichever is sooner. Many configuration changes
+    are therefore persisted by a single save. A failed save is retried, with
+    the interval doubling after each consecutive failure up to
+    MAX_RETRY_INTERVAL seconds.
+
+    """
+
+    def __init__(self, save, delay, max_wait, name=None):
+        self._save = save
+        self.delay = delay
+        self.max_wait = max_wait
+        self.name = name
+        # Monotonic times of the first and last pending save requests.
+        self._first_request = None
+        self._last_request = None
+        # Number of consecutive failed saves, and the monotonic time before
+        # which the next save must not be attempted.
+        self._failures = 0
+        self._retry_at = None
+        self._lock = threading.Lock()
+        self._saver = None
+        _SCHEDULERS.add(self)
+
+    @property
+    def pending(self):
+        """Whether a save has been requested but has not yet started."""
+        return self._first_request is not None
+
+    def schedule(self):
+        """Request that the configuration be saved."""
+        now = time.monotonic()
+        with self._lock:
+            if self._first_request is None:
+                self._first_request = now
+            self._last_request = now
+            if self._saver is None:
+                self._saver = eventlet.spawn(self._run)
+
+    def flush(self):
+        """Save the configuration now if a save is pending."""
+        with self._lock:
+            if self._first_request is None:
+                return
+            self._first_request = None
+            self._last_request = None
+        LOG.debug("Saving configuration of %s", self.name)
+        try:
+            self._save()
+        except Exception:
+            LOG.exception("Failed to save configuration of %s", self.name)
+            self._retry()
+        else:
+            with self._lock:
+                self._failures = 0
+                self._retry_at = None
+
+    def _retry(self):
+        """Request the save again after a failure, backing off."""
+        now = time.monotonic()
+        with self._lock:
+            self._failures += 1
+            interval = min(max(self.delay, 1) * 2 ** (self._failures - 1),
+                           MAX_RETRY_INTERVAL)
+            self._retry_at = now + interval
+            if self._first_request is None:
+                self._first_request = now
+                self._last_request = now
+            if self._saver is None:
+                self._saver = eventlet.spawn(self._run)
+        LOG.info("Retrying save of configuration of %s in %d seconds",
+                 self.name, interval)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._first_request is None:
+                    self._saver = None
+                    return
+                deadline = min(self._last_request + self.delay,
+                               self._first_request + self.max_wait)
+                if self._retry_at is not None:
+                    deadline = max(deadline, self._retry_at)
+            wait = deadline - time.monotonic()
+            if wait > 0:
+                eventlet.sleep(wait)
+            else:
+                self.flush()
@@ -0,0 +1,66 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import unittest
+
+from networking_generic_switch.devices import command_templates
+from networking_generic_switch.devices import netmiko_devices
+from networking_generic_switch import exceptions as exc
+
+
+class TestCommandTemplate(unittest.TestCase):
+
+    def test_render(self):
+        template = command_templates.CommandTemplate(
+            ('interface {port}', 'vlan {segmentation_id}', 'exit {{x}}'))
+        self.assertEqual({'port', 'segmentation_id'}, template.fields)
+        self.assertEqual(
+            ['interface 1/1', 'vlan 22', 'exit {x}'],
+            template.render({'port': '1/1', 'segmentation_id': 22}))
+
+    def test_render_missing_field(self):
+        template = command_templates.CommandTemplate(
+            ('interface {port}', 'vlan {segmentation_id}'))
+        self.assertRaises(exc.GenericSwitchNetmikoMethodError,
+                          template.render, {'port': '1/1'})
+
+    def test_render_empty_value(self):
+        template = command_templates.CommandTemplate(('interface {port}',))
+        self.assertRaises(exc.GenericSwitchNetmikoMethodError,
+                          template.render, {'port': ''})
+
+    def test_positional_field(self):
+        self.assertRaises(ValueError, command_templates.CommandTemplate,
+                          ('interface {}',))
+
+    def test_validate(self):
+        template = command_templates.CommandTemplate(('interface {prot}',))
+        template.validate(('prot',), 'FOO')
+        self.assertRaisesRegex(
+            exc.GenericSwitchCommandTemplateInvalid,
+            r"Invalid command template FOO: unknown placeholders \['prot'\]",
+            template.validate, ('port',), 'FOO')
+
+    def test_get_template_cached(self):
+        template1 = command_templates.get_template(['interface {port}'])
+        template2 = command_templates.get_template(('interface {port}',))
+        self.assertIs(template1, template2)
+
+    def test_driver_invalid_template(self):
+        def define_driver():
+            class FakeDriver(netmiko_devices.NetmikoSwitch):
+                PLUG_PORT_TO_NETWORK = ('interface {bond}',)
+
+        self.assertRaisesRegex(
+            exc.GenericSwitchCommandTemplateInvalid,
+            r"FakeDriver.PLUG_PORT_TO_NETWORK: unknown placeholders",
+            define_driver)
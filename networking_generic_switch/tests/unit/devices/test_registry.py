@@ -0,0 +1,81 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import unittest
+from unittest import mock
+
+from networking_generic_switch import devices
+from networking_generic_switch.devices import registry
+from networking_generic_switch import exceptions as exc
+
+
+@mock.patch.object(devices, 'device_manager', autospec=True)
+class TestDeviceRegistry(unittest.TestCase):
+
+    def setUp(self):
+        super(TestDeviceRegistry, self).setUp()
+        self.configs = {
+            'A': {'device_type': 'netmiko_ovs_linux',
+                  'ngs_physical_networks': 'physnet1'},
+            'B': {'device_type': 'netmiko_cisco_ios',
+                  'ngs_mac_address': 'aa:bb:cc:dd:ee:ff'},
+        }
+
+    def test_lazy(self, mock_dm):
+        reg = registry.DeviceRegistry(self.configs)
+
+        self.assertEqual(['A', 'B'], list(reg))
+        self.assertEqual(2, len(reg))
+        self.assertEqual(('physnet1',),
+                         reg.get_settings('A').physical_networks)
+        self.assertEqual('aa:bb:cc:dd:ee:ff',
+                         reg.get_settings('B').mac_address)
+        self.assertFalse(mock_dm.called)
+
+        self.assertEqual(mock_dm.return_value, reg['A'])
+        self.assertEqual(mock_dm.return_value, reg['A'])
+        mock_dm.assert_called_once_with(self.configs['A'])
+        self.assertIsNot(self.configs['A'], mock_dm.call_args[0][0])
+        self.assertTrue(reg.is_loaded('A'))
+        self.assertFalse(reg.is_loaded('B'))
+        self.assertIsNone(reg.get('C'))
+
+    def test_invalid_settings(self, mock_dm):
+        self.configs['A']['ngs_manage_vlans'] = 'maybe'
+        self.assertRaises(exc.GenericSwitchConfigValueInvalid,
+                          registry.DeviceRegistry, self.configs)
+
+    def test_load_all(self, mock_dm):
+        reg = registry.DeviceRegistry(self.configs)
+
+        reg.load_all()
+
+        self.assertEqual(2, mock_dm.call_count)
+        self.assertTrue(reg.is_loaded('A'))
+        self.assertTrue(reg.is_loaded('B'))
+
+    def test_load_all_error(self, mock_dm):
+        mock_dm.side_effect = [ValueError('boom'), mock.Mock()]
+        reg = registry.DeviceRegistry(self.configs)
+
+        self.assertRaises(ValueError, reg.load_all)
+        self.assertFalse(reg.is_loaded('A'))
+        self.assertFalse(reg.is_loaded('B'))
+
+    def test_load_all_ignore_errors(self, mock_dm):
+        mock_dm.side_effect = [ValueError('boom'), mock.Mock()]
+        reg = registry.DeviceRegistry(self.configs)
+
+        reg.load_all(ignore_errors=True)
+
+        self.assertFalse(reg.is_loaded('A'))
+        self.assertTrue(reg.is_loaded('B'))
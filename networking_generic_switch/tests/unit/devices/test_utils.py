@@ -59,6 +59,28 @@ class TestDevices(unittest.TestCase):
             self.devices, switch_info='A',
             ngs_mac_address='11:22:33:44:55:77'))
 
+    def _build_mac_index(self):
+        return device_utils.build_mac_index(
+            (name, device.ngs_config.get('ngs_mac_address'))
+            for name, device in self.devices.items())
+
+    def test_get_switch_device_mac_index(self):
+        mac_index = self._build_mac_index()
+        self.assertEqual({'aa:bb:cc:dd:ee:ff': 'B'}, dict(mac_index))
+        self.assertEqual(self.devices['B'], device_utils.get_switch_device(
+            self.devices, switch_info='A',
+            ngs_mac_address='AA:BB:CC:DD:EE:FF', mac_index=mac_index))
+        self.assertEqual(self.devices['A'], device_utils.get_switch_device(
+            self.devices, switch_info='A',
+            ngs_mac_address='11:22:33:44:55:77', mac_index=mac_index))
+
+    def test_build_mac_index_first_match(self):
+        self.devices['C'] = devices.device_manager(
+            {"device_type": 'netmiko_cisco_ios',
+             "ngs_mac_address": 'AA:BB:CC:DD:EE:FF'})
+        mac_index = self._build_mac_index()
+        self.assertEqual({'aa:bb:cc:dd:ee:ff': 'B'}, dict(mac_index))
+
     def test_sanitise_config(self):
         config = {'username': 'fake-user', 'password': 'fake-password'}
         result = device_utils.sanitise_config(config)
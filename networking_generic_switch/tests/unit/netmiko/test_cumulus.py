@@ -155,6 +155,10 @@ class TestNetmikoCumulus(test_netmiko_base.NetmikoSwitchTestBase):
         mock_exec.assert_called_with(
             ['net del bond 3333 bridge access 33'])
 
+    def test_save_delay_rejected(self):
+        self.assertRaises(exc.GenericSwitchConfigValueInvalid,
+                          self._make_switch_device, {'ngs_save_delay': '5'})
+
     def test_save(self):
         mock_connect = mock.MagicMock()
         mock_connect.save_config.side_effect = NotImplementedError
@@ -127,6 +127,15 @@ class TestNetmikoJuniper(test_netmiko_base.NetmikoSwitchTestBase):
         self.switch.save_configuration(mock_connection)
         mock_connection.commit.assert_called_once_with()
 
+    def test_save_delay_rejected(self):
+        self.assertRaises(exc.GenericSwitchConfigValueInvalid,
+                          self._make_switch_device, {'ngs_save_delay': '5'})
+
+    def test_save_delay_without_save_configuration(self):
+        switch = self._make_switch_device({'ngs_save_delay': '5',
+                                           'ngs_save_configuration': False})
+        self.assertIsNone(switch.save_scheduler)
+
     @mock.patch.object(netmiko_devices.tenacity, 'wait_fixed',
                        return_value=tenacity.wait_fixed(0.01))
     @mock.patch.object(netmiko_devices.tenacity, 'stop_after_delay',
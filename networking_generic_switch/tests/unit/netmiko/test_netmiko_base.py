@@ -23,6 +23,8 @@ import paramiko
 import tenacity
 from tooz import coordination
 
+from networking_generic_switch import circuit_breaker
+from networking_generic_switch import connection_pool
 from networking_generic_switch.devices import netmiko_devices
 from networking_generic_switch.devices import utils
 from networking_generic_switch import exceptions as exc
@@ -56,6 +58,33 @@ class TestNetmikoSwitch(NetmikoSwitchTestBase):
             Exception, "backend_url",
             self._make_switch_device, {'ngs_batch_requests': True})
 
+    @mock.patch.dict(netmiko_devices.batching._MEMORY_QUEUES, clear=True)
+    def test_batch_memory_backend(self):
+        self.cfg.config(batch_backend='memory', group='ngs_coordination')
+        switch = self._make_switch_device({'ngs_batch_requests': True})
+        self.assertIsInstance(switch.batch_cmds.queue,
+                              netmiko_devices.batching.MemorySwitchQueue)
+
+    @mock.patch.object(netmiko_devices.NetmikoSwitch, '_format_commands',
+                       return_value=['cmd'])
+    @mock.patch.object(netmiko_devices.batching.SwitchBatch, 'do_batch',
+                       return_value='fake output')
+    def test_batch_op(self, m_do_batch, m_format):
+        self.cfg.config(backend_url='url', group='ngs_coordination')
+        switch = self._make_switch_device({'ngs_batch_requests': True,
+                                           'ngs_batch_coalesce': True})
+        self.assertTrue(switch.batch_cmds.coalesce)
+        switch.plug_port_to_network(2222, 22)
+        switch.add_network(33, '0ae071f5-5be9-43e4-80ea-e41fefe85b21')
+        m_do_batch.assert_has_calls([
+            mock.call(switch, ['cmd'],
+                      op={'name': 'plug port', 'port': 2222, 'vlan': 22}),
+            mock.call(switch, ['cmd'],
+                      op={'name': 'add network', 'vlan': 33,
+                          'network_id': '0ae071f55be943e480eae41fefe85b21'}),
+        ])
+        self.assertIsNone(getattr(netmiko_devices._current_op, 'op', None))
+
     @mock.patch('networking_generic_switch.devices.netmiko_devices.'
                 'NetmikoSwitch.send_commands_to_device',
                 return_value='fake output')
@@ -259,6 +288,160 @@ class TestNetmikoSwitch(NetmikoSwitchTestBase):
         self.assertRaises(FakeError, get_connection)
         m_conn.__exit__.assert_called_once_with(mock.ANY, mock.ANY, mock.ANY)
 
+    @mock.patch.object(netmiko, 'ConnectHandler')
+    def test__get_connection_persistent(self, m_conn_handler):
+        switch = self._make_switch_device(
+            {'ngs_persistent_connections': 'true',
+             'ngs_connection_idle_timeout': '30'})
+        self.assertEqual(30, switch.connection_pool.idle_timeout)
+        self.assertEqual(1, switch.connection_pool.max_size)
+        m_conn = mock.MagicMock()
+        m_conn_handler.return_value = m_conn
+
+        with mock.patch.object(switch.connection_pool, '_reaper', True):
+            with switch._get_connection() as conn:
+                self.assertEqual(m_conn, conn)
+            with switch._get_connection() as conn:
+                self.assertEqual(m_conn, conn)
+
+        m_conn_handler.assert_called_once_with(**switch.config)
+        m_conn.is_alive.assert_called_once_with()
+        self.assertFalse(m_conn.__exit__.called)
+        self.assertFalse(m_conn.disconnect.called)
+
+    def test__get_connection_not_persistent(self):
+        self.assertIsNone(self.switch.connection_pool)
+
+    @mock.patch.object(netmiko_devices.NetmikoSwitch, '_get_connection')
+    @mock.patch.object(netmiko_devices.NetmikoSwitch, 'send_config_set')
+    @mock.patch.object(netmiko_devices.NetmikoSwitch, 'save_configuration')
+    def test_send_commands_to_device_reconnect(self, save_mock, send_mock,
+                                               gc_mock):
+        switch = self._make_switch_device(
+            {'ngs_persistent_connections': 'true'})
+        connect_mock = mock.MagicMock(netmiko.base_connection.BaseConnection)
+        gc_mock.return_value.__enter__.return_value = connect_mock
+        send_mock.side_effect = [connection_pool.StaleConnection,
+                                 'fake output']
+
+        result = switch.send_commands_to_device(['spam ham aaaa'])
+
+        self.assertEqual('fake output', result)
+        self.assertEqual(2, gc_mock.call_count)
+        self.assertEqual(2, send_mock.call_count)
+        save_mock.assert_called_once_with(connect_mock)
+
+    @mock.patch.object(netmiko_devices.NetmikoSwitch, '_get_connection')
+    @mock.patch.object(netmiko_devices.NetmikoSwitch, 'send_config_set')
+    def test_send_commands_to_device_reconnect_once(self, send_mock,
+                                                    gc_mock):
+        switch = self._make_switch_device(
+            {'ngs_persistent_connections': 'true'})
+        send_mock.side_effect = connection_pool.StaleConnection
+
+        self.assertRaises(exc.GenericSwitchNetmikoConnectError,
+                          switch.send_commands_to_device, ['spam ham aaaa'])
+
+        self.assertEqual(2, send_mock.call_count)
+
+    @mock.patch.object(netmiko_devices.NetmikoSwitch, 'send_config_set')
+    @mock.patch.object(netmiko, 'ConnectHandler')
+    def test_send_commands_to_device_reconnect_reused(self, m_conn_handler,
+                                                      send_mock):
+        switch = self._make_switch_device(
+            {'ngs_persistent_connections': 'true'})
+        conn1 = mock.MagicMock()
+        conn2 = mock.MagicMock()
+        m_conn_handler.side_effect = [conn1, conn2]
+        send_mock.side_effect = ['output1', EOFError, 'output2']
+
+        switch.send_commands_to_device(['spam ham aaaa'])
+        result = switch.send_commands_to_device(['spam ham aaaa'])
+
+        # The lost connection was discarded, and the commands sent again on
+        # a new connection.
+        self.assertEqual('output2', result)
+        send_mock.assert_has_calls([mock.call(conn1, ['spam ham aaaa']),
+                                    mock.call(conn1, ['spam ham aaaa']),
+                                    mock.call(conn2, ['spam ham aaaa'])])
+        conn1.disconnect.assert_called_once_with()
+
+    @mock.patch.object(netmiko_devices.NetmikoSwitch, 'send_config_set')
+    @mock.patch.object(netmiko, 'ConnectHandler')
+    def test_send_commands_to_device_no_reconnect_new(self, m_conn_handler,
+                                                      send_mock):
+        switch = self._make_switch_device(
+            {'ngs_persistent_connections': 'true'})
+        send_mock.side_effect = EOFError
+
+        self.assertRaises(exc.GenericSwitchNetmikoConnectError,
+                          switch.send_commands_to_device, ['spam ham aaaa'])
+
+        # A new connection that fails is not retried.
+        send_mock.assert_called_once_with(mock.ANY, ['spam ham aaaa'])
+        m_conn_handler.return_value.disconnect.assert_called_once_with()
+
+    @mock.patch.object(netmiko_devices.NetmikoSwitch, '_get_connection')
+    @mock.patch.object(netmiko_devices.NetmikoSwitch, 'send_config_set')
+    def test_send_commands_to_device_no_reconnect(self, send_mock, gc_mock):
+        send_mock.side_effect = EOFError
+
+        self.assertRaises(exc.GenericSwitchNetmikoConnectError,
+                          self.switch.send_commands_to_device,
+                          ['spam ham aaaa'])
+
+        send_mock.assert_called_once_with(mock.ANY, ['spam ham aaaa'])
+
+    @mock.patch.dict(circuit_breaker._BREAKERS, clear=True)
+    @mock.patch.object(netmiko_devices.tenacity, 'wait_fixed',
+                       return_value=tenacity.wait_fixed(0.01))
+    @mock.patch.object(netmiko_devices.tenacity, 'stop_after_delay',
+                       return_value=tenacity.stop_after_delay(0.1))
+    @mock.patch.object(netmiko, 'ConnectHandler')
+    def test__get_connection_circuit_breaker(self, m_conn_handler,
+                                             m_stop, m_wait):
+        switch = self._make_switch_device(
+            {'ngs_circuit_breaker_threshold': '2',
+             'ngs_circuit_breaker_reset_timeout': '30'})
+        m_conn_handler.side_effect = paramiko.SSHException
+
+        def get_connection():
+            with switch._get_connection():
+                self.fail()
+
+        self.assertRaises(exc.GenericSwitchNetmikoConnectError, get_connection)
+        self.assertRaises(exc.GenericSwitchNetmikoConnectError, get_connection)
+        self.assertEqual(circuit_breaker.OPEN, switch.circuit_breaker.state)
+        m_conn_handler.reset_mock()
+
+        # Further attempts fail without connecting.
+        self.assertRaisesRegex(exc.GenericSwitchNetmikoConnectError,
+                               'Circuit breaker', get_connection)
+        self.assertFalse(m_conn_handler.called)
+
+    @mock.patch.dict(circuit_breaker._BREAKERS, clear=True)
+    def test_circuit_breaker_shared(self):
+        switch1 = self._make_switch_device(
+            {'ngs_circuit_breaker_threshold': '2'})
+        switch2 = self._make_switch_device(
+            {'ngs_circuit_breaker_threshold': '2'})
+        self.assertIs(switch1.circuit_breaker, switch2.circuit_breaker)
+        self.assertEqual(60, switch1.circuit_breaker.reset_timeout)
+        self.assertIsNone(self.switch.circuit_breaker)
+
+    @mock.patch.dict(circuit_breaker._BREAKERS, clear=True)
+    @mock.patch.object(netmiko_devices.ngs_lock, 'PoolLock', autospec=True)
+    def test_send_commands_to_device_circuit_open(self, lock_mock):
+        switch = self._make_switch_device(
+            {'ngs_circuit_breaker_threshold': '1'})
+        switch.circuit_breaker.state = circuit_breaker.OPEN
+        switch.circuit_breaker._opened_at = (
+            circuit_breaker.time.monotonic())
+
+        self.assertRaises(exc.GenericSwitchNetmikoConnectError,
+                          switch.send_commands_to_device, ['spam ham aaaa'])
+        self.assertFalse(lock_mock.called)
+
     @mock.patch.object(netmiko_devices.NetmikoSwitch, '_get_connection')
     def test_send_commands_to_device_empty(self, gc_mock):
         connect_mock = mock.MagicMock()
@@ -362,6 +545,155 @@ class TestNetmikoSwitch(NetmikoSwitchTestBase):
             config_commands=['spam ham aaaa'], cmd_verify=False)
         save_mock.assert_called_once_with(connect_mock)
 
+    def test_config_session(self):
+        connection_mock = mock.MagicMock()
+        connection_mock.send_config_set.side_effect = ['out1', 'out2']
+        with self.switch.config_session(connection_mock) as send:
+            connection_mock.enable.assert_called_once_with()
+            connection_mock.config_mode.assert_called_once_with()
+            self.assertEqual('out1', send(['cmd1']))
+            self.assertEqual('out2', send(['cmd2']))
+            self.assertFalse(connection_mock.exit_config_mode.called)
+        connection_mock.send_config_set.assert_has_calls([
+            mock.call(config_commands=['cmd1'], cmd_verify=False,
+                      enter_config_mode=False, exit_config_mode=False),
+            mock.call(config_commands=['cmd2'], cmd_verify=False,
+                      enter_config_mode=False, exit_config_mode=False),
+        ])
+        connection_mock.exit_config_mode.assert_called_once_with()
+
+    def test_config_session_failure(self):
+        class FakeError(Exception):
+            pass
+
+        connection_mock = mock.MagicMock()
+        connection_mock.send_config_set.side_effect = [FakeError('Bang'),
+                                                       'out2']
+        with self.switch.config_session(connection_mock) as send:
+            self.assertRaises(FakeError, send, ['cmd1'])
+            # After a failure, each set of lines uses its own session.
+            self.assertEqual('out2', send(['cmd2']))
+        connection_mock.send_config_set.assert_called_with(
+            config_commands=['cmd2'], cmd_verify=False)
+        connection_mock.exit_config_mode.assert_called_once_with()
+
+    def test_config_session_exit_failure(self):
+        connection_mock = mock.MagicMock()
+        connection_mock.exit_config_mode.side_effect = Exception('Bang')
+        with self.switch.config_session(connection_mock) as send:
+            send(['cmd1'])
+        connection_mock.exit_config_mode.assert_called_once_with()
+
+    def test_config_session_driver_override(self):
+        class FakeSwitch(netmiko_devices.NetmikoSwitch):
+            def send_config_set(self, net_connect, cmd_set):
+                return 'fake output'
+
+        switch = FakeSwitch({'device_type': 'netmiko_base', 'ip': 'host'})
+        connection_mock = mock.MagicMock()
+        with switch.config_session(connection_mock) as send:
+            self.assertEqual('fake output', send(['cmd1']))
+        self.assertFalse(connection_mock.config_mode.called)
+        self.assertFalse(connection_mock.exit_config_mode.called)
+
+    def test_batch_single_session(self):
+        self.cfg.config(backend_url='url', group='ngs_coordination')
+        switch = self._make_switch_device({'ngs_batch_requests': True,
+                                           'ngs_batch_single_session': True})
+        self.assertTrue(switch.batch_cmds.single_session)
+
+    def test_batch_publish_each(self):
+        self.cfg.config(backend_url='url', group='ngs_coordination')
+        switch = self._make_switch_device({'ngs_batch_requests': True,
+                                           'ngs_batch_publish_each': True})
+        self.assertTrue(switch.batch_cmds.publish_each)
+
+    def test_batch_linger(self):
+        self.cfg.config(backend_url='url', group='ngs_coordination')
+        switch = self._make_switch_device({'ngs_batch_requests': True,
+                                           'ngs_batch_linger_ms': '50',
+                                           'ngs_batch_linger_batches': '20'})
+        self.assertEqual(0.05, switch.batch_cmds.linger.max_linger)
+        self.assertEqual(20, switch.batch_cmds.linger.max_batches)
+
+    def test_batch_executor(self):
+        self.cfg.config(backend_url='url', group='ngs_coordination')
+        switch = self._make_switch_device({'ngs_batch_requests': True,
+                                           'ngs_batch_executor': True,
+                                           'ngs_batch_max_backlog': '100'})
+        self.assertIsNotNone(switch.batch_cmds.executor)
+        self.assertEqual(100, switch.batch_cmds.max_backlog)
+
+    def test_batch_compact(self):
+        self.cfg.config(backend_url='url', group='ngs_coordination')
+        switch = self._make_switch_device({'ngs_batch_requests': True,
+                                           'ngs_batch_compact': True,
+                                           'ngs_batch_output_limit': '100'})
+        self.assertTrue(switch.batch_cmds.check_output)
+        self.assertTrue(switch.batch_cmds.queue.compact)
+        self.assertEqual(100, switch.batch_cmds.queue.output_limit)
+
+    def test_batch_priority(self):
+        self.cfg.config(backend_url='url', group='ngs_coordination')
+        switch = self._make_switch_device({'ngs_batch_requests': True,
+                                           'ngs_batch_priority': True})
+        self.assertTrue(switch.batch_cmds.priority)
+        self.assertEqual(16, switch.batch_cmds.priority_aging)
+
+    def test_batch_no_linger(self):
+        self.cfg.config(backend_url='url', group='ngs_coordination')
+        switch = self._make_switch_device({'ngs_batch_requests': True})
+        self.assertIsNone(switch.batch_cmds.linger)
+
+    @mock.patch.object(netmiko_devices.save_scheduler.SaveScheduler,
+                       'schedule', autospec=True)
+    @mock.patch.object(netmiko_devices.NetmikoSwitch, 'save_configuration')
+    @mock.patch.object(netmiko_devices.NetmikoSwitch, 'send_config_set')
+    @mock.patch.object(netmiko_devices.NetmikoSwitch, '_get_connection')
+    def test_send_commands_to_device_save_delayed(self, gc_mock, send_mock,
+                                                  save_mock, schedule_mock):
+        switch = self._make_switch_device({'ngs_save_delay': '5'})
+        self.assertEqual(5, switch.save_scheduler.delay)
+        self.assertEqual(60, switch.save_scheduler.max_wait)
+        send_mock.return_value = 'fake output'
+        result = switch.send_commands_to_device(['spam ham aaaa'])
+        self.assertEqual('fake output', result)
+        schedule_mock.assert_called_once_with(switch.save_scheduler)
+        self.assertFalse(save_mock.called)
+
+    def test_save_delay_without_save_configuration(self):
+        switch = self._make_switch_device({'ngs_save_delay': '5',
+                                           'ngs_save_configuration': False})
+        self.assertIsNone(switch.save_scheduler)
+
+    @mock.patch.object(netmiko_devices.netmiko, 'platforms', new=['base'])
+    def test_save_delay_save_configuration_overridden(self):
+        class CommitSwitch(netmiko_devices.NetmikoSwitch):
+            def save_configuration(self, net_connect):
+                net_connect.commit()
+
+        self.assertRaises(exc.GenericSwitchConfigValueInvalid,
+                          CommitSwitch, {'device_type': 'netmiko_base',
+                                         'ngs_save_delay': '5'})
+
+    @mock.patch.object(netmiko_devices.NetmikoSwitch, 'save_configuration')
+    @mock.patch.object(netmiko_devices.NetmikoSwitch, '_get_connection')
+    def test__save_configuration_now(self, gc_mock, save_mock):
+        connect_mock = mock.MagicMock()
+        gc_mock.return_value.__enter__.return_value = connect_mock
+        self.switch._save_configuration_now()
+        save_mock.assert_called_once_with(connect_mock)
+
+    @mock.patch.object(netmiko_devices.batching.SwitchBatch,
+                       'save_configuration', autospec=True)
+    @mock.patch.object(netmiko_devices.NetmikoSwitch, '_get_connection')
+    def test__save_configuration_now_batching(self, gc_mock, save_mock):
+        self.cfg.config(backend_url='url', group='ngs_coordination')
+        switch = self._make_switch_device({'ngs_batch_requests': True})
+        switch._save_configuration_now()
+        save_mock.assert_called_once_with(switch.batch_cmds, switch)
+        self.assertFalse(gc_mock.called)
+
     def test_save_configuration(self):
         connect_mock = mock.MagicMock(netmiko.base_connection.BaseConnection,
                                       autospec=True)
@@ -385,6 +717,7 @@ class TestNetmikoSwitch(NetmikoSwitchTestBase):
     @mock.patch.object(netmiko_devices.ngs_lock, 'PoolLock', autospec=True)
     @mock.patch.object(netmiko_devices.netmiko, 'ConnectHandler')
     @mock.patch.object(coordination, 'get_coordinator', autospec=True)
+    @mock.patch.dict(netmiko_devices.ngs_lock._COORDINATORS, clear=True)
     def test_switch_send_commands_with_coordinator(self, get_coord_mock,
                                                    nm_mock, lock_mock,
                                                    mock_hostname):
@@ -395,9 +728,15 @@ class TestNetmikoSwitch(NetmikoSwitchTestBase):
         mock_hostname.return_value = 'viking'
         switch = self._make_switch_device(
             extra_cfg={'ngs_max_connections': 2})
-        self.assertEqual(coord, switch.locker)
-        get_coord_mock.assert_called_once_with('mysql://localhost',
-                                               'ngs-viking'.encode('ascii'))
+        self.assertIsInstance(switch.locker,
+                              netmiko_devices.ngs_lock.SharedCoordinator)
+        self.assertEqual('mysql://localhost', switch.locker.backend_url)
+        self.assertEqual('ngs-viking'.encode('ascii'), switch.locker.member_id)
+        # The coordinator is shared between switches, and started lazily.
+        switch2 = self._make_switch_device(
+            extra_cfg={'ngs_max_connections': 2})
+        self.assertIs(switch.locker, switch2.locker)
+        self.assertFalse(get_coord_mock.called)
 
         connect_mock = mock.MagicMock(SAVE_CONFIGURATION=None)
         connect_mock.__enter__.return_value = connect_mock
@@ -405,12 +744,11 @@ class TestNetmikoSwitch(NetmikoSwitchTestBase):
         lock_mock.return_value.__enter__.return_value = lock_mock
         switch.send_commands_to_device(['spam ham'])
 
-        lock_mock.assert_called_once_with(coord, locks_pool_size=2,
+        lock_mock.assert_called_once_with(switch.locker, locks_pool_size=2,
                                           locks_prefix='host',
                                           timeout=120)
         lock_mock.return_value.__exit__.assert_called_once()
         lock_mock.return_value.__enter__.assert_called_once()
-        mock_hostname.assert_called_once()
 
     def test_check_output(self):
         self.switch.check_output('fake output', 'fake op')
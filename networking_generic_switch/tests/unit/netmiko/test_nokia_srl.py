@@ -14,7 +14,9 @@
 
 from unittest import mock
 
+from networking_generic_switch import connection_pool
 from networking_generic_switch.devices.netmiko_devices import nokia
+from networking_generic_switch import exceptions as exc
 from networking_generic_switch.tests.unit.netmiko import test_netmiko_base
 
 
@@ -75,6 +77,48 @@ class TestNetmikoNokiaSRL(test_netmiko_base.NetmikoSwitchTestBase):
             ['delete network-instance mac-vrf-33 interface 3333.33',
              'delete interface 3333 subinterface 33'])
 
+    @mock.patch.object(nokia.NokiaSRL, 'save_configuration', autospec=True)
+    @mock.patch.object(nokia.NokiaSRL, 'commit', autospec=True)
+    @mock.patch.object(nokia.NokiaSRL, 'send_config_set', autospec=True)
+    @mock.patch.object(nokia.NokiaSRL, '_get_connection', autospec=True)
+    def test_send_commands_to_device(self, m_gc, m_send, m_commit, m_save):
+        conn = m_gc.return_value.__enter__.return_value
+        m_send.return_value = 'output'
+        m_commit.return_value = ' committed'
+
+        result = self.switch.send_commands_to_device(['cmd1'])
+
+        self.assertEqual('output committed', result)
+        m_send.assert_called_once_with(self.switch, conn, ['cmd1'])
+        m_commit.assert_called_once_with(self.switch, conn)
+        m_save.assert_called_once_with(self.switch, conn)
+
+    @mock.patch.object(nokia.NokiaSRL, 'save_configuration', autospec=True)
+    @mock.patch.object(nokia.NokiaSRL, 'commit', autospec=True)
+    @mock.patch.object(nokia.NokiaSRL, 'send_config_set', autospec=True)
+    @mock.patch.object(nokia.NokiaSRL, '_get_connection', autospec=True)
+    def test_send_commands_to_device_reconnect(self, m_gc, m_send, m_commit,
+                                               m_save):
+        m_send.side_effect = [connection_pool.StaleConnection, 'output']
+        m_commit.return_value = ''
+
+        result = self.switch.send_commands_to_device(['cmd1'])
+
+        self.assertEqual('output', result)
+        self.assertEqual(2, m_gc.call_count)
+        self.assertEqual(2, m_send.call_count)
+        m_commit.assert_called_once_with(self.switch, mock.ANY)
+        m_save.assert_called_once_with(self.switch, mock.ANY)
+
+    @mock.patch.object(nokia.NokiaSRL, 'send_config_set', autospec=True)
+    @mock.patch.object(nokia.NokiaSRL, '_get_connection', autospec=True)
+    def test_send_commands_to_device_failure(self, m_gc, m_send):
+        m_send.side_effect = EOFError
+
+        self.assertRaises(exc.GenericSwitchNetmikoConnectError,
+                          self.switch.send_commands_to_device, ['cmd1'])
+        self.assertEqual(1, m_send.call_count)
+
     def test__format_commands(self):
         cmd_set = self.switch._format_commands(
             nokia.NokiaSRL.ADD_NETWORK,
@@ -12,9 +12,13 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import contextlib
+import threading
+import time
 from unittest import mock
 
 from etcd3gw.exceptions import Etcd3Exception
+from etcd3gw.utils import _decode
 from etcd3gw.utils import _encode
 from etcd3gw.utils import _increment_last_byte
 import fixtures
@@ -23,9 +27,30 @@ from oslo_utils import uuidutils
 import tenacity
 
 from networking_generic_switch import batching
+from networking_generic_switch import connection_pool
 from networking_generic_switch import exceptions as exc
 
 
+class EncodingTest(fixtures.TestWithFixtures):
+    def test_encode_value(self):
+        self.assertEqual(b'{"cmds": ["cmd1"], "uuid": "uuid"}',
+                         batching.encode_value({"uuid": "uuid",
+                                                "cmds": ["cmd1"]}))
+
+    def test_encode_value_compact(self):
+        value = {"result": "output " * 1000}
+        encoded = batching.encode_value(value, compact=True)
+        self.assertEqual(batching.COMPACT_FORMAT_V1, encoded[:1])
+        self.assertLess(len(encoded), len(batching.encode_value(value)))
+        self.assertEqual(value, batching.decode_value(encoded))
+
+    def test_decode_value(self):
+        self.assertEqual({"result": "output"},
+                         batching.decode_value(b'{"result": "output"}'))
+        self.assertEqual({"result": "output"},
+                         batching.decode_value('{"result": "output"}'))
+
+
 class SwitchQueueTest(fixtures.TestWithFixtures):
     def setUp(self):
         super(SwitchQueueTest, self).setUp()
@@ -35,6 +60,10 @@ class SwitchQueueTest(fixtures.TestWithFixtures):
         self.switch_name = "switch1"
         self.queue = batching.SwitchQueue(self.switch_name, self.client)
 
+        patcher = mock.patch.object(batching.etcd3gw_watch, "Watcher")
+        self.mock_watcher = patcher.start()
+        self.addCleanup(patcher.stop)
+
     @mock.patch.object(uuidutils, "generate_uuid")
     def test_add_batch(self, mock_uuid):
         mock_uuid.return_value = "uuid"
@@ -77,6 +106,50 @@ class SwitchQueueTest(fixtures.TestWithFixtures):
         }
         self.client.transaction.assert_called_once_with(expected_txn)
 
+    @mock.patch.object(uuidutils, "generate_uuid")
+    def test_add_batch_with_op(self, mock_uuid):
+        mock_uuid.return_value = "uuid"
+        self.client.transaction.return_value = {
+            "succeeded": True,
+            "responses": [{
+                "response_put": {
+                    "header": {
+                        "revision": 42
+                    }
+                }
+            }]
+        }
+
+        self.queue.add_batch(["cmd1"], op={"name": "add network", "vlan": 2})
+
+        expected_value = (
+            b'{"cmds": ["cmd1"], '
+            b'"input_key": "/ngs/batch/switch1/input/uuid", '
+            b'"op": {"name": "add network", "vlan": 2}, '
+            b'"result_key": "/ngs/batch/switch1/output/uuid", '
+            b'"uuid": "uuid"}')
+        txn = self.client.transaction.call_args[0][0]
+        self.assertEqual(_encode(expected_value),
+                         txn['success'][0]['request_put']['value'])
+
+    @mock.patch.object(uuidutils, "generate_uuid")
+    def test_add_batch_compact(self, mock_uuid):
+        mock_uuid.return_value = "uuid"
+        self.queue.compact = True
+        self.client.transaction.return_value = {
+            "succeeded": True,
+            "responses": [{"response_put": {"header": {"revision": 42}}}]
+        }
+
+        self.queue.add_batch(["cmd1"], op={"name": "add network", "vlan": 2})
+
+        txn = self.client.transaction.call_args[0][0]
+        value = _decode(txn['success'][0]['request_put']['value'])
+        self.assertEqual(batching.COMPACT_FORMAT_V1, value[:1])
+        self.assertEqual({"cmds": ["cmd1"],
+                          "op": {"name": "add network", "vlan": 2}},
+                         batching.decode_value(value))
+
     @mock.patch.object(uuidutils, "generate_uuid")
     def test_add_batch_failure(self, mock_uuid):
         mock_uuid.return_value = "uuid"
@@ -93,63 +166,48 @@ class SwitchQueueTest(fixtures.TestWithFixtures):
         self.assertRaises(exc.GenericSwitchBatchError,
                           self.queue.add_batch, ["cmd1", "cmd2"])
 
-    @mock.patch.object(batching.SwitchQueue, "_get_and_delete_result")
-    def test_wait_for_result(self, mock_get):
-        event = {
-            "kv": {
-                "version": 1
-            }
-        }
-        self.client.watch_once.return_value = event
-        mock_get.return_value = {"result": "result1"}
+    @mock.patch.object(batching, "get_result_watcher", autospec=True)
+    def test_wait_for_result(self, mock_get_watcher):
+        watcher = mock_get_watcher.return_value
+        watcher.wait.return_value = {"result": "result1"}
         item = batching.SwitchQueueItem("uuid", 42)
 
         result = self.queue.wait_for_result(item, 43)
 
         self.assertEqual("result1", result)
-        result_key = '/ngs/batch/switch1/output/uuid'
-        self.client.watch_once.assert_called_once_with(
-            result_key, timeout=43, start_revision=42)
-        mock_get.assert_called_once_with(result_key)
+        mock_get_watcher.assert_called_once_with("switch1", self.client)
+        watcher.wait.assert_called_once_with(
+            '/ngs/batch/switch1/output/uuid', 42, 43)
+
+    @mock.patch.object(batching, "get_result_watcher", autospec=True)
+    def test_wait_for_result_error(self, mock_get_watcher):
+        watcher = mock_get_watcher.return_value
+        watcher.wait.return_value = {"error": "Bang"}
+        item = batching.SwitchQueueItem("uuid", 42)
 
-    def test_get_and_delete_result(self):
-        self.client.transaction.return_value = {
-            "succeeded": True,
-            "responses": [{
-                "response_delete_range": {
-                    "prev_kvs": [{
-                        "value": _encode(b'{"foo": "bar"}')
-                    }]
-                }
-            }]
-        }
+        self.assertRaisesRegex(exc.GenericSwitchBatchError, "Bang",
+                               self.queue.wait_for_result, item, 43)
 
-        result = self.queue._get_and_delete_result(b"result_key")
+    def test_get_result_watcher(self):
+        with mock.patch.dict(batching._RESULT_WATCHERS, clear=True):
+            watcher1 = batching.get_result_watcher("switch1", self.client)
+            watcher2 = batching.get_result_watcher("switch1", mock.Mock())
+            watcher3 = batching.get_result_watcher("switch2", self.client)
 
-        self.assertEqual({"foo": "bar"}, result)
+        self.assertIs(watcher1, watcher2)
+        self.assertIsNot(watcher1, watcher3)
+        self.assertIs(self.client, watcher2.client)
+        self.assertEqual("/ngs/batch/switch1/output/", watcher1.prefix)
 
-        expected_txn = {
-            'compare': [],
-            'success': [{
-                'request_delete_range': {
-                    'key': _encode(b"result_key"),
-                    'prev_kv': True,
-                }
-            }],
-            'failure': []
-        }
-        self.client.transaction.assert_called_once_with(expected_txn)
-
-    def test_get_and_delete_result_failure(self):
-        self.client.transaction.return_value = {"succeeded": False}
-
-        self.assertRaises(exc.GenericSwitchBatchError,
-                          self.queue._get_and_delete_result, b"result_key")
+    def _kv(self, key, mod_revision, value=b''):
+        return (value, {"key": key.encode(), "mod_revision": str(mod_revision),
+                        "create_revision": str(mod_revision)})
 
     def test_get_batches(self):
-        self.client.get.return_value = [
-            (b'{"foo": "bar"}', {}),
-            (b'{"foo1": "bar1"}', {})
+        self.client.get.side_effect = [
+            [self._kv("/input/a", 10), self._kv("/input/b", 11)],
+            [self._kv("/input/a", 10, b'{"foo": "bar"}'),
+             self._kv("/input/b", 11, b'{"foo1": "bar1"}')],
         ]
 
         batches = self.queue.get_batches()
@@ -159,52 +217,185 @@ class SwitchQueueTest(fixtures.TestWithFixtures):
             {"foo1": "bar1"}
         ], batches)
         input_prefix = '/ngs/batch/switch1/input/'
-        self.client.get.assert_called_once_with(
-            input_prefix,
-            metadata=True,
-            range_end=_encode(_increment_last_byte(input_prefix)),
-            sort_order='ascend', sort_target='create',
-            max_create_revision=None)
+        range_end = _encode(_increment_last_byte(input_prefix))
+        self.client.get.assert_has_calls([
+            mock.call(input_prefix, metadata=True, range_end=range_end,
+                      sort_order='ascend', sort_target='create',
+                      max_create_revision=None, keys_only=True),
+            mock.call(input_prefix, metadata=True, range_end=range_end,
+                      sort_order='ascend', sort_target='create',
+                      max_create_revision=None, min_mod_revision=10),
+        ])
 
     def test_get_batches_with_item(self):
-        self.client.get.return_value = [
-            (b'{"foo": "bar"}', {}),
-            (b'{"foo1": "bar1"}', {})
+        self.client.get.side_effect = [
+            [self._kv("/input/a", 10)],
+            [self._kv("/input/a", 10, b'{"foo": "bar"}')],
         ]
         item = batching.SwitchQueueItem("uuid", 42)
 
         batches = self.queue.get_batches(item)
 
-        self.assertEqual([
-            {"foo": "bar"},
-            {"foo1": "bar1"}
-        ], batches)
+        self.assertEqual([{"foo": "bar"}], batches)
+        input_prefix = '/ngs/batch/switch1/input/'
+        range_end = _encode(_increment_last_byte(input_prefix))
+        self.client.get.assert_has_calls([
+            mock.call(input_prefix, metadata=True, range_end=range_end,
+                      sort_order='ascend', sort_target='create',
+                      max_create_revision=42, keys_only=True),
+            mock.call(input_prefix, metadata=True, range_end=range_end,
+                      sort_order='ascend', sort_target='create',
+                      max_create_revision=42, min_mod_revision=10),
+        ])
+
+    def test_get_batches_cached(self):
+        self.client.get.side_effect = [
+            [self._kv("/input/a", 10), self._kv("/input/b", 11)],
+            [self._kv("/input/a", 10, b'{"foo": "bar"}'),
+             self._kv("/input/b", 11, b'{"foo1": "bar1"}')],
+            # Batch a was executed, and batch c was added.
+            [self._kv("/input/b", 11), self._kv("/input/c", 15)],
+            [self._kv("/input/c", 15, b'{"foo2": "bar2"}')],
+            # No change.
+            [self._kv("/input/b", 11), self._kv("/input/c", 15)],
+        ]
+
+        self.queue.get_batches()
+        batches = self.queue.get_batches()
+
+        self.assertEqual([{"foo1": "bar1"}, {"foo2": "bar2"}], batches)
+        self.assertEqual(15, self.client.get.call_args[1]["min_mod_revision"])
+        self.assertEqual({b"/input/b", b"/input/c"},
+                         set(self.queue._batch_cache))
+
+        batches[0]["result"] = "output"
+        self.assertEqual([{"foo1": "bar1"}, {"foo2": "bar2"}],
+                         self.queue.get_batches())
+        self.assertEqual(5, self.client.get.call_count)
+
+    def test_get_batches_removed(self):
+        self.client.get.side_effect = [
+            [self._kv("/input/a", 10), self._kv("/input/b", 11)],
+            # Batch a was executed after the keys were read.
+            [self._kv("/input/b", 11, b'{"foo1": "bar1"}')],
+        ]
+
+        batches = self.queue.get_batches()
+
+        self.assertEqual([{"foo1": "bar1"}], batches)
+
+    def test_get_batches_empty(self):
+        self.client.get.return_value = []
+
+        self.assertEqual([], self.queue.get_batches())
+        self.assertEqual(1, self.client.get.call_count)
+
+    def test_get_batches_compact(self):
+        input_key = "/ngs/batch/switch1/input/uuid"
+        value = batching.encode_value({"cmds": ["cmd1"]}, compact=True)
+        self.client.get.side_effect = [
+            [self._kv(input_key, 10)],
+            [self._kv(input_key, 10, value)],
+        ]
+
+        batches = self.queue.get_batches()
+
+        self.assertEqual([{
+            "cmds": ["cmd1"],
+            "uuid": "uuid",
+            "input_key": input_key,
+            "result_key": "/ngs/batch/switch1/output/uuid",
+        }], batches)
+
+    def test_has_batches(self):
+        self.client.post.return_value = {"count": "2"}
+        item = batching.SwitchQueueItem("uuid", 42)
+
+        self.assertTrue(self.queue.has_batches(item))
+
         input_prefix = '/ngs/batch/switch1/input/'
-        self.client.get.assert_called_once_with(
-            input_prefix,
-            metadata=True,
-            range_end=_encode(_increment_last_byte(input_prefix)),
-            sort_order='ascend', sort_target='create',
-            max_create_revision=42)
-
-    def test_record_result(self):
+        self.client.post.assert_called_once_with(
+            self.client.get_url.return_value,
+            json={"key": _encode(input_prefix),
+                  "range_end": _encode(_increment_last_byte(input_prefix)),
+                  "count_only": True,
+                  "max_create_revision": 42})
+        self.client.get_url.assert_called_once_with("/kv/range")
+
+    def test_has_batches_empty(self):
+        # etcd omits zero values from responses.
+        self.client.post.return_value = {"header": {}}
+
+        self.assertFalse(self.queue.has_batches())
+
+        self.assertNotIn("max_create_revision",
+                         self.client.post.call_args[1]["json"])
+
+    def _make_lock(self):
+        return mock.Mock(key="/locks/lock", uuid="lock-uuid")
+
+    def test_record_results_compact(self):
         self.client.transaction.return_value = {"succeeded": True}
-        batch = {"result_key": "result1", "input_key": "input1",
-                 "result": "asdf"}
+        self.queue.compact = True
+        self.queue.output_limit = 4
+        batches = [
+            {"result_key": "result1", "input_key": "input1",
+             "cmds": ["cmd1"], "result": "output"},
+            {"result_key": "result2", "input_key": "input2",
+             "cmds": ["cmd2"], "error": "Bang"},
+            {"result_key": "result3", "input_key": "input3",
+             "cmds": ["cmd3"], "result": None},
+        ]
 
-        self.queue.record_result(batch)
+        self.queue.record_results(batches, self._make_lock())
 
-        self.client.lease.assert_called_once_with(ttl=600)
-        expected_value = (
+        txn = self.client.transaction.call_args[0][0]
+        values = [batching.decode_value(_decode(op['request_put']['value']))
+                  for op in txn['success'] if 'request_put' in op]
+        self.assertEqual([{"result": "outp"}, {"error": "Bang"},
+                          {"result": ""}], values)
+
+    def test_record_results_uncache(self):
+        self.client.transaction.return_value = {"succeeded": True}
+        self.queue._batch_cache = {b"input1": (10, {}), b"input2": (11, {})}
+        batches = [{"result_key": "result1", "input_key": "input1",
+                    "result": "asdf"}]
+
+        self.queue.record_results(batches, self._make_lock())
+
+        self.assertEqual({b"input2": (11, {})}, self.queue._batch_cache)
+
+    def test_record_results(self):
+        self.client.transaction.return_value = {"succeeded": True}
+        batches = [
+            {"result_key": "result1", "input_key": "input1",
+             "result": "asdf"},
+            {"result_key": "result2", "input_key": "input2",
+             "error": "Bang"},
+        ]
+
+        self.queue.record_results(batches, self._make_lock())
+
+        # The TTL is padded by the lease rotation interval.
+        self.client.lease.assert_called_once_with(ttl=660)
+        expected_value1 = (
             b'{"input_key": "input1", '
             b'"result": "asdf", "result_key": "result1"}')
+        expected_value2 = (
+            b'{"error": "Bang", "input_key": "input2", '
+            b'"result_key": "result2"}')
         expected_txn = {
-            'compare': [],
+            'compare': [{
+                'key': _encode("/locks/lock"),
+                'result': 'EQUAL',
+                'target': 'VALUE',
+                'value': _encode("lock-uuid"),
+            }],
             'success': [
                 {
                     'request_put': {
                         'key': _encode("result1"),
-                        'value': _encode(expected_value),
+                        'value': _encode(expected_value1),
                         'lease': mock.ANY,
                     }
                 },
@@ -212,23 +403,92 @@ class SwitchQueueTest(fixtures.TestWithFixtures):
                     'request_delete_range': {
                         'key': _encode("input1"),
                     }
+                },
+                {
+                    'request_put': {
+                        'key': _encode("result2"),
+                        'value': _encode(expected_value2),
+                        'lease': mock.ANY,
+                    }
+                },
+                {
+                    'request_delete_range': {
+                        'key': _encode("input2"),
+                    }
                 }
             ],
             'failure': []
         }
         self.client.transaction.assert_called_once_with(expected_txn)
 
-    def test_record_result_failure(self):
+    def test_record_results_chunked(self):
+        self.client.transaction.return_value = {"succeeded": True}
+        batches = [{"result_key": "result%d" % i, "input_key": "input%d" % i,
+                    "result": "asdf"} for i in range(65)]
+
+        self.queue.record_results(batches, self._make_lock())
+
+        self.assertEqual(2, self.client.transaction.call_count)
+        txns = [c[0][0] for c in self.client.transaction.call_args_list]
+        self.assertEqual(128, len(txns[0]['success']))
+        self.assertEqual(2, len(txns[1]['success']))
+        self.assertEqual(_encode("result64"),
+                         txns[1]['success'][0]['request_put']['key'])
+
+    def test_record_results_lease_shared(self):
+        self.client.transaction.return_value = {"succeeded": True}
+        batch = {"result_key": "result1", "input_key": "input1",
+                 "result": "asdf"}
+
+        self.queue.record_results([batch], self._make_lock())
+        self.queue.record_results([batch], self._make_lock())
+
+        self.client.lease.assert_called_once_with(ttl=660)
+        lease_id = self.client.lease.return_value.id
+        for call in self.client.transaction.call_args_list:
+            txn = call[0][0]
+            self.assertEqual(lease_id,
+                             txn['success'][0]['request_put']['lease'])
+
+    def test_record_results_lease_not_found(self):
+        self.client.transaction.side_effect = [
+            Etcd3Exception('{"error": "etcdserver: requested lease not '
+                           'found"}'),
+            {"succeeded": True},
+        ]
+        self.client.lease.side_effect = [mock.Mock(id=1), mock.Mock(id=2)]
+        batch = {"result_key": "result1", "input_key": "input1",
+                 "result": "asdf"}
+
+        self.queue.record_results([batch], self._make_lock())
+
+        self.assertEqual(2, self.client.lease.call_count)
+        txn = self.client.transaction.call_args[0][0]
+        self.assertEqual(2, txn['success'][0]['request_put']['lease'])
+        self.assertEqual(2, self.queue.leases.get_lease_id())
+
+    def test_record_results_etcd_error(self):
+        self.client.transaction.side_effect = Etcd3Exception("Bang")
+        batch = {"result_key": "result1", "input_key": "input1",
+                 "result": "asdf"}
+
+        self.assertRaises(Etcd3Exception, self.queue.record_results,
+                          [batch], self._make_lock())
+        self.assertEqual(1, self.client.transaction.call_count)
+
+    def test_record_results_lock_lost(self):
         self.client.transaction.return_value = {"succeeded": False}
         batch = {"result_key": "result1", "input_key": "input1",
                  "result": "asdf"}
 
-        # Should not raise an exception.
-        self.queue.record_result(batch)
+        self.assertRaisesRegex(exc.GenericSwitchBatchError,
+                               "lock timed out",
+                               self.queue.record_results,
+                               [batch], self._make_lock())
 
-    @mock.patch.object(batching.SwitchQueue, "_get_raw_batches")
-    def test_acquire_worker_lock_timeout(self, mock_get):
-        mock_get.return_value = ["work"]
+    @mock.patch.object(batching.SwitchQueue, "_count_batches")
+    def test_acquire_worker_lock_timeout(self, mock_count):
+        mock_count.return_value = 1
         lock = mock.MagicMock()
         lock.acquire.return_value = False
         self.client.lock.return_value = lock
@@ -240,9 +500,9 @@ class SwitchQueueTest(fixtures.TestWithFixtures):
             self.queue.acquire_worker_lock,
             item, wait=wait, acquire_timeout=0.05)
 
-    @mock.patch.object(batching.SwitchQueue, "_get_raw_batches")
-    def test_acquire_worker_lock_no_work(self, mock_get):
-        mock_get.side_effect = [["work"], None]
+    @mock.patch.object(batching.SwitchQueue, "_count_batches")
+    def test_acquire_worker_lock_no_work(self, mock_count):
+        mock_count.side_effect = [1, 0]
         lock = mock.MagicMock()
         lock.acquire.return_value = False
         self.client.lock.return_value = lock
@@ -253,12 +513,12 @@ class SwitchQueueTest(fixtures.TestWithFixtures):
             item, wait=wait, acquire_timeout=0.05)
 
         self.assertIsNone(result)
-        self.assertEqual(2, mock_get.call_count)
+        self.assertEqual(2, mock_count.call_count)
         self.assertEqual(2, lock.acquire.call_count)
 
-    @mock.patch.object(batching.SwitchQueue, "_get_raw_batches")
-    def test_acquire_worker_lock_success(self, mock_get):
-        mock_get.return_value = ["work"]
+    @mock.patch.object(batching.SwitchQueue, "_count_batches")
+    def test_acquire_worker_lock_success(self, mock_count):
+        mock_count.return_value = 1
         lock = mock.MagicMock()
         lock.acquire.side_effect = [False, False, True]
         self.client.lock.return_value = lock
@@ -269,9 +529,725 @@ class SwitchQueueTest(fixtures.TestWithFixtures):
             item, wait=wait, acquire_timeout=0.05)
 
         self.assertEqual(lock, result)
-        self.assertEqual(2, mock_get.call_count)
+        self.assertEqual(2, mock_count.call_count)
         self.assertEqual(3, lock.acquire.call_count)
 
+    def _watch_callbacks(self):
+        return {c[0][1]: c[0][2] for c in self.mock_watcher.call_args_list}
+
+    @mock.patch.object(batching.SwitchQueue, "_count_batches")
+    def test_acquire_worker_lock_lock_released(self, mock_count):
+        lock = mock.MagicMock()
+        lock.key = "/locks/lock"
+        lock.acquire.side_effect = [False, True]
+        self.client.lock.return_value = lock
+        item = batching.SwitchQueueItem("uuid", 42)
+
+        # The lock is released while the worker is waiting.
+        def count_batches(revision):
+            self._watch_callbacks()["/locks/lock"]({"type": "DELETE"})
+            return 1
+
+        mock_count.side_effect = count_batches
+
+        result = self.queue.acquire_worker_lock(
+            item, wait=tenacity.wait_fixed(60), acquire_timeout=30)
+
+        self.assertEqual(lock, result)
+        self.assertEqual(2, lock.acquire.call_count)
+        mock_count.assert_called_once_with(42)
+        input_key = "/ngs/batch/switch1/input/uuid"
+        self.mock_watcher.assert_has_calls([
+            mock.call(self.client, "/locks/lock", mock.ANY,
+                      start_revision=42, filters=["NOPUT"]),
+            mock.call(self.client, input_key, mock.ANY,
+                      start_revision=42, filters=["NOPUT"]),
+        ], any_order=True)
+        self.assertEqual(2, self.mock_watcher.return_value.stop.call_count)
+
+    @mock.patch.object(batching.SwitchQueue, "_count_batches")
+    def test_acquire_worker_lock_batch_executed(self, mock_count):
+        lock = mock.MagicMock()
+        lock.key = "/locks/lock"
+        lock.acquire.return_value = False
+        self.client.lock.return_value = lock
+        item = batching.SwitchQueueItem("uuid", 42)
+
+        # Our batch is executed by another worker while we are waiting.
+        def count_batches(revision):
+            input_key = "/ngs/batch/switch1/input/uuid"
+            self._watch_callbacks()[input_key]({"type": "DELETE"})
+            return 1
+
+        mock_count.side_effect = count_batches
+
+        result = self.queue.acquire_worker_lock(
+            item, wait=tenacity.wait_fixed(60), acquire_timeout=30)
+
+        self.assertIsNone(result)
+        self.assertEqual(1, lock.acquire.call_count)
+        self.assertEqual(2, self.mock_watcher.return_value.stop.call_count)
+
+    def test_acquire_worker_lock_first_attempt(self):
+        lock = mock.MagicMock()
+        lock.acquire.return_value = True
+        self.client.lock.return_value = lock
+        item = batching.SwitchQueueItem("uuid", 42)
+
+        result = self.queue.acquire_worker_lock(item)
+
+        self.assertEqual(lock, result)
+        self.assertFalse(self.mock_watcher.called)
+
+    def test_acquire_lock(self):
+        lock = mock.MagicMock()
+        lock.acquire.side_effect = [False, True]
+        self.client.lock.return_value = lock
+
+        result = self.queue.acquire_lock(wait=tenacity.wait_none())
+
+        self.assertEqual(lock, result)
+        self.assertEqual(2, lock.acquire.call_count)
+        self.client.lock.assert_called_once_with(
+            "/ngs/batch/switch1/execute_lock", 120)
+
+    def test_acquire_lock_timeout(self):
+        lock = mock.MagicMock()
+        lock.acquire.return_value = False
+        self.client.lock.return_value = lock
+
+        self.assertRaisesRegex(exc.GenericSwitchBatchError,
+                               "Timed out waiting for lock",
+                               self.queue.acquire_lock,
+                               wait=tenacity.wait_none(),
+                               acquire_timeout=0.05)
+
+    def test_delete_watch_start_failure(self):
+        self.mock_watcher.side_effect = [Exception("Bang"), mock.Mock()]
+        watch = batching.DeleteWatch(self.client)
+
+        watch.start(["key1", "key2"], 42)
+
+        self.assertTrue(watch.started)
+        self.assertEqual(1, len(watch._watchers))
+        watch.stop()
+        self.assertEqual([], watch._watchers)
+
+
+class QueueJanitorTest(fixtures.TestWithFixtures):
+    def setUp(self):
+        super(QueueJanitorTest, self).setUp()
+        self.client = mock.Mock()
+        self.queue = batching.SwitchQueue("switch1", self.client)
+        self.janitor = batching.QueueJanitor(self.queue, 60, input_age=300,
+                                             result_age=60)
+        self.input_prefix = "/ngs/batch/switch1/input/"
+        self.result_prefix = "/ngs/batch/switch1/output/"
+
+    def _kv(self, key, mod_revision):
+        return (b"", {"key": key.encode(), "mod_revision": str(mod_revision)})
+
+    def _set_keys(self, inputs, results):
+        def get(key, **kwargs):
+            if key == self.input_prefix:
+                return [self._kv(k, r) for k, r in inputs]
+            return [self._kv(k, r) for k, r in results]
+        self.client.get.side_effect = get
+
+    def _deleted_keys(self):
+        return [_decode(op['request_delete_range']['key'])
+                for call in self.client.transaction.call_args_list
+                for op in call[0][0]['success']]
+
+    @mock.patch.object(batching.time, "monotonic", autospec=True)
+    def test_run_once(self, mock_time):
+        self._set_keys([(self.input_prefix + "a", 10),
+                        (self.input_prefix + "b", 11)],
+                       [(self.result_prefix + "c", 12)])
+        mock_time.return_value = 1000
+        self.janitor.run_once()
+
+        self.assertFalse(self.client.transaction.called)
+        self.assertEqual({'queue_depth': 2, 'results': 1,
+                          'orphaned_inputs': 0, 'orphaned_results': 0},
+                         self.janitor.stats)
+        self.client.get.assert_any_call(
+            self.input_prefix, metadata=True,
+            range_end=_encode(_increment_last_byte(self.input_prefix)),
+            keys_only=True)
+
+        # Input b was replaced, and result d was written.
+        self._set_keys([(self.input_prefix + "a", 10),
+                        (self.input_prefix + "b", 15)],
+                       [(self.result_prefix + "c", 12),
+                        (self.result_prefix + "d", 16)])
+        self.queue._batch_cache[(self.input_prefix + "a").encode()] = (10, {})
+        mock_time.return_value = 1300
+        self.janitor.run_once()
+
+        self.assertEqual([(self.input_prefix + "a").encode(),
+                          (self.result_prefix + "c").encode()],
+                         self._deleted_keys())
+        self.assertEqual({'queue_depth': 1, 'results': 1,
+                          'orphaned_inputs': 1, 'orphaned_results': 1},
+                         self.janitor.stats)
+        self.assertEqual({}, self.queue._batch_cache)
+
+    @mock.patch.object(batching.time, "monotonic", autospec=True)
+    def test_run_once_chunked(self, mock_time):
+        results = [(self.result_prefix + str(i), i) for i in range(130)]
+        self._set_keys([], results)
+        mock_time.return_value = 1000
+        self.janitor.run_once()
+        mock_time.return_value = 1060
+        self.janitor.run_once()
+
+        self.assertEqual(2, self.client.transaction.call_count)
+        self.assertEqual(130, len(self._deleted_keys()))
+        self.assertEqual(130, self.janitor.stats['orphaned_results'])
+
+    @mock.patch.object(batching.eventlet, "sleep", autospec=True)
+    def test_run(self, mock_sleep):
+        class Stop(Exception):
+            pass
+
+        mock_sleep.side_effect = [None, None, Stop()]
+        with mock.patch.object(self.janitor, "run_once",
+                               side_effect=[Etcd3Exception("Bang"), None]):
+            self.assertRaises(Stop, self.janitor._run)
+            self.assertEqual(2, self.janitor.run_once.call_count)
+        mock_sleep.assert_called_with(60)
+
+    @mock.patch.object(batching.eventlet, "spawn", autospec=True)
+    def test_start_stop(self, mock_spawn):
+        self.janitor.start()
+        self.janitor.start()
+        mock_spawn.assert_called_once_with(self.janitor._run)
+        self.janitor.stop()
+        mock_spawn.return_value.kill.assert_called_once_with()
+
+
+@mock.patch.object(batching.time, "monotonic", autospec=True)
+class LeaseManagerTest(fixtures.TestWithFixtures):
+    def setUp(self):
+        super(LeaseManagerTest, self).setUp()
+        self.client = mock.Mock()
+        self.client.lease.side_effect = [mock.Mock(id=1), mock.Mock(id=2)]
+        self.leases = batching.LeaseManager(self.client, 600,
+                                            rotation_interval=60)
+
+    def test_get_lease_id(self, mock_time):
+        mock_time.return_value = 100
+        self.assertEqual(1, self.leases.get_lease_id())
+        mock_time.return_value = 159
+        self.assertEqual(1, self.leases.get_lease_id())
+        self.client.lease.assert_called_once_with(ttl=660)
+
+    def test_get_lease_id_rotated(self, mock_time):
+        mock_time.return_value = 100
+        self.assertEqual(1, self.leases.get_lease_id())
+        mock_time.return_value = 160
+        self.assertEqual(2, self.leases.get_lease_id())
+        mock_time.return_value = 200
+        self.assertEqual(2, self.leases.get_lease_id())
+        self.assertEqual(2, self.client.lease.call_count)
+
+    def test_invalidate(self, mock_time):
+        mock_time.return_value = 100
+        self.assertEqual(1, self.leases.get_lease_id())
+        self.leases.invalidate(3)
+        self.assertEqual(1, self.leases.get_lease_id())
+        self.leases.invalidate(1)
+        self.assertEqual(2, self.leases.get_lease_id())
+
+
+class LockHeartbeatTest(fixtures.TestWithFixtures):
+    def setUp(self):
+        super(LockHeartbeatTest, self).setUp()
+        self.lock = mock.Mock(key="/locks/lock")
+        self.heartbeat = batching.LockHeartbeat(self.lock, interval=10)
+
+    def test_beat(self):
+        self.lock.refresh.return_value = 120
+        self.heartbeat.beat()
+        self.lock.refresh.assert_called_once_with()
+        self.assertFalse(self.heartbeat.lost)
+
+    def test_beat_expired(self):
+        self.lock.refresh.return_value = -1
+        self.heartbeat.beat()
+        self.assertTrue(self.heartbeat.lost)
+
+    def test_beat_failure(self):
+        self.lock.refresh.side_effect = Etcd3Exception("Bang")
+        self.heartbeat.beat()
+        self.assertFalse(self.heartbeat.lost)
+
+    @mock.patch.object(batching.eventlet, "sleep", autospec=True)
+    def test_run(self, mock_sleep):
+        self.lock.refresh.side_effect = [120, 120, -1]
+        self.heartbeat._run()
+        self.assertEqual(3, self.lock.refresh.call_count)
+        mock_sleep.assert_called_with(10)
+        self.assertTrue(self.heartbeat.lost)
+
+    @mock.patch.object(batching.eventlet, "spawn", autospec=True)
+    def test_context_manager(self, mock_spawn):
+        with self.heartbeat as heartbeat:
+            self.assertIs(self.heartbeat, heartbeat)
+            mock_spawn.assert_called_once_with(self.heartbeat._run)
+        mock_spawn.return_value.kill.assert_called_once_with()
+
+
+class ResultWatcherTest(fixtures.TestWithFixtures):
+    def setUp(self):
+        super(ResultWatcherTest, self).setUp()
+        self.client = mock.Mock()
+        self.client.get.return_value = []
+        self.cancel = mock.Mock()
+        self.watcher = batching.ResultWatcher("switch1", self.client)
+        self.key = "/ngs/batch/switch1/output/uuid"
+
+        # Run background work in real threads, and wait for it to finish.
+        self.threads = []
+
+        def spawn(func, *args):
+            thread = threading.Thread(target=func, args=args)
+            self.threads.append(thread)
+            thread.start()
+
+        patcher = mock.patch.object(batching.eventlet, "spawn",
+                                    side_effect=spawn)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _join(self):
+        while self.threads:
+            self.threads.pop(0).join()
+
+    def _watch(self, events):
+        self.client.watch_prefix.return_value = (iter(events), self.cancel)
+
+    def test_wait(self):
+        self._watch([
+            {"kv": {"key": b"/ngs/batch/switch1/output/other",
+                    "value": b'{"result": "other"}'}},
+            {"kv": {"key": self.key.encode(),
+                    "value": b'{"result": "output"}'}},
+        ])
+
+        result = self.watcher.wait(self.key, 42, 300)
+        self._join()
+
+        self.assertEqual({"result": "output"}, result)
+        self.client.watch_prefix.assert_called_once_with(
+            "/ngs/batch/switch1/output/", start_revision=42)
+        self.cancel.assert_called_once_with()
+        self.assertIsNone(self.watcher._cancel)
+        self.assertFalse(self.client.get.called)
+        # Only our result key is deleted.
+        self.client.transaction.assert_called_once_with({
+            'compare': [],
+            'success': [{'request_delete_range': {'key': _encode(self.key)}}],
+            'failure': []
+        })
+
+    def test_wait_deleted(self):
+        self._watch([{"type": "DELETE", "kv": {"key": self.key.encode()}}])
+
+        self.assertRaisesRegex(exc.GenericSwitchBatchError,
+                               "Output key was deleted",
+                               self.watcher.wait, self.key, 42, 300)
+        self._join()
+        self.assertFalse(self.client.transaction.called)
+
+    @mock.patch.object(batching, "RESULT_POLL_INTERVAL", 0.01)
+    def test_wait_timeout(self):
+        self._watch([])
+
+        self.assertRaisesRegex(exc.GenericSwitchBatchError,
+                               "Timed out waiting for result key",
+                               self.watcher.wait, self.key, 42, 0.05)
+        self._join()
+        self.client.get.assert_called_with(self.key)
+        self.assertEqual({}, self.watcher._waiters)
+
+    @mock.patch.object(batching, "RESULT_POLL_INTERVAL", 0.01)
+    def test_wait_poll(self):
+        self._watch([])
+        self.client.get.side_effect = [[], [b'{"result": "output"}']]
+
+        result = self.watcher.wait(self.key, 42, 300)
+        self._join()
+
+        self.assertEqual({"result": "output"}, result)
+        self.assertEqual(2, self.client.get.call_count)
+        # The watch missed the result, so is stopped.
+        self.cancel.assert_called_once_with()
+        self.assertIsNone(self.watcher._cancel)
+        self.assertEqual(1, self.client.transaction.call_count)
+
+    def test_wait_watch_failure(self):
+        self.client.watch_prefix.side_effect = Exception("Bang")
+        self.client.get.return_value = [b'{"result": "output"}']
+
+        result = self.watcher.wait(self.key, 42, 300)
+        self._join()
+
+        self.assertEqual({"result": "output"}, result)
+        self.assertIsNone(self.watcher._cancel)
+
+    def test_wait_watch_started_later(self):
+        # A watch started after our batch was added.
+        self.watcher._cancel = self.cancel
+        self.watcher._start_revision = 50
+        self.client.get.return_value = [b'{"result": "output"}']
+
+        result = self.watcher.wait(self.key, 42, 300)
+        self._join()
+
+        self.assertEqual({"result": "output"}, result)
+        self.assertFalse(self.client.watch_prefix.called)
+        self.client.get.assert_called_once_with(self.key)
+
+    @mock.patch.object(batching.eventlet, "sleep", autospec=True)
+    def test_delete_consumed(self, mock_sleep):
+        keys = ["key%d" % i for i in range(130)]
+        self.watcher._consumed = list(keys)
+
+        self.watcher._delete_consumed()
+
+        self.assertEqual(2, self.client.transaction.call_count)
+        txns = [c[0][0] for c in self.client.transaction.call_args_list]
+        self.assertEqual(128, len(txns[0]['success']))
+        self.assertEqual(
+            [{'request_delete_range': {'key': _encode(key)}}
+             for key in keys[128:]],
+            txns[1]['success'])
+        self.assertIsNone(self.watcher._deleter)
+
+
+class ShutdownTest(fixtures.TestWithFixtures):
+
+    @mock.patch.object(batching.save_scheduler.eventlet, "spawn",
+                       autospec=True)
+    @mock.patch.object(batching, "_wait_for_threads", autospec=True)
+    def test_shutdown_saves_after_workers(self, mock_wait, mock_spawn):
+        save = mock.Mock()
+        scheduler = batching.save_scheduler.SaveScheduler(
+            save, delay=10, max_wait=30)
+        # A worker completing during shutdown schedules a save, whose
+        # background thread does not get to run.
+        mock_wait.side_effect = scheduler.schedule
+
+        batching._shutdown()
+
+        mock_wait.assert_called_once_with()
+        save.assert_called_once_with()
+        self.assertFalse(scheduler.pending)
+
+
+@mock.patch.dict(batching._ETCD_CLIENTS, clear=True)
+@mock.patch.object(batching.etcd3gw, 'client', autospec=True)
+class GetEtcdClientTest(fixtures.TestWithFixtures):
+    def test_get_etcd_client(self, mock_client):
+        client = batching.get_etcd_client(
+            'etcd3+https://etcd.example.com:2379?ca_cert=/ca.pem'
+            '&cert_key=/key.pem&cert_cert=/cert.pem&api_version=v3')
+        self.assertIs(mock_client.return_value, client)
+        mock_client.assert_called_once_with(
+            host='etcd.example.com', port=2379, protocol='https',
+            ca_cert='/ca.pem', cert_key='/key.pem', cert_cert='/cert.pem',
+            api_path='/v3/', timeout=30)
+        (http, http_adapter), (https, https_adapter) = [
+            call[0] for call in client.session.mount.call_args_list]
+        self.assertEqual(('http://', 'https://'), (http, https))
+        self.assertIs(http_adapter, https_adapter)
+        self.assertEqual(batching.ETCD_POOL_SIZE, http_adapter._pool_maxsize)
+
+    def test_get_etcd_client_defaults(self, mock_client):
+        batching.get_etcd_client('etcd3+http://etcd.example.com:2379')
+        mock_client.assert_called_once_with(
+            host='etcd.example.com', port=2379, protocol='http',
+            ca_cert=None, cert_key=None, cert_cert=None,
+            api_path='/v3alpha/', timeout=30)
+
+    def test_get_etcd_client_shared(self, mock_client):
+        mock_client.side_effect = [mock.Mock(), mock.Mock()]
+        url = 'etcd3+http://etcd.example.com:2379'
+        client = batching.get_etcd_client(url)
+        self.assertIs(client, batching.get_etcd_client(url))
+        self.assertIsNot(client, batching.get_etcd_client(
+            'etcd3+http://etcd2.example.com:2379'))
+        self.assertEqual(2, mock_client.call_count)
+
+    def test_get_etcd_client_credentials(self, mock_client):
+        mock_client.side_effect = [mock.Mock(), mock.Mock()]
+        url = 'etcd3+https://etcd.example.com:2379?ca_cert=/ca.pem'
+        client = batching.get_etcd_client(url)
+        self.assertIsNot(client, batching.get_etcd_client(
+            url + '&cert_key=/key.pem&cert_cert=/cert.pem'))
+        self.assertEqual(2, mock_client.call_count)
+
+
+class BatchLingerTest(fixtures.TestWithFixtures):
+    def setUp(self):
+        super(BatchLingerTest, self).setUp()
+        self.linger = batching.BatchLinger(0.08, max_batches=3)
+
+    def test_wait_no_arrivals(self):
+        self.linger.wait()
+        self.assertEqual(0.04, self.linger.window)
+        for _ in range(5):
+            self.linger.wait()
+        self.assertEqual(0.01, self.linger.window)
+
+    def test_wait_arrivals(self):
+        self.linger.window = 0.02
+        timer = threading.Timer(0.001, self.linger.arrived)
+        timer.start()
+        self.linger.wait()
+        timer.join()
+        self.assertEqual(0.04, self.linger.window)
+
+    def test_wait_full(self):
+        for _ in range(3):
+            self.linger.arrived()
+        self.linger.window = 10
+        start = time.monotonic()
+        self.linger.wait()
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(0.08, self.linger.window)
+
+    def test_wait_woken_when_full(self):
+        self.linger.window = 10
+        self.linger.arrived()
+        timer = threading.Timer(0.001, lambda: [self.linger.arrived(),
+                                                self.linger.arrived()])
+        start = time.monotonic()
+        timer.start()
+        self.linger.wait()
+        timer.join()
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_taken(self):
+        for _ in range(3):
+            self.linger.arrived()
+        self.linger.taken()
+        self.assertFalse(self.linger._full())
+
+    def test_no_max_batches(self):
+        linger = batching.BatchLinger(0.01)
+        for _ in range(10):
+            linger.arrived()
+        self.assertFalse(linger._full())
+
+
+class MemorySwitchQueueTest(fixtures.TestWithFixtures):
+    def setUp(self):
+        super(MemorySwitchQueueTest, self).setUp()
+        self.queue = batching.MemorySwitchQueue("switch1")
+
+    def test_add_batch(self):
+        item1 = self.queue.add_batch(["cmd1"])
+        item2 = self.queue.add_batch(["cmd2"], op={"name": "add network"})
+        self.assertLess(item1.create_revision, item2.create_revision)
+        self.assertEqual([
+            {"uuid": item1.uuid, "cmds": ["cmd1"]},
+            {"uuid": item2.uuid, "cmds": ["cmd2"],
+             "op": {"name": "add network"}},
+        ], self.queue.get_batches())
+
+    def test_get_batches_item(self):
+        item1 = self.queue.add_batch(["cmd1"])
+        self.queue.add_batch(["cmd2"])
+        self.assertEqual([{"uuid": item1.uuid, "cmds": ["cmd1"]}],
+                         self.queue.get_batches(item1))
+
+    def test_has_batches(self):
+        self.assertFalse(self.queue.has_batches())
+        item1 = self.queue.add_batch(["cmd1"])
+        self.assertTrue(self.queue.has_batches())
+        self.assertTrue(self.queue.has_batches(item1))
+        self.assertFalse(self.queue.has_batches(
+            batching.SwitchQueueItem("uuid", 0)))
+
+    def test_get_batches_copy(self):
+        self.queue.add_batch(["cmd1"])
+        self.queue.get_batches()[0]["result"] = "output"
+        self.assertNotIn("result", self.queue.get_batches()[0])
+
+    def test_record_results(self):
+        item1 = self.queue.add_batch(["cmd1"])
+        item2 = self.queue.add_batch(["cmd2"])
+        lock = self.queue.acquire_worker_lock(item1)
+        batches = self.queue.get_batches()
+        batches[0]["result"] = "output"
+        batches[1]["error"] = "Bang"
+
+        self.queue.record_results(batches, lock)
+
+        self.assertEqual([], self.queue.get_batches())
+        self.assertEqual("output", self.queue.wait_for_result(item1, 1))
+        self.assertRaisesRegex(exc.GenericSwitchBatchError, "Bang",
+                               self.queue.wait_for_result, item2, 1)
+        self.assertEqual({}, self.queue._futures)
+
+    def test_record_results_lock_lost(self):
+        item = self.queue.add_batch(["cmd1"])
+        lock = self.queue.acquire_worker_lock(item)
+        lock.release()
+        batches = self.queue.get_batches()
+        batches[0]["result"] = "output"
+        self.assertRaisesRegex(exc.GenericSwitchBatchError, "lock timed out",
+                               self.queue.record_results, batches, lock)
+        self.assertEqual(1, len(self.queue.get_batches()))
+
+    def test_wait_for_result_timeout(self):
+        item = self.queue.add_batch(["cmd1"])
+        self.assertRaisesRegex(exc.GenericSwitchBatchError, "Timed out",
+                               self.queue.wait_for_result, item, 0)
+        self.assertEqual({}, self.queue._futures)
+
+    def test_acquire_worker_lock(self):
+        item = self.queue.add_batch(["cmd1"])
+        lock = self.queue.acquire_worker_lock(item)
+        self.assertTrue(lock.is_acquired())
+        self.assertEqual(120, lock.refresh())
+        self.assertEqual("/ngs/batch/switch1/execute_lock", lock.key)
+        self.assertTrue(lock.release())
+        self.assertFalse(lock.is_acquired())
+        self.assertEqual(-1, lock.refresh())
+        self.assertFalse(lock.release())
+
+    def test_acquire_worker_lock_no_work(self):
+        item = self.queue.add_batch(["cmd1"])
+        lock = self.queue.acquire_worker_lock(item)
+        batches = self.queue.get_batches()
+        batches[0]["result"] = "output"
+        self.queue.record_results(batches, lock)
+        self.assertIsNone(self.queue.acquire_worker_lock(item))
+
+    def test_acquire_worker_lock_timeout(self):
+        item = self.queue.add_batch(["cmd1"])
+        lock = self.queue.acquire_worker_lock(item)
+        self.assertRaisesRegex(exc.GenericSwitchBatchError,
+                               "Timed out waiting for lock",
+                               self.queue.acquire_worker_lock, item,
+                               acquire_timeout=0)
+        self.assertTrue(lock.is_acquired())
+
+    def test_acquire_worker_lock_released(self):
+        item = self.queue.add_batch(["cmd1"])
+        lock = self.queue.acquire_worker_lock(item)
+        locks = []
+        waiter = threading.Thread(
+            target=lambda: locks.append(self.queue.acquire_worker_lock(item)))
+        waiter.start()
+        lock.release()
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.assertTrue(locks[0].is_acquired())
+
+    def test_acquire_lock(self):
+        # The lock is acquired even though no batches are queued.
+        lock = self.queue.acquire_lock()
+        self.assertTrue(lock.is_acquired())
+        self.assertRaisesRegex(exc.GenericSwitchBatchError,
+                               "Timed out waiting for lock",
+                               self.queue.acquire_lock, acquire_timeout=0)
+        lock.release()
+        self.assertTrue(self.queue.acquire_lock().is_acquired())
+
+    @mock.patch.dict(batching._MEMORY_QUEUES, clear=True)
+    def test_get_memory_queue(self):
+        queue = batching.get_memory_queue("switch1")
+        self.assertIsInstance(queue, batching.MemorySwitchQueue)
+        self.assertIs(queue, batching.get_memory_queue("switch1"))
+        self.assertIsNot(queue, batching.get_memory_queue("switch2"))
+
+    @mock.patch.object(batching, "LockHeartbeat", autospec=True)
+    def test_execute_pending_batches(self, mock_heartbeat):
+        mock_heartbeat.return_value.__enter__.return_value.lost = False
+        batch = batching.SwitchBatch("switch1", switch_queue=self.queue)
+        device = mock.MagicMock(save_scheduler=None)
+        device.send_config_set.side_effect = ["output1", "output2"]
+        item1 = self.queue.add_batch(["cmd1"])
+        item2 = self.queue.add_batch(["cmd2"])
+
+        batch._execute_pending_batches(device, item1)
+
+        self.assertEqual("output1", self.queue.wait_for_result(item1, 1))
+        self.assertEqual("output2", self.queue.wait_for_result(item2, 1))
+        self.assertIsNone(self.queue._lock_owner)
+
+
+@mock.patch.object(batching, "_get_executor_pool", autospec=True)
+class SwitchExecutorTest(fixtures.TestWithFixtures):
+    def setUp(self):
+        super(SwitchExecutorTest, self).setUp()
+        self.batch = mock.Mock(switch_name="switch1", linger=None)
+        self.executor = batching.SwitchExecutor(self.batch)
+
+    def test_submit(self, mock_pool):
+        item1 = batching.SwitchQueueItem("uuid1", "9")
+        item2 = batching.SwitchQueueItem("uuid2", "10")
+
+        self.executor.submit("device", item1)
+        self.executor.submit("device", item2)
+        # Requests may be submitted out of order.
+        self.executor.submit("device", item1)
+
+        mock_pool.return_value.spawn_n.assert_called_once_with(
+            self.executor._run)
+        self.assertEqual(("device", item2), self.executor._work)
+
+    def test_run(self, mock_pool):
+        item1 = batching.SwitchQueueItem("uuid1", 1)
+        item2 = batching.SwitchQueueItem("uuid2", 2)
+
+        # A request is submitted while batches are being executed.
+        def execute(device, item):
+            if item is item1:
+                self.executor.submit("device", item2)
+
+        self.batch._execute_pending_batches.side_effect = execute
+        self.executor.submit("device", item1)
+
+        self.executor._run()
+
+        self.batch._execute_pending_batches.assert_has_calls([
+            mock.call("device", item1), mock.call("device", item2)])
+        self.assertFalse(self.executor._running)
+        self.assertIsNone(self.executor._work)
+        self.assertEqual(1, mock_pool.return_value.spawn_n.call_count)
+
+    def test_run_failure(self, mock_pool):
+        item1 = batching.SwitchQueueItem("uuid1", 1)
+        item2 = batching.SwitchQueueItem("uuid2", 2)
+
+        def execute(device, item):
+            if item is item1:
+                self.executor.submit("device", item2)
+                raise Exception("Bang")
+
+        self.batch._execute_pending_batches.side_effect = execute
+        self.executor.submit("device", item1)
+
+        self.executor._run()
+
+        self.assertEqual(2, self.batch._execute_pending_batches.call_count)
+        self.assertFalse(self.executor._running)
+
+    def test_run_linger(self, mock_pool):
+        self.batch.linger = mock.Mock()
+        self.executor.submit("device", batching.SwitchQueueItem("uuid", 1))
+
+        self.executor._run()
+
+        self.batch.linger.wait.assert_called_once_with()
+        self.assertEqual(1, self.batch._execute_pending_batches.call_count)
+
 
 class SwitchBatchTest(fixtures.TestWithFixtures):
     def setUp(self):
@@ -283,6 +1259,13 @@ class SwitchBatchTest(fixtures.TestWithFixtures):
         self.batch = batching.SwitchBatch(
             self.switch_name, switch_queue=self.queue)
 
+        patcher = mock.patch.object(batching, "LockHeartbeat", autospec=True)
+        self.mock_heartbeat = patcher.start()
+        self.addCleanup(patcher.stop)
+        heartbeat = self.mock_heartbeat.return_value
+        self.heartbeat = heartbeat.__enter__.return_value
+        self.heartbeat.lost = False
+
     @mock.patch.object(batching.SwitchBatch, "_spawn")
     def test_do_batch(self, mock_spawn):
         self.queue.add_batch.return_value = "item"
@@ -292,18 +1275,114 @@ class SwitchBatchTest(fixtures.TestWithFixtures):
 
         self.assertEqual("output", result)
         self.assertEqual(1, mock_spawn.call_count)
-        self.queue.add_batch.assert_called_once_with(["cmd1"])
+        self.queue.add_batch.assert_called_once_with(["cmd1"], op=None)
+        self.queue.wait_for_result.assert_called_once_with("item", 300)
+
+    @mock.patch.object(batching.SwitchBatch, "_spawn")
+    def test_do_batch_with_op(self, mock_spawn):
+        self.queue.add_batch.return_value = "item"
+        self.queue.wait_for_result.return_value = "output"
+        op = {"name": "plug port", "port": "p1", "vlan": 22}
+
+        result = self.batch.do_batch("device", ["cmd1"], op=op)
+
+        self.assertEqual("output", result)
+        self.queue.add_batch.assert_called_once_with(["cmd1"], op=op)
+
+    @mock.patch.object(batching.SwitchBatch, "_execute_pending_batches")
+    @mock.patch.object(batching.SwitchBatch, "_spawn")
+    def test_do_batch_linger(self, mock_spawn, mock_execute):
+        mock_spawn.side_effect = lambda work_fn: work_fn()
+        batch = batching.SwitchBatch(self.switch_name, switch_queue=self.queue,
+                                     linger=0.1, linger_batches=5)
+        self.assertEqual(0.1, batch.linger.max_linger)
+        self.assertEqual(5, batch.linger.max_batches)
+        batch.linger = mock.Mock()
+        self.queue.add_batch.return_value = "item"
+        self.queue.wait_for_result.return_value = "output"
+
+        result = batch.do_batch("device", ["cmd1"])
+
+        self.assertEqual("output", result)
+        batch.linger.arrived.assert_called_once_with()
+        batch.linger.wait.assert_called_once_with()
+        mock_execute.assert_called_once_with("device", "item")
+
+    @mock.patch.object(batching.SwitchBatch, "_spawn")
+    def test_do_batch_executor(self, mock_spawn):
+        batch = batching.SwitchBatch(self.switch_name, switch_queue=self.queue,
+                                     executor=True)
+        batch.executor = mock.Mock()
+        self.queue.add_batch.return_value = "item"
+        self.queue.wait_for_result.return_value = "output"
+
+        result = batch.do_batch("device", ["cmd1"])
+
+        self.assertEqual("output", result)
+        batch.executor.submit.assert_called_once_with("device", "item")
+        self.assertFalse(mock_spawn.called)
         self.queue.wait_for_result.assert_called_once_with("item", 300)
 
+    @mock.patch.object(batching.SwitchBatch, "_spawn")
+    def test_do_batch_backlog(self, mock_spawn):
+        self.batch.max_backlog = 2
+        self.queue.wait_for_result.return_value = "output"
+
+        self.assertEqual("output", self.batch.do_batch("device", ["cmd1"]))
+        self.assertEqual(0, self.batch._backlog)
+
+        self.batch._backlog = 2
+        self.assertRaisesRegex(exc.GenericSwitchBatchError,
+                               "Too many pending requests",
+                               self.batch.do_batch, "device", ["cmd1"])
+        self.assertEqual(2, self.batch._backlog)
+        self.assertEqual(1, self.queue.add_batch.call_count)
+
+    @mock.patch.object(batching.SwitchBatch, "_spawn")
+    def test_do_batch_backlog_failure(self, mock_spawn):
+        self.batch.max_backlog = 1
+        self.queue.wait_for_result.side_effect = exc.GenericSwitchBatchError(
+            device=self.switch_name, error="Bang")
+
+        self.assertRaises(exc.GenericSwitchBatchError,
+                          self.batch.do_batch, "device", ["cmd1"])
+        self.assertEqual(0, self.batch._backlog)
+
+    @mock.patch.object(batching.QueueJanitor, "start", autospec=True)
+    def test_janitor(self, mock_start):
+        queue = batching.SwitchQueue(self.switch_name, mock.Mock())
+        batch = batching.SwitchBatch(self.switch_name, switch_queue=queue,
+                                     janitor_interval=120)
+        self.assertIs(queue, batch.janitor.queue)
+        self.assertEqual(120, batch.janitor.interval)
+        mock_start.assert_called_once_with(batch.janitor)
+
+    def test_no_janitor(self):
+        self.assertIsNone(self.batch.janitor)
+        batch = batching.SwitchBatch(self.switch_name,
+                                     switch_queue=batching.MemorySwitchQueue(
+                                         self.switch_name),
+                                     janitor_interval=120)
+        self.assertIsNone(batch.janitor)
+
+    def test_no_executor(self):
+        self.assertIsNone(self.batch.executor)
+        self.assertEqual(0, self.batch.max_backlog)
+
+    def test_no_linger(self):
+        self.assertIsNone(self.batch.linger)
+
     def test_execute_pending_batches_skip(self):
-        self.queue.get_batches.return_value = []
+        self.queue.has_batches.return_value = False
 
         result = self.batch._execute_pending_batches("device", "item")
 
         self.assertIsNone(result)
+        self.queue.has_batches.assert_called_once_with("item")
+        self.assertFalse(self.queue.get_batches.called)
 
     def test_execute_pending_batches_skip2(self):
-        self.queue.get_batches.return_value = ["work"]
+        self.queue.has_batches.return_value = True
         # Work was consumed by another worker before we could get the lock.
         self.queue.acquire_worker_lock.return_value = None
 
@@ -313,7 +1392,8 @@ class SwitchBatchTest(fixtures.TestWithFixtures):
 
     @mock.patch.object(batching.SwitchBatch, "_send_commands")
     def test_execute_pending_batches_skip3(self, mock_send):
-        self.queue.get_batches.side_effect = [["work"], None]
+        self.queue.has_batches.return_value = True
+        self.queue.get_batches.return_value = []
         # Work was consumed by another worker before we got the lock.
         lock = mock.MagicMock()
         self.queue.acquire_worker_lock.return_value = lock
@@ -330,7 +1410,7 @@ class SwitchBatchTest(fixtures.TestWithFixtures):
             {"cmds": ["cmd3", "cmd4"]},
         ]
         self.queue.get_batches.return_value = batches
-        device = mock.MagicMock()
+        device = mock.MagicMock(save_scheduler=None)
         lock = mock.MagicMock()
         self.queue.acquire_worker_lock.return_value = lock
 
@@ -340,6 +1420,15 @@ class SwitchBatchTest(fixtures.TestWithFixtures):
         self.queue.acquire_worker_lock.assert_called_once_with("item")
         lock.release.assert_called_once_with()
 
+    @mock.patch.object(batching.SwitchBatch, "_send_commands")
+    def test_execute_pending_batches_linger_taken(self, mock_send):
+        self.batch.linger = mock.Mock()
+        self.queue.get_batches.return_value = [{"cmds": ["cmd1"]}]
+
+        self.batch._execute_pending_batches(mock.MagicMock(), "item")
+
+        self.batch.linger.taken.assert_called_once_with()
+
     @mock.patch.object(batching.SwitchBatch, "_send_commands")
     def test_execute_pending_batches_failure(self, mock_send):
         batches = [
@@ -347,7 +1436,7 @@ class SwitchBatchTest(fixtures.TestWithFixtures):
             {"cmds": ["cmd3", "cmd4"]},
         ]
         self.queue.get_batches.return_value = batches
-        device = mock.MagicMock()
+        device = mock.MagicMock(save_scheduler=None)
         lock = mock.MagicMock()
         self.queue.acquire_worker_lock.return_value = lock
         mock_send.side_effect = exc.GenericSwitchBatchError
@@ -359,7 +1448,7 @@ class SwitchBatchTest(fixtures.TestWithFixtures):
         lock.release.assert_called_once_with()
 
     def test_send_commands_one_batch(self):
-        device = mock.MagicMock()
+        device = mock.MagicMock(save_scheduler=None)
         device.send_config_set.return_value = "output"
         batches = [
             {"cmds": ["cmd1", "cmd2"]},
@@ -371,14 +1460,13 @@ class SwitchBatchTest(fixtures.TestWithFixtures):
         connection = device._get_connection.return_value.__enter__.return_value
         device.send_config_set.assert_called_once_with(
             connection, ["cmd1", "cmd2"])
-        lock.refresh.assert_called_once_with()
-        lock.is_acquired.assert_called_once_with()
-        self.queue.record_result.assert_called_once_with(
-            {"cmds": ["cmd1", "cmd2"], "result": "output"})
+        self.mock_heartbeat.assert_called_once_with(lock)
+        self.queue.record_results.assert_called_once_with(
+            [{"cmds": ["cmd1", "cmd2"], "result": "output"}], lock)
         device.save_configuration.assert_called_once_with(connection)
 
     def test_send_commands_two_batches(self):
-        device = mock.MagicMock()
+        device = mock.MagicMock(save_scheduler=None)
         device.send_config_set.side_effect = ["output1", "output2"]
         batches = [
             {"cmds": ["cmd1", "cmd2"]},
@@ -394,18 +1482,16 @@ class SwitchBatchTest(fixtures.TestWithFixtures):
             mock.call(connection, ["cmd1", "cmd2"]),
             mock.call(connection, ["cmd3", "cmd4"])
         ])
-        self.assertEqual(2, lock.refresh.call_count)
-        self.assertEqual(2, lock.is_acquired.call_count)
-        self.assertEqual(2, self.queue.record_result.call_count)
-        self.queue.record_result.assert_has_calls([
-            mock.call({"cmds": ["cmd1", "cmd2"], "result": "output1"}),
-            mock.call({"cmds": ["cmd3", "cmd4"], "result": "output2"})
-        ])
+        # Results are recorded together.
+        self.queue.record_results.assert_called_once_with([
+            {"cmds": ["cmd1", "cmd2"], "result": "output1"},
+            {"cmds": ["cmd3", "cmd4"], "result": "output2"}
+        ], lock)
         device.save_configuration.assert_called_once_with(connection)
         self.assertEqual(1, device.save_configuration.call_count)
 
     def test_send_commands_failure(self):
-        device = mock.MagicMock()
+        device = mock.MagicMock(save_scheduler=None)
         device.send_config_set.side_effect = Exception("Bang")
         batches = [
             {"cmds": ["cmd1", "cmd2"]},
@@ -417,20 +1503,78 @@ class SwitchBatchTest(fixtures.TestWithFixtures):
         connection = device._get_connection.return_value.__enter__.return_value
         device.send_config_set.assert_called_once_with(
             connection, ["cmd1", "cmd2"])
-        lock.refresh.assert_called_once_with()
-        lock.is_acquired.assert_called_once_with()
-        self.queue.record_result.assert_called_once_with(
-            {"cmds": ["cmd1", "cmd2"], "error": "Bang"})
+        self.queue.record_results.assert_called_once_with(
+            [{"cmds": ["cmd1", "cmd2"], "error": "Bang"}], lock)
         device.save_configuration.assert_called_once_with(connection)
 
+    def test_send_commands_check_output(self):
+        self.batch.check_output = True
+        device = mock.MagicMock(save_scheduler=None)
+        device.send_config_set.side_effect = ["output1", "output2", "output3"]
+        device.check_output.side_effect = [None, ValueError("Invalid")]
+        add = {"name": "add network", "vlan": 2}
+        plug = {"name": "plug port", "port": "p1", "vlan": 2}
+        batches = [
+            {"cmds": ["cmd1"], "op": add},
+            {"cmds": ["cmd2"], "op": plug},
+            {"cmds": ["cmd3"]},
+        ]
+        lock = mock.MagicMock()
+
+        self.batch._send_commands(device, batches, lock)
+
+        device.check_output.assert_has_calls([
+            mock.call("output1", "add network"),
+            mock.call("output2", "plug port"),
+        ])
+        self.assertEqual(2, device.check_output.call_count)
+        self.queue.record_results.assert_called_once_with([
+            {"cmds": ["cmd1"], "op": add, "result": "output1"},
+            {"cmds": ["cmd2"], "op": plug, "error": "Invalid"},
+            {"cmds": ["cmd3"], "result": "output3"},
+        ], lock)
+
+    def test_send_commands_priority(self):
+        self.batch.priority = True
+        device = mock.MagicMock(save_scheduler=None)
+        device.send_config_set.side_effect = ["output1", "output2", "output3"]
+        add = {"name": "add network", "vlan": 2}
+        plug1 = {"name": "plug port", "port": "p1", "vlan": 3}
+        plug2 = {"name": "plug port", "port": "p2", "vlan": 4}
+        batches = [
+            {"cmds": ["cmd1"], "op": add},
+            {"cmds": ["cmd2"], "op": plug1},
+            {"cmds": ["cmd3"], "op": plug2},
+        ]
+        lock = mock.MagicMock()
+
+        recorded = []
+        self.queue.record_results.side_effect = (
+            lambda batches, lock: recorded.append(list(batches)))
+
+        self.batch._send_commands(device, batches, lock)
+
+        connection = device._get_connection.return_value.__enter__.return_value
+        device.send_config_set.assert_has_calls([
+            mock.call(connection, ["cmd2"]),
+            mock.call(connection, ["cmd3"]),
+            mock.call(connection, ["cmd1"]),
+        ])
+        # The results of each priority class are published together.
+        self.assertEqual([
+            [{"cmds": ["cmd2"], "op": plug1, "result": "output1"},
+             {"cmds": ["cmd3"], "op": plug2, "result": "output2"}],
+            [{"cmds": ["cmd1"], "op": add, "result": "output3"}],
+        ], recorded)
+
     def test_send_commands_lock_timeout(self):
-        device = mock.MagicMock()
+        device = mock.MagicMock(save_scheduler=None)
         device.send_config_set.side_effect = Exception("Bang")
         batches = [
             {"cmds": ["cmd1", "cmd2"]},
         ]
         lock = mock.MagicMock()
-        lock.is_acquired.return_value = False
+        self.heartbeat.lost = True
 
         self.assertRaises(exc.GenericSwitchBatchError,
                           self.batch._send_commands, device, batches, lock)
@@ -438,5 +1582,451 @@ class SwitchBatchTest(fixtures.TestWithFixtures):
         connection = device._get_connection.return_value.__enter__.return_value
         device.send_config_set.assert_called_once_with(
             connection, ["cmd1", "cmd2"])
-        self.assertEqual(0, self.queue.record_result.call_count)
+        self.assertEqual(0, self.queue.record_results.call_count)
+        self.assertEqual(0, device.save_configuration.call_count)
+
+    def test_send_commands_coalesce(self):
+        self.batch.coalesce = True
+        device = mock.MagicMock(save_scheduler=None)
+        device.send_config_set.return_value = "output"
+        plug = {"name": "plug port", "port": "p1", "vlan": 22}
+        unplug = {"name": "unplug port", "port": "p1", "vlan": 22}
+        add = {"name": "add network", "vlan": 33}
+        batches = [
+            {"cmds": ["plug"], "op": plug},
+            {"cmds": ["add"], "op": add},
+            {"cmds": ["unplug"], "op": unplug},
+            {"cmds": ["add"], "op": add},
+        ]
+        lock = mock.MagicMock()
+
+        self.batch._send_commands(device, batches, lock)
+
+        connection = device._get_connection.return_value.__enter__.return_value
+        device.send_config_set.assert_called_once_with(connection, ["add"])
+        self.queue.record_results.assert_called_once_with([
+            {"cmds": ["plug"], "op": plug, "result": ""},
+            {"cmds": ["add"], "op": add, "result": "output"},
+            {"cmds": ["unplug"], "op": unplug, "result": ""},
+            {"cmds": ["add"], "op": add, "result": "output"},
+        ], lock)
+        device.save_configuration.assert_called_once_with(connection)
+
+    def test_send_commands_coalesce_duplicate_error(self):
+        self.batch.coalesce = True
+        device = mock.MagicMock(save_scheduler=None)
+        device.send_config_set.side_effect = Exception("Bang")
+        add = {"name": "add network", "vlan": 33}
+        batches = [
+            {"cmds": ["add"], "op": add},
+            {"cmds": ["add"], "op": add},
+        ]
+        lock = mock.MagicMock()
+
+        self.batch._send_commands(device, batches, lock)
+
+        self.assertEqual(1, device.send_config_set.call_count)
+        self.queue.record_results.assert_called_once_with([
+            {"cmds": ["add"], "op": add, "error": "Bang"},
+            {"cmds": ["add"], "op": add, "error": "Bang"},
+        ], lock)
+
+    def test_send_commands_coalesce_all(self):
+        self.batch.coalesce = True
+        device = mock.MagicMock(save_scheduler=None)
+        add = {"name": "add network", "vlan": 33}
+        delete = {"name": "delete network", "vlan": 33}
+        batches = [
+            {"cmds": ["add"], "op": add},
+            {"cmds": ["del"], "op": delete},
+        ]
+        lock = mock.MagicMock()
+
+        self.batch._send_commands(device, batches, lock)
+
+        self.assertEqual(0, device._get_connection.call_count)
+        self.assertEqual(0, device.send_config_set.call_count)
+        self.queue.record_results.assert_called_once_with([
+            {"cmds": ["add"], "op": add, "result": ""},
+            {"cmds": ["del"], "op": delete, "result": ""},
+        ], lock)
+        self.assertEqual(0, device.save_configuration.call_count)
+        self.assertFalse(self.mock_heartbeat.called)
+
+    def test_send_commands_coalesce_disabled(self):
+        device = mock.MagicMock(save_scheduler=None)
+        device.send_config_set.return_value = "output"
+        add = {"name": "add network", "vlan": 33}
+        delete = {"name": "delete network", "vlan": 33}
+        batches = [
+            {"cmds": ["add"], "op": add},
+            {"cmds": ["del"], "op": delete},
+        ]
+        lock = mock.MagicMock()
+
+        self.batch._send_commands(device, batches, lock)
+
+        self.assertEqual(2, device.send_config_set.call_count)
+
+    def test_send_commands_single_session(self):
+        self.batch.single_session = True
+        device = mock.MagicMock(save_scheduler=None)
+        session = device.config_session.return_value
+        send = session.__enter__.return_value
+        send.side_effect = ["output1", Exception("Bang"), "output3"]
+        batches = [
+            {"cmds": ["cmd1"]},
+            {"cmds": ["cmd2"]},
+            {"cmds": ["cmd3"]},
+        ]
+        lock = mock.MagicMock()
+
+        self.batch._send_commands(device, batches, lock)
+
+        connection = device._get_connection.return_value.__enter__.return_value
+        device.config_session.assert_called_once_with(connection)
+        send.assert_has_calls([
+            mock.call(["cmd1"]), mock.call(["cmd2"]), mock.call(["cmd3"])])
+        session.__exit__.assert_called_once_with(None, None, None)
+        self.assertEqual(0, device.send_config_set.call_count)
+        self.queue.record_results.assert_called_once_with([
+            {"cmds": ["cmd1"], "result": "output1"},
+            {"cmds": ["cmd2"], "error": "Bang"},
+            {"cmds": ["cmd3"], "result": "output3"},
+        ], lock)
+        device.save_configuration.assert_called_once_with(connection)
+
+    def test_send_commands_save_scheduler(self):
+        device = mock.MagicMock()
+        device.send_config_set.return_value = "output"
+        batches = [
+            {"cmds": ["cmd1", "cmd2"]},
+        ]
+        lock = mock.MagicMock()
+
+        self.batch._send_commands(device, batches, lock)
+
+        device.save_scheduler.schedule.assert_called_once_with()
         self.assertEqual(0, device.save_configuration.call_count)
+        self.queue.record_results.assert_called_once_with(
+            [{"cmds": ["cmd1", "cmd2"], "result": "output"}], lock)
+
+    def _make_pooled_device(self, reused):
+        """Return a device whose connections are lost on EOFError."""
+        device = mock.MagicMock(save_scheduler=None)
+        connections = [mock.Mock(name="conn1"), mock.Mock(name="conn2")]
+
+        @contextlib.contextmanager
+        def get_connection():
+            net_connect = connections.pop(0)
+            try:
+                yield net_connect
+            except EOFError as e:
+                if reused:
+                    raise connection_pool.StaleConnection() from e
+                raise
+
+        device._get_connection.side_effect = get_connection
+        return device
+
+    def _record_results(self):
+        # Copy the batches recorded, as the list is reused.
+        recorded = []
+        self.queue.record_results.side_effect = (
+            lambda batches, lock: recorded.append(list(batches)))
+        return recorded
+
+    def test_send_commands_reconnect(self):
+        device = self._make_pooled_device(reused=True)
+        device.send_config_set.side_effect = [
+            "output1", EOFError, "output2", "output3"]
+        batches = [
+            {"cmds": ["cmd1"]},
+            {"cmds": ["cmd2"]},
+            {"cmds": ["cmd3"]},
+        ]
+        lock = mock.MagicMock()
+        recorded = self._record_results()
+
+        self.batch._send_commands(device, batches, lock)
+
+        self.assertEqual(4, device.send_config_set.call_count)
+        conn2 = device.send_config_set.call_args_list[2][0][0]
+        device.send_config_set.assert_has_calls([
+            mock.call(mock.ANY, ["cmd2"]),
+            mock.call(conn2, ["cmd2"]),
+            mock.call(conn2, ["cmd3"]),
+        ])
+        self.assertEqual([
+            [{"cmds": ["cmd1"], "result": "output1"}],
+            [{"cmds": ["cmd2"], "result": "output2"},
+             {"cmds": ["cmd3"], "result": "output3"}],
+        ], recorded)
+        device.save_configuration.assert_called_once_with(conn2)
+
+    def test_send_commands_reconnect_once(self):
+        device = self._make_pooled_device(reused=True)
+        device.send_config_set.side_effect = EOFError
+        batches = [
+            {"cmds": ["cmd1"]},
+            {"cmds": ["cmd2"]},
+        ]
+        lock = mock.MagicMock()
+
+        self.batch._send_commands(device, batches, lock)
+
+        self.assertEqual(2, device.send_config_set.call_count)
+        self.queue.record_results.assert_called_once_with(batches, lock)
+        for batch in batches:
+            self.assertIn("Lost connection", batch["error"])
+        self.assertFalse(device.save_configuration.called)
+
+    def test_send_commands_connection_lost_new(self):
+        device = self._make_pooled_device(reused=False)
+        device.send_config_set.side_effect = ["output1", EOFError]
+        batches = [
+            {"cmds": ["cmd1"]},
+            {"cmds": ["cmd2"]},
+            {"cmds": ["cmd3"]},
+        ]
+        lock = mock.MagicMock()
+        recorded = self._record_results()
+
+        self.batch._send_commands(device, batches, lock)
+
+        # A new connection that fails is not retried.
+        self.assertEqual(2, device.send_config_set.call_count)
+        self.assertEqual([
+            [{"cmds": ["cmd1"], "result": "output1"}],
+            [{"cmds": ["cmd2"], "error": mock.ANY},
+             {"cmds": ["cmd3"], "error": mock.ANY}],
+        ], recorded)
+        self.assertIn("Lost connection", batches[2]["error"])
+        self.assertFalse(device.save_configuration.called)
+
+    def test_save_configuration(self):
+        device = mock.MagicMock()
+        lock = self.queue.acquire_lock.return_value
+
+        self.batch.save_configuration(device)
+
+        connection = device._get_connection.return_value.__enter__.return_value
+        device.save_configuration.assert_called_once_with(connection)
+        self.mock_heartbeat.assert_called_once_with(lock)
+        lock.release.assert_called_once_with()
+
+    def test_save_configuration_failure(self):
+        device = mock.MagicMock()
+        device.save_configuration.side_effect = exc.GenericSwitchException(
+            method="save")
+        lock = self.queue.acquire_lock.return_value
+
+        self.assertRaises(exc.GenericSwitchException,
+                          self.batch.save_configuration, device)
+        lock.release.assert_called_once_with()
+
+    def test_send_commands_publish_each(self):
+        self.batch.publish_each = True
+        device = mock.MagicMock(save_scheduler=None)
+        device.send_config_set.side_effect = ["output1", "output2"]
+        batches = [
+            {"cmds": ["cmd1"]},
+            {"cmds": ["cmd2"]},
+        ]
+        lock = mock.MagicMock()
+
+        # Copy the batches recorded, as the list is reused.
+        recorded = []
+        self.queue.record_results.side_effect = (
+            lambda batches, lock: recorded.append(list(batches)))
+
+        self.batch._send_commands(device, batches, lock)
+
+        self.assertEqual([
+            [{"cmds": ["cmd1"], "result": "output1"}],
+            [{"cmds": ["cmd2"], "result": "output2"}],
+        ], recorded)
+
+
+class CoalesceBatchesTest(fixtures.TestWithFixtures):
+
+    def _batch(self, name, vlan, port=None, cmds=None):
+        op = {"name": name, "vlan": vlan}
+        if port is not None:
+            op["port"] = port
+        return {"cmds": cmds or [name], "op": op}
+
+    def test_no_ops(self):
+        batches = [{"cmds": ["cmd1"]}, {"cmds": ["cmd1"]}]
+        self.assertEqual({}, batching.coalesce_batches(batches))
+
+    def test_cancel_port(self):
+        batches = [
+            self._batch("plug port", 22, "p1"),
+            self._batch("unplug port", 22, "p1"),
+        ]
+        self.assertEqual({0: None, 1: None},
+                         batching.coalesce_batches(batches))
+
+    def test_cancel_bond(self):
+        batches = [
+            self._batch("unplug bond", 22, "b1"),
+            self._batch("plug port", 23, "p2"),
+            self._batch("plug bond", 22, "b1"),
+        ]
+        self.assertEqual({0: None, 2: None},
+                         batching.coalesce_batches(batches))
+
+    def test_cancel_network(self):
+        batches = [
+            self._batch("add network", 22),
+            self._batch("delete network", 22),
+        ]
+        self.assertEqual({0: None, 1: None},
+                         batching.coalesce_batches(batches))
+
+    def test_no_cancel_different_network(self):
+        # The VLAN of a deleted network is reused by another network.
+        batches = [
+            {"cmds": ["no vlan 100"],
+             "op": {"name": "delete network", "vlan": 100,
+                    "network_id": "net1"}},
+            {"cmds": ["vlan 100", "name net2"],
+             "op": {"name": "add network", "vlan": 100,
+                    "network_id": "net2"}},
+        ]
+        self.assertEqual({}, batching.coalesce_batches(batches))
+
+    def test_no_cancel_different_port(self):
+        batches = [
+            self._batch("plug port", 22, "p1"),
+            self._batch("unplug port", 22, "p2"),
+        ]
+        self.assertEqual({}, batching.coalesce_batches(batches))
+
+    def test_no_cancel_intervening_vlan(self):
+        batches = [
+            self._batch("plug port", 22, "p1"),
+            self._batch("delete network", 22),
+            self._batch("unplug port", 22, "p1"),
+        ]
+        self.assertEqual({}, batching.coalesce_batches(batches))
+
+    def test_no_cancel_intervening_port(self):
+        batches = [
+            self._batch("unplug port", 22, "p1"),
+            self._batch("plug port", 23, "p1"),
+            self._batch("plug port", 22, "p1"),
+        ]
+        self.assertEqual({}, batching.coalesce_batches(batches))
+
+    def test_no_cancel_intervening_unknown(self):
+        batches = [
+            self._batch("add network", 22),
+            {"cmds": ["cmd1"]},
+            self._batch("delete network", 22),
+        ]
+        self.assertEqual({}, batching.coalesce_batches(batches))
+
+    def test_duplicate(self):
+        batches = [
+            self._batch("add network", 22),
+            self._batch("plug port", 23, "p1"),
+            self._batch("add network", 22),
+        ]
+        self.assertEqual({2: 0}, batching.coalesce_batches(batches))
+
+    def test_duplicate_different_cmds(self):
+        batches = [
+            self._batch("add network", 22, cmds=["vlan 22", "name a"]),
+            self._batch("add network", 22, cmds=["vlan 22", "name b"]),
+        ]
+        self.assertEqual({}, batching.coalesce_batches(batches))
+
+    def test_nested_cancel(self):
+        batches = [
+            self._batch("add network", 22),
+            self._batch("plug port", 22, "p1"),
+            self._batch("unplug port", 22, "p1"),
+            self._batch("delete network", 22),
+        ]
+        self.assertEqual({0: None, 1: None, 2: None, 3: None},
+                         batching.coalesce_batches(batches))
+
+    def test_duplicate_then_cancel(self):
+        batches = [
+            self._batch("plug port", 22, "p1"),
+            self._batch("plug port", 22, "p1"),
+            self._batch("unplug port", 22, "p1"),
+        ]
+        self.assertEqual({0: None, 1: 0, 2: None},
+                         batching.coalesce_batches(batches))
+
+
+class PrioritiseBatchesTest(fixtures.TestWithFixtures):
+
+    def _batch(self, name, vlan, port=None):
+        op = {"name": name, "vlan": vlan}
+        if port is not None:
+            op["port"] = port
+        return {"cmds": [name], "op": op}
+
+    def test_empty(self):
+        self.assertEqual(([], []), batching.prioritise_batches([]))
+
+    def test_priority(self):
+        batches = [
+            self._batch("add network", 10),
+            self._batch("add network", 11),
+            self._batch("unplug port", 22, "p1"),
+            self._batch("plug bond", 23, "b1"),
+        ]
+        ordered, lanes = batching.prioritise_batches(batches)
+        self.assertEqual([batches[2], batches[3], batches[0], batches[1]],
+                         ordered)
+        self.assertEqual([0, 0, 1, 1], lanes)
+
+    def test_same_vlan(self):
+        batches = [
+            self._batch("add network", 22),
+            self._batch("plug port", 22, "p1"),
+            self._batch("unplug port", 23, "p2"),
+        ]
+        ordered, lanes = batching.prioritise_batches(batches)
+        self.assertEqual([batches[2], batches[0], batches[1]], ordered)
+        self.assertEqual([0, 1, 0], lanes)
+
+    def test_same_port(self):
+        batches = [
+            self._batch("delete network", 10),
+            self._batch("plug port", 10, "p1"),
+            self._batch("add network", 11),
+            self._batch("unplug port", 11, "p1"),
+        ]
+        ordered, _ = batching.prioritise_batches(batches)
+        # The port batches follow the network batches with the same VLANs,
+        # and remain in order.
+        self.assertEqual([batches[0], batches[1], batches[2], batches[3]],
+                         ordered)
+
+    def test_no_op(self):
+        batches = [
+            self._batch("add network", 10),
+            {"cmds": ["cmd1"]},
+            self._batch("plug port", 11, "p1"),
+        ]
+        ordered, lanes = batching.prioritise_batches(batches)
+        self.assertEqual(batches, ordered)
+        self.assertEqual([1, 2, 0], lanes)
+
+    def test_aging(self):
+        batches = [self._batch("add network", 10)] + [
+            self._batch("plug port", 20 + i, "p%d" % i) for i in range(4)]
+        ordered, lanes = batching.prioritise_batches(batches, aging=4)
+        # The network batch has been promoted by the four batches after it.
+        self.assertEqual(batches, ordered)
+        self.assertEqual([0, 0, 0, 0, 0], lanes)
+
+        ordered, lanes = batching.prioritise_batches(batches, aging=5)
+        self.assertEqual(batches[1:] + batches[:1], ordered)
+        self.assertEqual([0, 0, 0, 0, 1], lanes)
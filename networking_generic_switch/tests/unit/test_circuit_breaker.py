@@ -0,0 +1,95 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from unittest import mock
+
+import fixtures
+
+from networking_generic_switch import circuit_breaker
+
+
+class FakeError(Exception):
+    pass
+
+
+@mock.patch.object(circuit_breaker.time, 'monotonic', autospec=True,
+                   return_value=100)
+class CircuitBreakerTest(fixtures.TestWithFixtures):
+
+    def setUp(self):
+        super(CircuitBreakerTest, self).setUp()
+        self.breaker = circuit_breaker.CircuitBreaker('switch1', 2, 60)
+
+    def _fail(self):
+        def attempt():
+            with self.breaker.attempt():
+                raise FakeError()
+        self.assertRaises(FakeError, attempt)
+
+    def _succeed(self):
+        with self.breaker.attempt():
+            pass
+
+    def test_closed(self, mock_time):
+        self._fail()
+        self._succeed()
+        self._fail()
+
+        self.assertEqual(circuit_breaker.CLOSED, self.breaker.state)
+        self.assertEqual(1, self.breaker.failures)
+        self.breaker.check()
+
+    def test_open(self, mock_time):
+        self._fail()
+        self._fail()
+
+        self.assertEqual(circuit_breaker.OPEN, self.breaker.state)
+        self.assertRaises(circuit_breaker.CircuitOpen, self.breaker.check)
+        self.assertRaises(circuit_breaker.CircuitOpen, self._succeed)
+
+    def test_half_open_trial_success(self, mock_time):
+        self._fail()
+        self._fail()
+        mock_time.return_value = 160
+
+        self.breaker.check()
+        with self.breaker.attempt():
+            self.assertEqual(circuit_breaker.HALF_OPEN, self.breaker.state)
+            # Only one trial is allowed at a time.
+            self.assertRaises(circuit_breaker.CircuitOpen, self._succeed)
+
+        self.assertEqual(circuit_breaker.CLOSED, self.breaker.state)
+        self.assertEqual(0, self.breaker.failures)
+
+    def test_half_open_trial_failure(self, mock_time):
+        self._fail()
+        self._fail()
+        mock_time.return_value = 160
+
+        self._fail()
+
+        self.assertEqual(circuit_breaker.OPEN, self.breaker.state)
+        self.assertRaises(circuit_breaker.CircuitOpen, self.breaker.check)
+        mock_time.return_value = 220
+        self._succeed()
+        self.assertEqual(circuit_breaker.CLOSED, self.breaker.state)
+
+    @mock.patch.dict(circuit_breaker._BREAKERS, clear=True)
+    def test_get_circuit_breaker_shared(self, mock_time):
+        breaker1 = circuit_breaker.get_circuit_breaker('switch1', 3, 30)
+        breaker2 = circuit_breaker.get_circuit_breaker('switch1', 3, 30)
+        breaker3 = circuit_breaker.get_circuit_breaker('switch2', 3, 30)
+
+        self.assertIs(breaker1, breaker2)
+        self.assertIsNot(breaker1, breaker3)
+        self.assertEqual(3, breaker1.threshold)
+        self.assertEqual(30, breaker1.reset_timeout)
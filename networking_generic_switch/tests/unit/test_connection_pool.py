@@ -0,0 +1,147 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from unittest import mock
+
+import fixtures
+
+from networking_generic_switch import connection_pool
+
+
+@mock.patch.object(connection_pool.eventlet, 'spawn', autospec=True)
+class ConnectionPoolTest(fixtures.TestWithFixtures):
+
+    def setUp(self):
+        super(ConnectionPoolTest, self).setUp()
+        self.create = mock.Mock(side_effect=lambda: mock.Mock())
+        self.pool = connection_pool.ConnectionPool(
+            self.create, max_size=2, idle_timeout=60, name='switch1')
+
+    def test_connection_reused(self, mock_spawn):
+        with self.pool.connection() as conn1:
+            pass
+        with self.pool.connection() as conn2:
+            pass
+
+        self.assertIs(conn1, conn2)
+        self.assertEqual(1, self.create.call_count)
+        conn1.is_alive.assert_called_once_with()
+        self.assertFalse(conn1.disconnect.called)
+        mock_spawn.assert_called_once_with(self.pool._reap_idle)
+
+    def test_connection_not_alive(self, mock_spawn):
+        with self.pool.connection() as conn1:
+            pass
+        conn1.is_alive.return_value = False
+
+        with self.pool.connection() as conn2:
+            pass
+
+        self.assertIsNot(conn1, conn2)
+        self.assertEqual(2, self.create.call_count)
+        conn1.disconnect.assert_called_once_with()
+
+    def test_connection_caller_failure(self, mock_spawn):
+        def use_connection():
+            with self.pool.connection():
+                raise EOFError()
+
+        self.assertRaises(EOFError, use_connection)
+        self.assertEqual(0, len(self.pool._idle))
+        self.assertFalse(mock_spawn.called)
+
+    def test_connection_caller_failure_discards(self, mock_spawn):
+        with self.pool.connection() as conn1:
+            pass
+        try:
+            with self.pool.connection() as conn2:
+                raise EOFError()
+        except EOFError:
+            pass
+
+        self.assertIs(conn1, conn2)
+        conn1.disconnect.assert_called_once_with()
+        self.assertEqual(0, len(self.pool._idle))
+
+    def test_connection_lost_reused(self, mock_spawn):
+        self.pool.lost_errors = (EOFError,)
+        with self.pool.connection() as conn1:
+            pass
+        try:
+            with self.pool.connection():
+                raise EOFError()
+        except connection_pool.StaleConnection as e:
+            self.assertIsInstance(e.__cause__, EOFError)
+        else:
+            self.fail("StaleConnection not raised")
+
+        conn1.disconnect.assert_called_once_with()
+        self.assertEqual(0, len(self.pool._idle))
+
+    def test_connection_lost_new(self, mock_spawn):
+        self.pool.lost_errors = (EOFError,)
+
+        def use_connection():
+            with self.pool.connection():
+                raise EOFError()
+
+        # A new connection is not reported as stale.
+        self.assertRaises(EOFError, use_connection)
+
+    def test_release_pool_full(self, mock_spawn):
+        conns = [self.pool.acquire() for _ in range(3)]
+        for conn in conns:
+            self.pool.release(conn)
+
+        self.assertEqual(2, len(self.pool._idle))
+        self.assertFalse(conns[0].disconnect.called)
+        self.assertFalse(conns[1].disconnect.called)
+        conns[2].disconnect.assert_called_once_with()
+
+    @mock.patch.object(connection_pool.time, 'monotonic', autospec=True)
+    def test_evict_idle(self, mock_time, mock_spawn):
+        mock_time.return_value = 100
+        conn1 = self.pool.acquire()
+        conn2 = self.pool.acquire()
+        self.pool.release(conn1)
+        mock_time.return_value = 150
+        self.pool.release(conn2)
+
+        mock_time.return_value = 170
+        self.pool.evict_idle()
+
+        conn1.disconnect.assert_called_once_with()
+        self.assertFalse(conn2.disconnect.called)
+        self.assertEqual([conn2], [c for c, _ in self.pool._idle])
+
+    @mock.patch.object(connection_pool.time, 'monotonic', autospec=True)
+    def test_acquire_skips_expired(self, mock_time, mock_spawn):
+        mock_time.return_value = 100
+        with self.pool.connection() as conn1:
+            pass
+
+        mock_time.return_value = 200
+        with self.pool.connection() as conn2:
+            pass
+
+        self.assertIsNot(conn1, conn2)
+        conn1.disconnect.assert_called_once_with()
+        self.assertFalse(conn1.is_alive.called)
+
+    def test_close(self, mock_spawn):
+        with self.pool.connection() as conn:
+            pass
+
+        self.pool.close()
+
+        conn.disconnect.assert_called_once_with()
+        self.assertEqual(0, len(self.pool._idle))
@@ -154,17 +154,51 @@ class TestDeviceManager(unittest.TestCase):
         self.assertEqual('{network_id}',
                          device.ngs_config['ngs_network_name_format'])
 
+    def test_driver_settings(self):
+        device_cfg = {"device_type": 'netmiko_ovs_linux',
+                      "ngs_ssh_connect_timeout": "120",
+                      "ngs_trunk_ports": "port1, port2",
+                      "ngs_port_default_vlan": "20",
+                      "ngs_disable_inactive_ports": "true",
+                      "ngs_save_configuration": "False"}
+        device = devices.device_manager(device_cfg)
+        self.assertEqual(120, device.settings.ssh_connect_timeout)
+        self.assertEqual(10, device.settings.ssh_connect_interval)
+        self.assertEqual(("port1", "port2"), device.settings.trunk_ports)
+        self.assertEqual((), device.settings.physical_networks)
+        self.assertEqual("20", device.settings.port_default_vlan)
+        self.assertIsNone(device.settings.mac_address)
+        self.assertIs(True, device.settings.disable_inactive_ports)
+        self.assertIs(False, device.settings.save_configuration)
+        self.assertIs(True, device.settings.manage_vlans)
+        self.assertRaises(AttributeError, setattr, device.settings,
+                          'manage_vlans', False)
+
+    def test_driver_settings_invalid_bool(self):
+        device_cfg = {"ngs_manage_vlans": "maybe"}
+        self.assertRaisesRegex(
+            exc.GenericSwitchConfigValueInvalid,
+            r"Invalid value for 'ngs_manage_vlans': maybe",
+            FakeDevice, device_cfg)
+
+    def test_driver_settings_invalid_int(self):
+        device_cfg = {"ngs_max_connections": "two"}
+        self.assertRaisesRegex(
+            exc.GenericSwitchConfigValueInvalid,
+            r"Invalid value for 'ngs_max_connections': two",
+            FakeDevice, device_cfg)
+
     def test__get_trunk_ports(self):
         device_cfg = {"ngs_trunk_ports": 'port1, Po 1/30,port42'}
         device = FakeDevice(device_cfg)
         trunk_ports = device._get_trunk_ports()
-        self.assertEqual(["port1", "Po 1/30", "port42"], trunk_ports)
+        self.assertEqual(("port1", "Po 1/30", "port42"), trunk_ports)
 
     def test__get_physical_networks(self):
         device_cfg = {"ngs_physical_networks": 'net1,  net2, net3  '}
         device = FakeDevice(device_cfg)
         physnets = device._get_physical_networks()
-        self.assertEqual(["net1", "net2", "net3"], physnets)
+        self.assertEqual(("net1", "net2", "net3"), physnets)
 
     def test__disable_inactive_ports(self):
         device_cfg = {"device_type": 'netmiko_ovs_linux',
@@ -16,6 +16,7 @@
 import unittest
 from unittest import mock
 
+import eventlet
 from neutron.db import provisioning_blocks
 from neutron.plugins.ml2 import driver_context
 from neutron_lib.callbacks import resources
@@ -40,6 +41,47 @@ class TestGenericSwitchDriver(unittest.TestCase):
         patcher.start()
         self.addCleanup(patcher.stop)
 
+    def _set_device_loading(self, device_loading):
+        gsm.CONF.set_override('device_loading', device_loading, group='ngs')
+        self.addCleanup(gsm.CONF.clear_override, 'device_loading',
+                        group='ngs')
+
+    def test_initialize_eager(self, m_list):
+        driver = gsm.GenericSwitchDriver()
+        driver.initialize()
+        self.assertTrue(driver.switches.is_loaded('foo'))
+
+    def test_initialize_lazy(self, m_list):
+        self._set_device_loading('lazy')
+        driver = gsm.GenericSwitchDriver()
+        driver.initialize()
+        self.assertFalse(driver.switches.is_loaded('foo'))
+
+        mock_context = mock.create_autospec(driver_context.NetworkContext)
+        mock_context.current = {'id': 22,
+                                'provider:network_type': 'vlan',
+                                'provider:segmentation_id': 22,
+                                'provider:physical_network': 'physnet1'}
+        driver.create_network_postcommit(mock_context)
+
+        self.assertTrue(driver.switches.is_loaded('foo'))
+        self.switch_mock.add_network.assert_called_once_with(22, 22)
+
+    @mock.patch.object(gsm.eventlet, 'spawn_n', autospec=True)
+    def test_initialize_background(self, mock_spawn, m_list):
+        self._set_device_loading('background')
+        driver = gsm.GenericSwitchDriver()
+        driver.initialize()
+        self.assertFalse(driver.switches.is_loaded('foo'))
+        mock_spawn.assert_called_once_with(driver.switches.load_all,
+                                           ignore_errors=True)
+
+    def _set_physical_networks(self, m_list, physnets):
+        m_list.return_value = {
+            'foo': {'device_type': 'bar', 'spam': 'ham', 'ip': 'ip',
+                    'ngs_physical_networks': ','.join(physnets)}}
+        self.switch_mock._get_physical_networks.return_value = physnets
+
     def test_create_network_postcommit(self, m_list):
         driver = gsm.GenericSwitchDriver()
         driver.initialize()
@@ -53,6 +95,7 @@ class TestGenericSwitchDriver(unittest.TestCase):
         self.switch_mock.add_network.assert_called_once_with(22, 22)
 
     def test_create_network_postcommit_with_physnet(self, m_list):
+        self._set_physical_networks(m_list, ['physnet1'])
         driver = gsm.GenericSwitchDriver()
         driver.initialize()
         mock_context = mock.create_autospec(driver_context.NetworkContext)
@@ -60,12 +103,12 @@ class TestGenericSwitchDriver(unittest.TestCase):
                                 'provider:network_type': 'vlan',
                                 'provider:segmentation_id': 22,
                                 'provider:physical_network': 'physnet1'}
-        self.switch_mock._get_physical_networks.return_value = ['physnet1']
 
         driver.create_network_postcommit(mock_context)
         self.switch_mock.add_network.assert_called_once_with(22, 22)
 
     def test_create_network_postcommit_with_multiple_physnets(self, m_list):
+        self._set_physical_networks(m_list, ['physnet1', 'physnet2'])
         driver = gsm.GenericSwitchDriver()
         driver.initialize()
         mock_context = mock.create_autospec(driver_context.NetworkContext)
@@ -73,14 +116,13 @@ class TestGenericSwitchDriver(unittest.TestCase):
                                 'provider:network_type': 'vlan',
                                 'provider:segmentation_id': 22,
                                 'provider:physical_network': 'physnet1'}
-        self.switch_mock._get_physical_networks.return_value = ['physnet1',
-                                                                'physnet2']
 
         driver.create_network_postcommit(mock_context)
         self.switch_mock.add_network.assert_called_once_with(22, 22)
         self.assertEqual(self.switch_mock.add_network.call_count, 1)
 
     def test_create_network_postcommit_with_different_physnet(self, m_list):
+        self._set_physical_networks(m_list, ['physnet2'])
         driver = gsm.GenericSwitchDriver()
         driver.initialize()
         mock_context = mock.create_autospec(driver_context.NetworkContext)
@@ -88,11 +130,44 @@ class TestGenericSwitchDriver(unittest.TestCase):
                                 'provider:network_type': 'vlan',
                                 'provider:segmentation_id': 22,
                                 'provider:physical_network': 'physnet1'}
-        self.switch_mock._get_physical_networks.return_value = ['physnet2']
 
         driver.create_network_postcommit(mock_context)
         self.assertFalse(self.switch_mock.add_network.called)
 
+    def test_get_devices_by_physnet(self, m_list):
+        m_list.return_value = {
+            'a': {'device_type': 'bar', 'ngs_physical_networks': 'physnet1'},
+            'b': {'device_type': 'bar'},
+            'c': {'device_type': 'bar',
+                  'ngs_physical_networks': 'physnet2,physnet1'},
+            'd': {'device_type': 'bar', 'ngs_physical_networks': 'physnet2'},
+        }
+
+        def make_switch(device_cfg):
+            switch = mock.Mock()
+            physnets = device_cfg.get('ngs_physical_networks')
+            switch._get_physical_networks.return_value = (
+                physnets.split(',') if physnets else [])
+            return switch
+
+        with mock.patch('networking_generic_switch.devices.device_manager',
+                        side_effect=make_switch):
+            driver = gsm.GenericSwitchDriver()
+            driver.initialize()
+
+        self.assertEqual(
+            ['a', 'b', 'c'],
+            [name for name, _ in driver._get_devices_by_physnet('physnet1')])
+        self.assertEqual(
+            ['b', 'c', 'd'],
+            [name for name, _ in driver._get_devices_by_physnet('physnet2')])
+        self.assertEqual(
+            ['b'],
+            [name for name, _ in driver._get_devices_by_physnet('physnet3')])
+        # The index is built from the switch configuration.
+        for switch in driver.switches.values():
+            switch._get_physical_networks.assert_not_called()
+
     @mock.patch('networking_generic_switch.generic_switch_mech.LOG')
     def test_create_network_postcommit_failure(self, m_log, m_list):
         driver = gsm.GenericSwitchDriver()
@@ -132,6 +207,54 @@ class TestGenericSwitchDriver(unittest.TestCase):
         self.assertEqual(1, m_log.error.call_count)
         self.assertIn('Failed to create network', m_log.error.call_args[0][0])
 
+    @mock.patch('networking_generic_switch.generic_switch_mech.LOG')
+    def test_create_network_postcommit_concurrent(self, m_log, m_list):
+        gsm.CONF.set_override('switch_concurrency', 2, group='ngs')
+        self.addCleanup(gsm.CONF.clear_override, 'switch_concurrency',
+                        group='ngs')
+        m_list.return_value = {
+            'foo': {'device_type': 'bar', 'spam': 'ham', 'ip': 'ip'},
+            'bar': {'device_type': 'bar', 'spam': 'ham', 'ip': 'ip'},
+            'baz': {'device_type': 'bar', 'spam': 'ham', 'ip': 'ip'},
+        }
+        driver = gsm.GenericSwitchDriver()
+        driver.initialize()
+        m_log.reset_mock()
+        mock_context = mock.create_autospec(driver_context.NetworkContext)
+        mock_context.current = {'id': 22,
+                                'provider:network_type': 'vlan',
+                                'provider:segmentation_id': 22,
+                                'provider:physical_network': 'physnet1'}
+
+        driver.create_network_postcommit(mock_context)
+        self.switch_mock.add_network.assert_called_with(22, 22)
+        self.assertEqual(3, self.switch_mock.add_network.call_count)
+        self.assertEqual(3, m_log.info.call_count)
+
+    @mock.patch('networking_generic_switch.generic_switch_mech.LOG')
+    def test_create_network_postcommit_concurrent_failure(self, m_log,
+                                                          m_list):
+        gsm.CONF.set_override('switch_concurrency', 2, group='ngs')
+        self.addCleanup(gsm.CONF.clear_override, 'switch_concurrency',
+                        group='ngs')
+        m_list.return_value = {
+            'foo': {'device_type': 'bar', 'spam': 'ham', 'ip': 'ip'},
+            'bar': {'device_type': 'bar', 'spam': 'ham', 'ip': 'ip'},
+        }
+        driver = gsm.GenericSwitchDriver()
+        driver.initialize()
+        self.switch_mock.add_network.side_effect = [ValueError('boom'), None]
+        mock_context = mock.create_autospec(driver_context.NetworkContext)
+        mock_context.current = {'id': 22,
+                                'provider:network_type': 'vlan',
+                                'provider:segmentation_id': 22,
+                                'provider:physical_network': 'physnet1'}
+
+        self.assertRaisesRegex(ValueError, "boom",
+                               driver.create_network_postcommit, mock_context)
+        self.assertEqual(1, m_log.error.call_count)
+        self.assertIn('Failed to create network', m_log.error.call_args[0][0])
+
     def test_delete_network_postcommit(self, m_list):
         driver = gsm.GenericSwitchDriver()
         driver.initialize()
@@ -145,6 +268,7 @@ class TestGenericSwitchDriver(unittest.TestCase):
         self.switch_mock.del_network.assert_called_once_with(22, 22)
 
     def test_delete_network_postcommit_with_physnet(self, m_list):
+        self._set_physical_networks(m_list, ['physnet1'])
         driver = gsm.GenericSwitchDriver()
         driver.initialize()
         mock_context = mock.create_autospec(driver_context.NetworkContext)
@@ -152,12 +276,12 @@ class TestGenericSwitchDriver(unittest.TestCase):
                                 'provider:network_type': 'vlan',
                                 'provider:segmentation_id': 22,
                                 'provider:physical_network': 'physnet1'}
-        self.switch_mock._get_physical_networks.return_value = ['physnet1']
 
         driver.delete_network_postcommit(mock_context)
         self.switch_mock.del_network.assert_called_once_with(22, 22)
 
     def test_delete_network_postcommit_with_multiple_physnets(self, m_list):
+        self._set_physical_networks(m_list, ['physnet1', 'physnet2'])
         driver = gsm.GenericSwitchDriver()
         driver.initialize()
         mock_context = mock.create_autospec(driver_context.NetworkContext)
@@ -165,14 +289,13 @@ class TestGenericSwitchDriver(unittest.TestCase):
                                 'provider:network_type': 'vlan',
                                 'provider:segmentation_id': 22,
                                 'provider:physical_network': 'physnet1'}
-        self.switch_mock._get_physical_networks.return_value = ['physnet1',
-                                                                'physnet2']
 
         driver.delete_network_postcommit(mock_context)
         self.switch_mock.del_network.assert_called_once_with(22, 22)
         self.assertEqual(self.switch_mock.del_network.call_count, 1)
 
     def test_delete_network_postcommit_with_different_physnet(self, m_list):
+        self._set_physical_networks(m_list, ['physnet2'])
         driver = gsm.GenericSwitchDriver()
         driver.initialize()
         mock_context = mock.create_autospec(driver_context.NetworkContext)
@@ -180,7 +303,6 @@ class TestGenericSwitchDriver(unittest.TestCase):
                                 'provider:network_type': 'vlan',
                                 'provider:segmentation_id': 22,
                                 'provider:physical_network': 'physnet1'}
-        self.switch_mock._get_physical_networks.return_value = ['physnet2']
 
         driver.delete_network_postcommit(mock_context)
         self.assertFalse(self.switch_mock.del_network.called)
@@ -225,6 +347,76 @@ class TestGenericSwitchDriver(unittest.TestCase):
         self.assertEqual(2, m_log.error.call_count)
         self.assertIn('Failed to delete network', m_log.error.call_args[0][0])
 
+    @mock.patch('networking_generic_switch.generic_switch_mech.LOG')
+    def test_delete_network_postcommit_concurrent_failure(self, m_log,
+                                                          m_list):
+        gsm.CONF.set_override('switch_concurrency', 2, group='ngs')
+        self.addCleanup(gsm.CONF.clear_override, 'switch_concurrency',
+                        group='ngs')
+        m_list.return_value = {
+            'foo': {'device_type': 'bar', 'spam': 'ham', 'ip': 'ip'},
+            'bar': {'device_type': 'bar', 'spam': 'ham', 'ip': 'ip'},
+            'baz': {'device_type': 'bar', 'spam': 'ham', 'ip': 'ip'},
+        }
+        driver = gsm.GenericSwitchDriver()
+        driver.initialize()
+        m_log.reset_mock()
+        self.switch_mock.del_network.side_effect = [
+            ValueError('boom'), None, None]
+        mock_context = mock.create_autospec(driver_context.NetworkContext)
+        mock_context.current = {'id': 22,
+                                'provider:network_type': 'vlan',
+                                'provider:segmentation_id': 22,
+                                'provider:physical_network': 'physnet1'}
+
+        self.assertRaisesRegex(ValueError, "boom",
+                               driver.delete_network_postcommit, mock_context)
+        self.assertEqual(3, self.switch_mock.del_network.call_count)
+        self.assertEqual(1, m_log.error.call_count)
+        self.assertEqual(2, m_log.info.call_count)
+
+    @mock.patch('networking_generic_switch.generic_switch_mech.LOG')
+    def _test_delete_network_postcommit_load_failure(self, m_list, m_log):
+        self._set_device_loading('lazy')
+        m_list.return_value = {
+            'foo': {'device_type': 'bar', 'spam': 'ham', 'ip': 'ip'},
+            'bad': {'device_type': 'unknown', 'spam': 'ham', 'ip': 'ip'},
+            'baz': {'device_type': 'bar', 'spam': 'ham', 'ip': 'ip'},
+        }
+
+        def make_switch(device_cfg):
+            if device_cfg['device_type'] == 'unknown':
+                raise exceptions.GenericSwitchEntrypointLoadError(
+                    ep='unknown', err='boom')
+            return self.switch_mock
+
+        driver = gsm.GenericSwitchDriver()
+        driver.initialize()
+        mock_context = mock.create_autospec(driver_context.NetworkContext)
+        mock_context.current = {'id': 22,
+                                'provider:network_type': 'vlan',
+                                'provider:segmentation_id': 22,
+                                'provider:physical_network': 'physnet1'}
+
+        with mock.patch('networking_generic_switch.devices.device_manager',
+                        side_effect=make_switch):
+            self.assertRaises(exceptions.GenericSwitchEntrypointLoadError,
+                              driver.delete_network_postcommit, mock_context)
+
+        # The other switches are still attempted.
+        self.assertEqual(2, self.switch_mock.del_network.call_count)
+        self.assertEqual(1, m_log.error.call_count)
+        self.assertIn('Failed to delete network', m_log.error.call_args[0][0])
+
+    def test_delete_network_postcommit_load_failure(self, m_list):
+        self._test_delete_network_postcommit_load_failure(m_list)
+
+    def test_delete_network_postcommit_load_failure_concurrent(self, m_list):
+        gsm.CONF.set_override('switch_concurrency', 2, group='ngs')
+        self.addCleanup(gsm.CONF.clear_override, 'switch_concurrency',
+                        group='ngs')
+        self._test_delete_network_postcommit_load_failure(m_list)
+
     def test_delete_port_postcommit(self, m_list):
         driver = gsm.GenericSwitchDriver()
         driver.initialize()
@@ -747,6 +939,52 @@ class TestGenericSwitchDriver(unittest.TestCase):
              mock.call(3333, 123)])
         m_pc.assert_not_called()
 
+    @mock.patch.object(provisioning_blocks, 'provisioning_complete')
+    def test_update_portgroup_postcommit_unbind_multiple_switches(self, m_pc,
+                                                                  m_list):
+        switches, events = self._make_two_switches(m_list)
+        driver = gsm.GenericSwitchDriver()
+        driver.initialize()
+        mock_context = mock.create_autospec(driver_context.PortContext)
+        mock_context._plugin_context = mock.MagicMock()
+        mock_context.current = {'binding:profile': {},
+                                'binding:vnic_type': 'baremetal',
+                                'id': '123',
+                                'binding:vif_type': 'unbound'}
+        mock_context.original = {'binding:profile':
+                                 {'local_link_information':
+                                     [
+                                         {
+                                             'switch_info': 'foo',
+                                             'port_id': 2222
+                                         },
+                                         {
+                                             'switch_info': 'bar',
+                                             'port_id': 3333
+                                         },
+                                         {
+                                             'switch_info': 'baz',
+                                             'port_id': 4444
+                                         },
+                                     ]
+                                  },
+                                 'binding:vnic_type': 'baremetal',
+                                 'id': '123',
+                                 'binding:vif_type': 'other'}
+        mock_context.network = mock.Mock()
+        mock_context.network.current = {'provider:segmentation_id': 123,
+                                        'id': 'aaaa-bbbb-cccc'}
+
+        driver.update_port_postcommit(mock_context)
+
+        switches[0].delete_port.assert_called_once_with(2222, 123)
+        switches[1].delete_port.assert_called_once_with(3333, 123)
+        self.assertEqual([('switch0', 2222, 'start'),
+                          ('switch1', 3333, 'start'),
+                          ('switch0', 2222, 'end'),
+                          ('switch1', 3333, 'end')], events)
+        m_pc.assert_not_called()
+
     @mock.patch.object(provisioning_blocks, 'add_provisioning_component')
     def test_bind_port(self, m_apc, m_list):
         driver = gsm.GenericSwitchDriver()
@@ -827,6 +1065,128 @@ class TestGenericSwitchDriver(unittest.TestCase):
                                           resources.PORT,
                                           'GENERICSWITCH')])
 
+    def _make_two_switches(self, m_list):
+        m_list.return_value = {
+            'foo': {'device_type': 'bar', 'spam': 'ham', 'ip': 'ip'},
+            'bar': {'device_type': 'bar', 'spam': 'ham', 'ip': 'ip'},
+        }
+        switches = []
+        events = []
+
+        def make_switch(device_cfg):
+            switch = mock.Mock()
+            switch._get_physical_networks.return_value = []
+            name = 'switch%d' % len(switches)
+
+            def configure(port_id, segmentation_id):
+                events.append((name, port_id, 'start'))
+                eventlet.sleep(0)
+                events.append((name, port_id, 'end'))
+
+            switch.plug_port_to_network.side_effect = configure
+            switch.delete_port.side_effect = configure
+            switches.append(switch)
+            return switch
+
+        patcher = mock.patch(
+            'networking_generic_switch.devices.device_manager',
+            side_effect=make_switch)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        gsm.CONF.set_override('switch_concurrency', 2, group='ngs')
+        self.addCleanup(gsm.CONF.clear_override, 'switch_concurrency',
+                        group='ngs')
+        return switches, events
+
+    @mock.patch.object(provisioning_blocks, 'add_provisioning_component')
+    def test_bind_portgroup_multiple_switches(self, m_apc, m_list):
+        switches, events = self._make_two_switches(m_list)
+        driver = gsm.GenericSwitchDriver()
+        driver.initialize()
+        mock_context = mock.create_autospec(driver_context.PortContext)
+        mock_context._plugin_context = mock.MagicMock()
+        mock_context.current = {'binding:profile':
+                                {'local_link_information':
+                                    [
+                                        {
+                                            'switch_info': 'foo',
+                                            'port_id': 2222
+                                        },
+                                        {
+                                            'switch_info': 'bar',
+                                            'port_id': 3333
+                                        },
+                                        {
+                                            'switch_info': 'foo',
+                                            'port_id': 4444
+                                        },
+                                    ]
+                                 },
+                                'binding:vnic_type': 'baremetal',
+                                'id': '123'}
+        mock_context.network.current = {
+            'provider:physical_network': 'physnet1'
+        }
+        mock_context.segments_to_bind = [
+            {
+                'segmentation_id': 22,
+                'id': 123
+            }
+        ]
+
+        driver.bind_port(mock_context)
+
+        switches[0].plug_port_to_network.assert_has_calls(
+            [mock.call(2222, 22), mock.call(4444, 22)])
+        switches[1].plug_port_to_network.assert_called_once_with(3333, 22)
+        # Links on different switches are configured concurrently, links on
+        # the same switch one after another.
+        self.assertEqual([('switch0', 2222, 'start'),
+                          ('switch1', 3333, 'start'),
+                          ('switch0', 2222, 'end'),
+                          ('switch0', 4444, 'start'),
+                          ('switch1', 3333, 'end'),
+                          ('switch0', 4444, 'end')], events)
+        mock_context.set_binding.assert_called_once_with(123, 'other', {})
+
+    @mock.patch.object(provisioning_blocks, 'add_provisioning_component')
+    def test_bind_portgroup_multiple_switches_failure(self, m_apc, m_list):
+        switches, events = self._make_two_switches(m_list)
+        driver = gsm.GenericSwitchDriver()
+        driver.initialize()
+        switches[1].plug_port_to_network.side_effect = ValueError('boom')
+        mock_context = mock.create_autospec(driver_context.PortContext)
+        mock_context._plugin_context = mock.MagicMock()
+        mock_context.current = {'binding:profile':
+                                {'local_link_information':
+                                    [
+                                        {
+                                            'switch_info': 'foo',
+                                            'port_id': 2222
+                                        },
+                                        {
+                                            'switch_info': 'bar',
+                                            'port_id': 3333
+                                        },
+                                    ]
+                                 },
+                                'binding:vnic_type': 'baremetal',
+                                'id': '123'}
+        mock_context.network.current = {
+            'provider:physical_network': 'physnet1'
+        }
+        mock_context.segments_to_bind = [
+            {
+                'segmentation_id': 22,
+                'id': 123
+            }
+        ]
+
+        self.assertRaisesRegex(ValueError, 'boom', driver.bind_port,
+                               mock_context)
+        self.assertFalse(mock_context.set_binding.called)
+        self.assertFalse(m_apc.called)
+
     @mock.patch.object(provisioning_blocks, 'add_provisioning_component')
     def test_bind_portgroup_802_3ad(self, m_apc, m_list):
         driver = gsm.GenericSwitchDriver()
@@ -0,0 +1,47 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import sys
+import unittest
+from unittest import mock
+
+from networking_generic_switch import _lazy_import
+
+
+class LazyImportTest(unittest.TestCase):
+
+    def test_already_imported(self):
+        self.assertIs(json, _lazy_import.lazy_import('json'))
+
+    @mock.patch.object(_lazy_import.importlib, 'import_module', autospec=True)
+    def test_lazy(self, mock_import):
+        module = mock.Mock(spec=['spam'])
+        mock_import.return_value = module
+        with mock.patch.dict(sys.modules):
+            sys.modules.pop('fake_module', None)
+            lazy = _lazy_import.lazy_import('fake_module')
+        self.assertIsInstance(lazy, _lazy_import.LazyModule)
+        self.assertFalse(mock_import.called)
+
+        self.assertEqual(module.spam, lazy.spam)
+        lazy.ham = 'eggs'
+        self.assertEqual('eggs', module.ham)
+        del lazy.ham
+        self.assertFalse(hasattr(module, 'ham'))
+        mock_import.assert_called_once_with('fake_module')
+
+    def test_patch(self):
+        lazy = _lazy_import.LazyModule('json')
+        with mock.patch.object(lazy, 'dumps', autospec=True) as mock_dumps:
+            self.assertIs(mock_dumps, json.dumps)
+        self.assertIsNot(mock_dumps, json.dumps)
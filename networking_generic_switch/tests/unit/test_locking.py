@@ -80,3 +80,42 @@ class PoolLockTest(fixtures.TestWithFixtures):
         log_mock.assert_called_once_with(mock.ANY, exc_info=True)
         lock_mock.release.assert_not_called()
         stop_mock.assert_called_once_with(1)
+
+
+@mock.patch.dict(ngs_lock._COORDINATORS, clear=True)
+@mock.patch.object(coordination, 'get_coordinator', autospec=True)
+class SharedCoordinatorTest(fixtures.TestWithFixtures):
+
+    @mock.patch.object(ngs_lock.atexit, 'register', autospec=True)
+    def test_get_coordinator(self, mock_register, mock_get_coord):
+        coord1 = ngs_lock.get_coordinator('mysql://localhost', b'ngs-host')
+        coord2 = ngs_lock.get_coordinator('mysql://localhost', b'ngs-host')
+        coord3 = ngs_lock.get_coordinator('etcd3://localhost', b'ngs-host')
+
+        self.assertIs(coord1, coord2)
+        self.assertIsNot(coord1, coord3)
+        mock_register.assert_called_once_with(ngs_lock._stop_coordinators)
+        self.assertFalse(mock_get_coord.called)
+
+    def test_get_lock_starts_once(self, mock_get_coord):
+        coord = ngs_lock.SharedCoordinator('mysql://localhost', b'ngs-host')
+
+        lock1 = coord.get_lock(b'spam0')
+        lock2 = coord.get_lock(b'spam1')
+
+        mock_get_coord.assert_called_once_with('mysql://localhost',
+                                               b'ngs-host')
+        tooz_coord = mock_get_coord.return_value
+        tooz_coord.start.assert_called_once_with(start_heart=True)
+        self.assertEqual(tooz_coord.get_lock.return_value, lock1)
+        self.assertEqual(tooz_coord.get_lock.return_value, lock2)
+
+    def test_stop(self, mock_get_coord):
+        coord = ngs_lock.SharedCoordinator('mysql://localhost', b'ngs-host')
+        coord.stop()
+        coord.get_lock(b'spam0')
+
+        coord.stop()
+        coord.stop()
+
+        mock_get_coord.return_value.stop.assert_called_once_with()
@@ -0,0 +1,141 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from unittest import mock
+
+import fixtures
+
+from networking_generic_switch import save_scheduler
+
+
+@mock.patch.object(save_scheduler.time, 'monotonic', autospec=True)
+@mock.patch.object(save_scheduler.eventlet, 'sleep', autospec=True)
+@mock.patch.object(save_scheduler.eventlet, 'spawn', autospec=True)
+class SaveSchedulerTest(fixtures.TestWithFixtures):
+
+    def setUp(self):
+        super(SaveSchedulerTest, self).setUp()
+        self.save = mock.Mock()
+        self.scheduler = save_scheduler.SaveScheduler(
+            self.save, delay=10, max_wait=30, name='switch1')
+
+    def test_schedule(self, mock_spawn, mock_sleep, mock_time):
+        mock_time.return_value = 100
+        self.scheduler.schedule()
+        self.scheduler.schedule()
+
+        self.assertTrue(self.scheduler.pending)
+        self.assertFalse(self.save.called)
+        mock_spawn.assert_called_once_with(self.scheduler._run)
+
+    def test_run_debounced(self, mock_spawn, mock_sleep, mock_time):
+        mock_time.return_value = 100
+        self.scheduler.schedule()
+
+        # A further request extends the delay.
+        def sleep(seconds):
+            if mock_sleep.call_count == 1:
+                mock_time.return_value = 105
+                self.scheduler.schedule()
+                mock_time.return_value = 110
+            else:
+                mock_time.return_value += seconds
+
+        mock_sleep.side_effect = sleep
+        self.scheduler._run()
+
+        self.assertEqual([mock.call(10), mock.call(5)],
+                         mock_sleep.call_args_list)
+        self.save.assert_called_once_with()
+        self.assertFalse(self.scheduler.pending)
+        self.assertIsNone(self.scheduler._saver)
+
+    def test_run_max_wait(self, mock_spawn, mock_sleep, mock_time):
+        mock_time.return_value = 100
+        self.scheduler.schedule()
+
+        # Requests keep arriving, but the save is delayed by at most
+        # max_wait seconds.
+        def sleep(seconds):
+            mock_time.return_value += seconds
+            if mock_time.return_value < 130:
+                self.scheduler.schedule()
+
+        mock_sleep.side_effect = sleep
+        self.scheduler._run()
+
+        self.assertEqual(130, mock_time.return_value)
+        self.save.assert_called_once_with()
+
+    def test_flush(self, mock_spawn, mock_sleep, mock_time):
+        mock_time.return_value = 100
+        self.scheduler.schedule()
+
+        self.scheduler.flush()
+
+        self.save.assert_called_once_with()
+        self.assertFalse(self.scheduler.pending)
+
+        # Nothing pending.
+        self.scheduler.flush()
+        self.assertEqual(1, self.save.call_count)
+
+    def test_flush_failure(self, mock_spawn, mock_sleep, mock_time):
+        mock_time.return_value = 100
+        self.save.side_effect = Exception('Bang')
+        self.scheduler.schedule()
+
+        self.scheduler.flush()
+
+        # The save is retried.
+        self.save.assert_called_once_with()
+        self.assertTrue(self.scheduler.pending)
+        self.assertEqual(110, self.scheduler._retry_at)
+        mock_spawn.assert_called_once_with(self.scheduler._run)
+
+    def test_run_failure_backoff(self, mock_spawn, mock_sleep, mock_time):
+        mock_time.return_value = 100
+        self.save.side_effect = [Exception('Bang'), Exception('Bang'), None]
+        self.scheduler.schedule()
+
+        def sleep(seconds):
+            mock_time.return_value += seconds
+
+        mock_sleep.side_effect = sleep
+        self.scheduler._run()
+
+        self.assertEqual([mock.call(10), mock.call(10), mock.call(20)],
+                         mock_sleep.call_args_list)
+        self.assertEqual(3, self.save.call_count)
+        self.assertFalse(self.scheduler.pending)
+        self.assertEqual(0, self.scheduler._failures)
+        self.assertIsNone(self.scheduler._retry_at)
+
+    def test_run_failure_backoff_max(self, mock_spawn, mock_sleep,
+                                     mock_time):
+        mock_time.return_value = 100
+        self.scheduler._failures = 10
+        self.save.side_effect = Exception('Bang')
+        self.scheduler.schedule()
+
+        self.scheduler.flush()
+
+        self.assertEqual(100 + save_scheduler.MAX_RETRY_INTERVAL,
+                         self.scheduler._retry_at)
+
+    def test_flush_all_schedulers(self, mock_spawn, mock_sleep, mock_time):
+        mock_time.return_value = 100
+        self.scheduler.schedule()
+
+        save_scheduler.flush_all_schedulers()
+
+        self.save.assert_called_once_with()
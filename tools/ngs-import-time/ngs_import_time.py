@@ -0,0 +1,91 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Measure the import time of the genericswitch mechanism driver.
+
+Each module is imported in a fresh interpreter using ``python -X importtime``,
+and the cumulative import time of the module and of a set of heavy
+dependencies is reported.
+"""
+
+import argparse
+import json
+import re
+import subprocess
+import sys
+
+DEFAULT_MODULES = [
+    # Entry point of the genericswitch ML2 mechanism driver.
+    'networking_generic_switch.generic_switch_mech',
+    # Base module of the Netmiko device drivers.
+    'networking_generic_switch.devices.netmiko_devices',
+]
+
+# Dependencies that should only be imported on first use.
+WATCHED_MODULES = ['etcd3gw', 'netmiko', 'paramiko', 'tenacity', 'tooz']
+
+IMPORT_TIME_RE = re.compile(
+    r'^import time:\s+(\d+) \|\s+(\d+) \|(\s+)(\S+)$')
+
+
+def measure(module):
+    """Import a module in a new interpreter, and return its import times.
+
+    :param module: name of the module to import.
+    :returns: a dict mapping the names of the top-level module and of any
+        watched modules that were imported to their cumulative import time
+        in microseconds.
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_RE.match(line)
+        if not match:
+            continue
+        cumulative, name = int(match.group(2)), match.group(4)
+        if name == module or name in WATCHED_MODULES:
+            times[name] = cumulative
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES,
+                        help='Modules to import. Default: %(default)s')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='Number of runs per module. The fastest run is '
+                             'reported. Default: %(default)s')
+    parser.add_argument('--output',
+                        help='Path of a file to write the results to, in '
+                             'JSON format.')
+    args = parser.parse_args()
+
+    results = {}
+    for module in args.modules:
+        runs = [measure(module) for _ in range(args.runs)]
+        best = min(runs, key=lambda times: times[module])
+        results[module] = best
+        print('%s: %.1f ms' % (module, best[module] / 1000.0))
+        for name in WATCHED_MODULES:
+            if name in best:
+                print('    %s imported: %.1f ms' % (name, best[name] / 1000.0))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()